@@ -0,0 +1,60 @@
+"""
+ASGI handler of the project.
+
+The handler of Django 3.2 iterates streaming responses in the event loop thread, so every blocking part (e.g. the
+users export waiting for its next chunk) stalls all the requests of the worker. Here the parts are produced in
+a thread and only sent from the event loop.
+"""
+
+import asyncio
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+
+_done = object()
+
+
+class ASGIHandler(asgi.ASGIHandler):
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': self.response_headers(response),
+            })
+            loop = asyncio.get_running_loop()
+            parts = iter(response)
+            while True:
+                part = await loop.run_in_executor(None, next, parts, _done)
+                if part is _done:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            # Also when the client has gone, so the producer of the parts is stopped
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    def response_headers(response):
+        """Same as in `django.core.handlers.asgi.ASGIHandler.send_response`"""
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return headers
+
+
+def get_asgi_application():
+    """Same as `django.core.asgi.get_asgi_application`, with the handler above"""
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -9,8 +9,10 @@ https://docs.djangoproject.com/en/3.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
+import datetime
 import os
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 from environ import environ
 
 env = environ.Env(
@@ -29,7 +31,7 @@ environ.Env.read_env()
 SECRET_KEY = env('SECRET_KEY')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = env('DEBUG')
+DEBUG = env.bool('DEBUG', default=False)
 
 ALLOWED_HOSTS = ['*']
 
@@ -49,6 +51,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'user_data_storage_service.middleware.MetricsMiddleware',
+    'user_data_storage_service.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +89,39 @@ WSGI_APPLICATION = 'core.wsgi.application'
 DATABASES = {
     "default": env.db(),
 }
+# Connections are reused between requests and by the threads of the database pool of the async views
+DATABASES['default']['CONN_MAX_AGE'] = env.int('CONN_MAX_AGE', default=60)
+
+# Read replicas, comma separated database URLs. GET requests of the users endpoints read from a healthy replica,
+# except for the requests made within REPLICA_READ_YOUR_WRITES_WINDOW seconds after the user's own write.
+# A replica lagging by REPLICA_MAX_LAG seconds is still healthy until the next check, so the window must cover both
+DATABASE_REPLICAS = []
+for number, url in enumerate(env.list('REPLICA_DATABASE_URLS', default=[]), start=1):
+    DATABASES[f'replica_{number}'] = dict(env.db_url_config(url), CONN_MAX_AGE=DATABASES['default']['CONN_MAX_AGE'])
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+# Replica of the routing tests. Without REPLICA_DATABASE_URLS it is an alias of the primary, which nothing but the tests
+# uses: the test run makes it a test database of its own
+if DATABASE_REPLICAS:
+    TEST_REPLICA = DATABASE_REPLICAS[0]
+else:
+    TEST_REPLICA = 'test_replica'
+    DATABASES[TEST_REPLICA] = dict(DATABASES['default'])
+    if DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+        # SQLite test databases are in memory, one per alias
+        DATABASES[TEST_REPLICA]['TEST'] = {'NAME': f'test_{DATABASES["default"]["NAME"]}_replica'}
+
+DATABASE_ROUTERS = ['user_data_storage_service.routers.PrimaryReplicaRouter']
+REPLICA_HEALTH_CHECK_INTERVAL = env.int('REPLICA_HEALTH_CHECK_INTERVAL', default=10)
+REPLICA_MAX_LAG = env.int('REPLICA_MAX_LAG', default=10)
+REPLICA_READ_YOUR_WRITES_WINDOW = env.int('REPLICA_READ_YOUR_WRITES_WINDOW',
+                                          default=REPLICA_MAX_LAG + REPLICA_HEALTH_CHECK_INTERVAL)
+if REPLICA_READ_YOUR_WRITES_WINDOW < REPLICA_MAX_LAG + REPLICA_HEALTH_CHECK_INTERVAL:
+    raise ImproperlyConfigured('REPLICA_READ_YOUR_WRITES_WINDOW must be at least '
+                               'REPLICA_MAX_LAG + REPLICA_HEALTH_CHECK_INTERVAL')
+
+# Number of threads running the ORM work of the async views, one database connection per thread
+DB_THREAD_POOL_SIZE = env.int('DB_THREAD_POOL_SIZE', default=10)
 
 # DATABASES = {
 #     'default': {
@@ -152,7 +189,18 @@ INTERNAL_IPS = [
 AUTH_USER_MODEL = 'user_data_storage_service.MyUser'
 
 REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'user_data_storage_service.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'user_data_storage_service.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        'user_data_storage_service.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         # 'rest_framework.authentication.BasicAuthentication',
     ],
@@ -165,6 +213,107 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 1
 }
 
-
-
-
+# JWT authentication, the token is stored in `jwt` Cookies
+JWT_SECRET_KEY = env('JWT_SECRET_KEY', default=SECRET_KEY)
+JWT_ALGORITHM = 'HS256'
+JWT_LIFETIME = datetime.timedelta(hours=env.int('JWT_LIFETIME_HOURS', default=24))
+JWT_COOKIE_NAME = 'jwt'
+JWT_CLAIMS_CACHE_SIZE = env.int('JWT_CLAIMS_CACHE_SIZE', default=10000)
+
+# Password verification on login is run in a bounded pool of 'thread' or 'process' workers,
+# when all the workers are busy and the queue is full, login responds with 503
+PASSWORD_HASHER_EXECUTOR = env('PASSWORD_HASHER_EXECUTOR', default='thread')
+PASSWORD_HASHER_WORKERS = env.int('PASSWORD_HASHER_WORKERS', default=os.cpu_count() or 1)
+PASSWORD_HASHER_QUEUE_SIZE = env.int('PASSWORD_HASHER_QUEUE_SIZE', default=32)
+
+# Users lists pagination (cursor mode), page size may be changed by the `limit` query parameter
+USERS_PAGE_SIZE = env.int('USERS_PAGE_SIZE', default=20)
+USERS_MAX_PAGE_SIZE = env.int('USERS_MAX_PAGE_SIZE', default=1000)
+
+# Totals of the users lists and the admin changelists are estimated: by the PostgreSQL statistics for a whole table,
+# otherwise by a count cached for COUNT_CACHE_TTL seconds and refreshed in the background.
+# Totals below COUNT_EXACT_THRESHOLD are counted exactly
+COUNT_EXACT_THRESHOLD = env.int('COUNT_EXACT_THRESHOLD', default=10000)
+COUNT_CACHE_TTL = env.int('COUNT_CACHE_TTL', default=60)
+COUNT_CACHE_SIZE = env.int('COUNT_CACHE_SIZE', default=1000)
+
+# Users resolved by one request to /private/users/?ids=... (?emails=...) or /private/users/lookup/
+USERS_LOOKUP_MAX_SIZE = env.int('USERS_LOOKUP_MAX_SIZE', default=1000)
+
+# Operations of one request to /private/users/batch/
+USERS_BATCH_MAX_OPERATIONS = env.int('USERS_BATCH_MAX_OPERATIONS', default=1000)
+
+# Change feed /private/users/changes/: changes by pages of USERS_CHANGES_PAGE_SIZE (up to USERS_MAX_PAGE_SIZE by
+# `limit`), the changes of the last USERS_CHANGES_DELAY seconds are held back, it must exceed the longest transaction
+# changing the users and REPLICA_MAX_LAG
+USERS_CHANGES_PAGE_SIZE = env.int('USERS_CHANGES_PAGE_SIZE', default=500)
+USERS_CHANGES_DELAY = env.int('USERS_CHANGES_DELAY', default=15)
+
+# Users export, rows are read from the database by chunks, at most USERS_EXPORT_QUEUE_SIZE encoded chunks are buffered
+USERS_EXPORT_CHUNK_SIZE = env.int('USERS_EXPORT_CHUNK_SIZE', default=2000)
+USERS_EXPORT_QUEUE_SIZE = env.int('USERS_EXPORT_QUEUE_SIZE', default=4)
+
+# Thumbnails of the users photos, made in the background after a photo is saved
+USER_PHOTO_THUMBNAIL_SIZES = (64, 128, 256)
+USER_PHOTO_THUMBNAIL_FORMAT = env('USER_PHOTO_THUMBNAIL_FORMAT', default='WEBP')  # WEBP or JPEG
+USER_PHOTO_THUMBNAIL_QUALITY = 80
+USER_PHOTO_THUMBNAIL_WORKERS = env.int('USER_PHOTO_THUMBNAIL_WORKERS', default=2)
+USER_PHOTO_ADMIN_THUMBNAIL_SIZE = 128
+
+# Cache of users and their serialized payloads. The in-process level keeps entries for USER_CACHE_LOCAL_TTL seconds,
+# the shared level is the cache USER_CACHE_BACKEND from CACHES (empty to use only the in-process one)
+USER_CACHE_LOCAL_SIZE = env.int('USER_CACHE_LOCAL_SIZE', default=10000)
+USER_CACHE_LOCAL_TTL = env.int('USER_CACHE_LOCAL_TTL', default=5)
+USER_CACHE_BACKEND = env('USER_CACHE_BACKEND', default='')
+USER_CACHE_TIMEOUT = env.int('USER_CACHE_TIMEOUT', default=300)
+
+# Request metrics exposed at /metrics. Workers of the server write their metrics to METRICS_DIR every
+# METRICS_FLUSH_INTERVAL seconds to be aggregated (empty to keep them in the process). With METRICS_TOKEN set,
+# the scraper must send `Authorization: Bearer <token>`, without it only INTERNAL_IPS are served
+METRICS_DIR = env('METRICS_DIR', default='')
+METRICS_FLUSH_INTERVAL = env.int('METRICS_FLUSH_INTERVAL', default=5)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Profiling of the requests to the views listed in the admin (Profiling rules), or of a single request with the signed
+# `X-Profile` header. Rules are reloaded every PROFILING_RULES_REFRESH seconds, PROFILING_MAX_PROFILES last profiles
+# are kept per view
+PROFILING_RULES_REFRESH = env.int('PROFILING_RULES_REFRESH', default=10)
+PROFILING_SAMPLE_INTERVAL = env.float('PROFILING_SAMPLE_INTERVAL', default=0.005)
+PROFILING_TOKEN_MAX_AGE = env.int('PROFILING_TOKEN_MAX_AGE', default=3600)
+PROFILING_MAX_PROFILES = env.int('PROFILING_MAX_PROFILES', default=20)
+
+# Compression of the responses by the codings the client accepts: zstd and br (when the zstandard and brotli packages
+# are installed) and gzip. Bodies shorter than COMPRESSION_MIN_SIZE bytes are not compressed
+COMPRESSION_MIN_SIZE = env.int('COMPRESSION_MIN_SIZE', default=1024)
+COMPRESSION_GZIP_LEVEL = env.int('COMPRESSION_GZIP_LEVEL', default=6)
+COMPRESSION_BROTLI_QUALITY = env.int('COMPRESSION_BROTLI_QUALITY', default=5)
+COMPRESSION_ZSTD_LEVEL = env.int('COMPRESSION_ZSTD_LEVEL', default=3)
+
+# Sessions are kept in the worker process for SESSION_LOCAL_TTL seconds, a logout in another worker applies within it.
+# Changes are written through, the expiry of an unchanged session is written behind the requests every
+# SESSION_WRITE_BEHIND_INTERVAL seconds. Expired sessions are deleted every SESSION_SWEEP_INTERVAL seconds
+# by SESSION_SWEEP_BATCH_SIZE rows
+SESSION_ENGINE = 'user_data_storage_service.sessions'
+SESSION_LOCAL_SIZE = env.int('SESSION_LOCAL_SIZE', default=10000)
+SESSION_LOCAL_TTL = env.int('SESSION_LOCAL_TTL', default=5)
+SESSION_WRITE_BEHIND_INTERVAL = env.float('SESSION_WRITE_BEHIND_INTERVAL', default=1.0)
+SESSION_SWEEP_INTERVAL = env.int('SESSION_SWEEP_INTERVAL', default=3600)
+SESSION_SWEEP_BATCH_SIZE = env.int('SESSION_SWEEP_BATCH_SIZE', default=1000)
+
+# The OpenAPI schema is generated once per process and kept in memory, and in SCHEMA_CACHE_DIR when it's set (shared
+# by the workers and filled by `manage.py generate_schema`). SCHEMA_URL is the base URL of the API in the schema,
+# e.g. `https://api.example.com`, with it set the schema is generated by the worker warmup. Empty: the request URL,
+# the schemas of up to SCHEMA_CACHE_SIZE base URLs are kept in memory only
+SCHEMA_URL = env('SCHEMA_URL', default='')
+SCHEMA_CACHE_DIR = env('SCHEMA_CACHE_DIR', default='')
+SCHEMA_CACHE_SIZE = env.int('SCHEMA_CACHE_SIZE', default=16)
+
+# Events of the users changes (transactional outbox) are delivered by `manage.py dispatch_outbox` to the OUTBOX_SINKS:
+# http(s):// URLs (POST of NDJSON), file:// paths (NDJSON appended) and unix:// sockets. Without sinks no events are
+# saved. Failed deliveries are retried after OUTBOX_RETRY_BACKOFF seconds, doubled up to OUTBOX_RETRY_MAX_BACKOFF
+OUTBOX_SINKS = env.list('OUTBOX_SINKS', default=[])
+OUTBOX_BATCH_SIZE = env.int('OUTBOX_BATCH_SIZE', default=500)
+OUTBOX_POLL_INTERVAL = env.float('OUTBOX_POLL_INTERVAL', default=1.0)
+OUTBOX_RETRY_BACKOFF = env.float('OUTBOX_RETRY_BACKOFF', default=1.0)
+OUTBOX_RETRY_MAX_BACKOFF = env.float('OUTBOX_RETRY_MAX_BACKOFF', default=60.0)
+OUTBOX_HTTP_TIMEOUT = env.float('OUTBOX_HTTP_TIMEOUT', default=10.0)
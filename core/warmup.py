@@ -0,0 +1,29 @@
+"""
+Warmup of a started worker process.
+
+Lazy initialization (URL resolver, view classes, password hasher, database connections, OpenAPI schema, threads of
+the profiling rules and of the sessions) is done before the worker accepts connections, so the first requests to
+every worker are not slower than the rest.
+"""
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher
+from django.urls import get_resolver
+
+
+def warmup():
+    from user_data_storage_service import profiling
+    from user_data_storage_service.async_views import warm_db_pool
+    from user_data_storage_service.sessions import session_cache
+
+    resolver = get_resolver()
+    resolver.url_patterns
+    resolver.reverse_dict
+    get_hasher()
+    warm_db_pool()
+    profiling.rules.start()
+    session_cache.start_writer()
+    if settings.SCHEMA_URL:
+        from core.yasg import generate_schemas
+
+        generate_schemas()
@@ -1,7 +1,21 @@
-from django.urls import re_path
+import hashlib
+import inspect
+import os
+import tempfile
+import threading
+import drf_yasg
+import rest_framework
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import URLResolver, get_resolver, re_path
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from rest_framework import permissions
+from drf_yasg.renderers import _SpecRenderer
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
+from user_data_storage_service.compression import choose_encoding, compress
+from user_data_storage_service.conditional import not_modified, set_validators
+from user_data_storage_service.utils import LRUCache
 
 
 schema_view = get_schema_view(
@@ -9,12 +23,158 @@ schema_view = get_schema_view(
       title="Kefir Python Junior Test",
       default_version='0.1.0',
    ),
+   url=settings.SCHEMA_URL or None,
    public=True,
    permission_classes=(permissions.AllowAny,),
 )
 
+
+def iterate_views(patterns):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from iterate_views(pattern.url_patterns)
+        else:
+            yield str(pattern.pattern), pattern.callback
+
+
+def code_version():
+    """Fingerprint of what the schema is made of: the URLconf, the source files of the project's packages with
+    the views (views, serializers, filters...) and the versions of DRF and drf_yasg"""
+    digest = hashlib.md5(f'{rest_framework.VERSION} {drf_yasg.__version__}\n'.encode())
+    directories = set()
+    for route, callback in iterate_views(get_resolver().url_patterns):
+        view = getattr(callback, 'cls', getattr(callback, 'view_class', callback))
+        digest.update(f'{route} {view.__module__}.{view.__qualname__}\n'.encode())
+        source = inspect.getsourcefile(view)
+        if source and os.path.abspath(source).startswith(str(settings.BASE_DIR)):
+            directories.add(os.path.dirname(os.path.abspath(source)))
+    for directory in sorted(directories):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                with open(os.path.join(directory, name), 'rb') as file:
+                    digest.update(name.encode() + file.read())
+    return digest.hexdigest()
+
+
+class SchemaEntry:
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+        self.etag = f'"{hashlib.md5(content).hexdigest()}"'
+        self.compressed = {}
+
+    def get_content(self, encoding):
+        if encoding not in self.compressed:
+            self.compressed[encoding] = compress(encoding, self.content)
+        return self.compressed[encoding]
+
+
+class SchemaCache:
+    """Rendered schemas by format and base URL. They are generated once per process, or read from SCHEMA_CACHE_DIR
+    where `manage.py generate_schema` or another worker has written them. The files are named by `code_version`,
+    so a changed URLconf or code never gets an old schema.
+
+    Without SCHEMA_URL the base URL comes from the Host of the request, so the schemas of such requests are not
+    written to SCHEMA_CACHE_DIR and no more than SCHEMA_CACHE_SIZE of them are kept in memory"""
+
+    def __init__(self):
+        self.entries = LRUCache(maxsize=settings.SCHEMA_CACHE_SIZE)
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = code_version()
+        return self._version
+
+    def path(self, key):
+        name = hashlib.md5(repr(key).encode()).hexdigest()
+        return os.path.join(settings.SCHEMA_CACHE_DIR, f'schema-{self.version}-{name}')
+
+    def get(self, key, content_type, generate, persist=True):
+        """`persist` is whether the schema may be kept in SCHEMA_CACHE_DIR"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                content = self.load(key) if persist else None
+                if content is None:
+                    content = generate()
+                    if persist:
+                        self.store(key, content)
+                entry = SchemaEntry(content, content_type)
+                self.entries.set(key, entry)
+        return entry
+
+    def load(self, key):
+        if not settings.SCHEMA_CACHE_DIR:
+            return None
+        try:
+            with open(self.path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, content):
+        if settings.SCHEMA_CACHE_DIR:
+            os.makedirs(settings.SCHEMA_CACHE_DIR, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=settings.SCHEMA_CACHE_DIR, delete=False) as file:
+                file.write(content)
+            os.replace(file.name, self.path(key))
+        return content
+
+
+schema_cache = SchemaCache()
+
+
+class CachedSchemaView(schema_view):
+    """The schema (JSON, YAML) is generated once, see `SchemaCache`, and sent with an ETag, compressed by the codings
+    the client accepts. The UI pages have no schema inside, they are rendered as before"""
+
+    def get(self, request, version='', format=None):
+        renderer = request.accepted_renderer
+        if not isinstance(renderer, _SpecRenderer):
+            return super().get(request, version, format)
+
+        version = request.version or version or ''
+        key = (renderer.format, version, settings.SCHEMA_URL or request.build_absolute_uri('/'))
+        content_type = f'{request.accepted_media_type}; charset={renderer.charset}'
+        entry = schema_cache.get(key, content_type, lambda: renderer.render(
+            super(CachedSchemaView, self).get(request, version, format).data, request.accepted_media_type,
+            self.get_renderer_context()), persist=bool(settings.SCHEMA_URL))
+
+        response = not_modified(request, entry.etag)
+        if response is None:
+            encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+            response = HttpResponse(entry.get_content(encoding) if encoding else entry.content,
+                                    content_type=entry.content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+            set_validators(response, entry.etag)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        # Browsers check the ETag every time, the schema changes with a deploy
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+def generate_schemas():
+    """Generates the schemas of SCHEMA_URL in every format, so no request waits for them"""
+    from django.test import RequestFactory
+
+    factory = RequestFactory()
+    view = CachedSchemaView.without_ui(cache_timeout=0)
+    for format in ('.json', '.yaml'):
+        view(factory.get(f'/swagger{format}'), format=format)
+    # The Swagger UI loads the schema by `/swagger/?format=openapi`
+    CachedSchemaView.with_ui('swagger', cache_timeout=0)(factory.get('/swagger/', {'format': 'openapi'}))
+    return schema_cache.entries
+
+
 urlpatterns = [
-   re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-   re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-   re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
-]
\ No newline at end of file
+   re_path(r'^swagger(?P<format>\.json|\.yaml)$', CachedSchemaView.without_ui(cache_timeout=0), name='schema-json'),
+   re_path(r'^swagger/$', CachedSchemaView.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+   re_path(r'^redoc/$', CachedSchemaView.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+]
@@ -15,4 +15,9 @@ python manage.py flush --no-input
 python manage.py migrate
 python manage.py loaddata user_data_storage_service_myuser.json
 
+if [ -n "$USERS_IMPORT_FILE" ]
+then
+    python manage.py import_users "$USERS_IMPORT_FILE"
+fi
+
 exec "$@"
\ No newline at end of file
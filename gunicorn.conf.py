@@ -0,0 +1,34 @@
+# Production server: gunicorn -c gunicorn.conf.py core.asgi:application
+# Every worker runs the ASGI application in the uvicorn event loop.
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Django and the project modules are imported once in the master process and shared by the forked workers
+preload_app = True
+keepalive = 5
+graceful_timeout = 30
+accesslog = '-'
+# Metrics of the workers are aggregated through the files of this directory, see user_data_storage_service/metrics.py
+metrics_dir = os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'user_data_storage_metrics'))
+
+
+def on_starting(server):
+    # Files of the previous server run, their counters must not be added to the new ones
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # Connections must not be shared between processes
+    from django.db import connections
+    connections.close_all()
+
+
+def post_worker_init(worker):
+    from core.warmup import warmup
+    warmup()
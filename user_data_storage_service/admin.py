@@ -1,11 +1,23 @@
+import io
+import marshal
+import pstats
 from django import forms
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.contrib.auth.password_validation import validate_password
 from django.forms import TextInput, Textarea
-from django.utils.safestring import mark_safe
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
 from .models import *
+from .pagination import EstimatedCountPaginator
+from .profiling import make_token
+from .signals import delete_users
+from .thumbnails import thumbnail_url
 
 
 class UserCreationForm(forms.ModelForm):
@@ -54,6 +66,61 @@ class UserChangeForm(forms.ModelForm):
         return self.initial["password"]
 
 
+class UsersChangeList(ChangeList):
+    """Changelist of a large users table. In the default order (by the unique email) the pages are read by keyset,
+    `?after=` (`?before=`) the email of the last (first) row of the page, so a deep page costs the same as the first
+    one. The long `additional_info` is not read"""
+
+    after_var = 'after'
+    before_var = 'before'
+
+    def __init__(self, request, *args, **kwargs):
+        self.after = request.GET.get(self.after_var)
+        self.before = request.GET.get(self.before_var)
+        super().__init__(request, *args, **kwargs)
+
+    def get_queryset(self, request):
+        # Like the page number, the cursor is only a part of the Previous/Next links, not of the links of the filters,
+        # the sorting and the search
+        self.params.pop(self.after_var, None)
+        self.params.pop(self.before_var, None)
+        return super().get_queryset(request).defer('additional_info')
+
+    def get_results(self, request):
+        """Same as `ChangeList.get_results`, but a keyset page is read by itself, the paginator gives only the
+        estimated count"""
+        self.previous_url = self.next_url = None
+        self.keyset = ORDER_VAR not in self.params and self.page_num == 1 and not self.show_all
+        if not self.keyset:
+            return super().get_results(request)
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.full_result_count = self.root_queryset.count() if self.show_full_result_count else None
+        # As in `ChangeList.get_results`, without the full count the actions are shown
+        self.show_admin_actions = not self.show_full_result_count or bool(self.full_result_count)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+
+        size = self.list_per_page
+        if self.before is not None:
+            rows = list(self.queryset.filter(email__lt=self.before).reverse()[:size + 1])
+            has_previous, has_next = len(rows) > size, True
+            rows = rows[:size][::-1]
+        else:
+            queryset = self.queryset if self.after is None else self.queryset.filter(email__gt=self.after)
+            rows = list(queryset[:size + 1])
+            has_previous, has_next = self.after is not None, len(rows) > size
+            rows = rows[:size]
+
+        self.result_list = rows
+        if rows and has_previous:
+            self.previous_url = self.get_query_string({self.before_var: rows[0].email})
+        if rows and has_next:
+            self.next_url = self.get_query_string({self.after_var: rows[-1].email})
+
+
 class MyUserAdmin(UserAdmin):
     # The forms to add and change user instances
     form = UserChangeForm
@@ -88,18 +155,117 @@ class MyUserAdmin(UserAdmin):
             'fields': ('email', 'first_name', 'password1', 'password2')}
         ),
     )
-    search_fields = ('email', 'first_name')
-    ordering = ('email', 'first_name')
+    # icontains over these columns uses the trigram indexes on PostgreSQL (see `models.SearchIndex`)
+    search_fields = ('email', 'first_name', 'last_name', 'other_name', 'city')
+    # Large tables are not counted on every page view, see `counts.estimate_count`
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # The email is unique, the order is total without a second column and is given by its index. The filters are
+    # backed by the (flag, email) indexes
+    ordering = ('email',)
     filter_horizontal = ()
 
+    def get_changelist(self, request, **kwargs):
+        return UsersChangeList
+
+    def delete_queryset(self, request, queryset):
+        """The tombstones and outbox events of the selected users are saved in bulk"""
+        delete_users(queryset)
+
     def get_photo(self, obj):
         if obj.photo and hasattr(obj.photo, 'url'):
-            return mark_safe(f'<img src={obj.photo.url} width="100" height="85"')
-        else:
-            return mark_safe(f'<img src="#"')
+            return format_html('<img src="{}" width="100" height="85" loading="lazy">',
+                               thumbnail_url(obj.photo, settings.USER_PHOTO_ADMIN_THUMBNAIL_SIZE))
+        # Not an empty <img>, its URL would be the changelist itself
+        return self.get_empty_value_display()
 
     get_photo.short_description = 'Photo'
 
 
 admin.site.register(MyUser, MyUserAdmin)
 
+
+class ProfilingRuleAdmin(admin.ModelAdmin):
+    list_display = ('view', 'sample_rate', 'expires_at')
+    readonly_fields = ('profiling_header',)
+
+    def profiling_header(self, obj):
+        if not obj.pk:
+            return '-'
+        return format_html('<code>X-Profile: {}</code><p class="help">Profiles a single request to the view, '
+                           'valid for {} seconds</p>', make_token(obj.view), settings.PROFILING_TOKEN_MAX_AGE)
+
+    profiling_header.short_description = 'Header'
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('view', 'path', 'duration_ms', 'created_at', 'downloads')
+    list_filter = ('view',)
+    fields = ('view', 'path', 'duration_ms', 'created_at', 'downloads', 'report')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/pstats/', self.admin_site.admin_view(self.download_stats),
+                 name='user_data_storage_service_requestprofile_pstats'),
+            path('<int:pk>/stacks/', self.admin_site.admin_view(self.download_stacks),
+                 name='user_data_storage_service_requestprofile_stacks'),
+        ] + super().get_urls()
+
+    def download_stats(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="profile-{pk}.pstats"'
+        return response
+
+    def download_stacks(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(profile.stacks, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{pk}.folded"'
+        return response
+
+    def duration_ms(self, obj):
+        return round(obj.duration * 1000, 1)
+
+    duration_ms.short_description = 'Duration, ms'
+
+    def downloads(self, obj):
+        return format_html('<a href="{}">pstats</a> | <a href="{}">flamegraph stacks</a>',
+                           reverse('admin:user_data_storage_service_requestprofile_pstats', args=[obj.pk]),
+                           reverse('admin:user_data_storage_service_requestprofile_stacks', args=[obj.pk]))
+
+    downloads.short_description = 'Download'
+
+    def report(self, obj):
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        stats.stats = marshal.loads(bytes(obj.stats))
+        stats.get_top_level_stats()
+        stats.sort_stats('cumulative').print_stats(40)
+        return format_html('<pre>{}</pre>', stream.getvalue())
+
+    report.short_description = 'Top functions'
+
+
+class OutboxEventAdmin(admin.ModelAdmin):
+    """Events not delivered yet, the failed attempts show a sink which is down"""
+    list_display = ('id', 'event_type', 'user_id', 'created_at', 'attempts')
+    list_filter = ('event_type',)
+    readonly_fields = ('event_type', 'user_id', 'payload', 'created_at', 'attempts')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(ProfilingRule, ProfilingRuleAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
+admin.site.register(OutboxEvent, OutboxEventAdmin)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class UserDataStorageServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user_data_storage_service'
+
+    def ready(self):
+        from . import signals  # noqa: F401
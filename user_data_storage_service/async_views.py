@@ -0,0 +1,87 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+from rest_framework.views import APIView
+from . import profiling
+
+# Blocking ORM work of the async views is run here instead of the single thread used by `sync_to_async` by default,
+# every thread of the pool keeps its own database connection
+db_executor = ThreadPoolExecutor(max_workers=settings.DB_THREAD_POOL_SIZE, thread_name_prefix='db')
+
+
+def db_sync_to_async(func):
+    """Wraps a blocking function, so it is awaited from the event loop and run in the database thread pool"""
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        # Same as at the start of a regular request: drop broken connections and the ones older than CONN_MAX_AGE
+        close_old_connections()
+        session = profiling.current_session()
+        if session is not None:
+            return session.run(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    return sync_to_async(run, thread_sensitive=False, executor=db_executor)
+
+
+def warm_db_pool():
+    """Starts the threads of the database pool and opens their connections"""
+    futures = [db_executor.submit(connection.ensure_connection) for _ in range(settings.DB_THREAD_POOL_SIZE)]
+    for future in futures:
+        future.result()
+
+
+class AsyncAPIView(APIView):
+    """APIView whose handlers may be coroutines. Under ASGI the request is handled in the event loop, blocking
+    parts (authentication, permissions, ORM) are moved to the database pool"""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(*args, **kwargs):
+            return await view(*args, **kwargs)
+
+        # Keep `cls`, `initkwargs` and `csrf_exempt`, they are used by the URL resolver, CSRF middleware and drf_yasg
+        return functools.update_wrapper(async_view, view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        """Profiles the request when it is asked for (see `profiling.py`)"""
+        view = f'{self.__class__.__name__}.{request.method.lower()}'
+        profiling.rules.start()
+        if not profiling.should_profile(request, view):
+            return await self.handle(request, *args, **kwargs)
+
+        with profiling.profile_session(view, request.get_full_path()) as session:
+            response = await self.handle(request, *args, **kwargs)
+        await db_sync_to_async(session.save)()
+        return response
+
+    async def handle(self, request, *args, **kwargs):
+        """Same as `APIView.dispatch`, but awaits the handler and runs the `initial` checks in the database pool"""
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await db_sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
@@ -0,0 +1,85 @@
+import datetime
+import time
+import jwt
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
+from django.utils.crypto import constant_time_compare
+from rest_framework import authentication
+from rest_framework.exceptions import AuthenticationFailed
+from .cache import user_cache
+from .models import MyUser
+from .utils import LRUCache
+
+# Decoded claims keyed by the encoded token, entries are dropped once the token expires
+claims_cache = LRUCache(maxsize=settings.JWT_CLAIMS_CACHE_SIZE)
+
+
+def encode_token(user):
+    """Returns a signed token for the user, which is set to Cookies after login"""
+    now = datetime.datetime.utcnow()
+    payload = {
+        'id': user.id,
+        'exp': now + settings.JWT_LIFETIME,
+        'iat': now
+    }
+    return jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+
+def decode_token(token):
+    """Validates the token signature and expiration once, then serves the claims from the cache until `exp`"""
+    claims = claims_cache.get(token)
+    if claims is not None:
+        if claims['exp'] > time.time():
+            return claims
+        claims_cache.pop(token)
+
+    try:
+        claims = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationFailed('Token has expired')
+    except jwt.InvalidTokenError:
+        raise AuthenticationFailed('Invalid token')
+
+    if 'id' not in claims or 'exp' not in claims:
+        raise AuthenticationFailed('Invalid token')
+    claims_cache.set(token, claims)
+    return claims
+
+
+class JWTAuthentication(authentication.BaseAuthentication):
+    """Authentication by the token from `jwt` Cookies. The user is loaded with at most one query per request.
+
+    The token is not stateless: it is bound to the session of its login, which is loaded on every request (from the
+    memory of the worker, or with one more query, see `sessions.py`). Logout and a password change revoke it, and a
+    request without the `sessionid` Cookie is not authenticated"""
+
+    def authenticate(self, request):
+        token = request.COOKIES.get(settings.JWT_COOKIE_NAME)
+        if not token:
+            return None
+
+        claims = decode_token(token)
+        session = request._request.session
+        if session.get(SESSION_KEY) != str(claims['id']):
+            raise AuthenticationFailed('Session has ended')
+
+        try:
+            user = user_cache.get_user(claims['id'])
+        except MyUser.DoesNotExist:
+            raise AuthenticationFailed('User not found')
+
+        if not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted')
+
+        if not constant_time_compare(session.get(HASH_SESSION_KEY, ''), user.get_session_auth_hash()):
+            raise AuthenticationFailed('Session has ended')
+
+        # Token is sent by the browser automatically like a session cookie, so the same CSRF rules are applied
+        self.enforce_csrf(request)
+        return user, token
+
+    def enforce_csrf(self, request):
+        authentication.SessionAuthentication().enforce_csrf(request)
+
+    def authenticate_header(self, request):
+        return 'JWT realm="api"'
@@ -0,0 +1,195 @@
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.validators import UniqueValidator
+from .cache import user_cache
+from .models import MyUser
+from .outbox import USER_CREATED, USER_UPDATED, record_events
+from .serializers import PrivateCreateUserSerializer, UpdateUserSerializer
+from .signals import delete_users
+
+CREATE, UPDATE, DELETE = 'create', 'update', 'delete'
+
+
+def without_unique_validators(serializer):
+    """The uniqueness of the emails is checked for the whole batch with one query instead of one per operation.
+    Returns the message of the removed validator"""
+    field = serializer.fields.get('email')
+    if field is None:
+        return None
+    validators = [validator for validator in field.validators if isinstance(validator, UniqueValidator)]
+    field.validators = [validator for validator in field.validators if validator not in validators]
+    return validators[0].message if validators else None
+
+
+class UserBatch:
+    """Operations of `/private/users/batch/` applied in one transaction: the deletes by one delete of `id IN (...)`,
+    the updates by one bulk_update, the creates by one bulk_create (the tombstones and outbox events of all of them
+    by one bulk_create each). The data of the operations is validated by the serializers of the single user views.
+    Nothing is applied when any operation is invalid.
+
+    `results` has an item for every operation, in their order: the status code, the id of the user and the data
+    (or the errors) as the single user views give them"""
+
+    def __init__(self, operations):
+        self.operations = operations
+        self.results = [None] * len(operations)
+        self.failed = False
+        self.status_code = status.HTTP_200_OK
+
+    def fail(self, index, status_code, errors):
+        self.failed = True
+        self.status_code = status.HTTP_400_BAD_REQUEST
+        self.results[index] = {'status': status_code, 'id': self.operations[index].get('id'), 'errors': errors}
+
+    def apply(self):
+        """Returns whether the batch has been applied"""
+        self.prepare_creates()
+        try:
+            with transaction.atomic():
+                ids = [operation['id'] for operation in self.operations if operation['op'] != CREATE]
+                users = MyUser.objects.select_for_update().in_bulk(ids) if ids else {}
+                validated = self.validate(users)
+                if self.failed:
+                    self.skip_valid()
+                    return False
+                self.delete([index for index, operation in enumerate(self.operations)
+                             if operation['op'] == DELETE and operation['id'] in users])
+                self.update([(index, serializer) for index, serializer in validated
+                             if self.operations[index]['op'] == UPDATE])
+                self.create([(index, serializer) for index, serializer in validated
+                             if self.operations[index]['op'] == CREATE])
+                self.invalidate_cache()
+        except IntegrityError:
+            # E.g. two users swapping their emails, the constraint may be checked before the whole update is done
+            self.failed = True
+            self.status_code = status.HTTP_409_CONFLICT
+            self.results = [{'status': status.HTTP_409_CONFLICT, 'id': operation.get('id'),
+                             'errors': {'detail': 'The batch conflicts with the data in the database.'}}
+                            for operation in self.operations]
+            return False
+        return True
+
+    def invalidate_cache(self):
+        """Bulk changes send no signals, the cache is invalidated like `signals.invalidate_user_cache` does"""
+        changed = [result['id'] for result in self.results
+                   if result['status'] in (status.HTTP_200_OK, status.HTTP_204_NO_CONTENT)]
+        user_cache.invalidate_many(changed)
+        transaction.on_commit(lambda: user_cache.invalidate_many(changed))
+
+    def prepare_creates(self):
+        """The creates don't depend on the locked users, they are validated and their passwords are hashed before
+        the transaction"""
+        self.creates = {}
+        for index, operation in enumerate(self.operations):
+            if operation['op'] == CREATE:
+                serializer = PrivateCreateUserSerializer(data=operation['data'])
+                self.creates[index] = serializer, without_unique_validators(serializer)
+        serializers = [serializer for serializer, message in self.creates.values()]
+        if all(serializer.is_valid() for serializer in serializers):
+            for serializer in serializers:
+                serializer.validated_data['password'] = make_password(serializer.validated_data.get('password'))
+
+    def validate(self, users):
+        """Returns (index, serializer) of the valid creates and updates"""
+        validated, messages, seen = [], {}, set()
+        for index, operation in enumerate(self.operations):
+            op, pk = operation['op'], operation.get('id')
+            if pk is not None:
+                if pk in seen:
+                    self.fail(index, status.HTTP_400_BAD_REQUEST,
+                              {'id': ['The user is changed by another operation of the batch.']})
+                    continue
+                seen.add(pk)
+
+            if op == DELETE:
+                if pk not in users:
+                    # Deletes are idempotent, the user deleted before doesn't fail the batch
+                    self.results[index] = {'status': status.HTTP_404_NOT_FOUND, 'id': pk}
+                continue
+            if op == UPDATE:
+                if pk not in users:
+                    self.fail(index, status.HTTP_404_NOT_FOUND, {'detail': 'Not found.'})
+                    continue
+                serializer = UpdateUserSerializer(users[pk], data=operation['data'], partial=True)
+                messages[index] = without_unique_validators(serializer)
+            else:
+                serializer, messages[index] = self.creates[index]
+            if serializer.is_valid():
+                validated.append((index, serializer))
+            else:
+                self.fail(index, status.HTTP_400_BAD_REQUEST, serializer.errors)
+
+        self.check_emails(validated, messages, users)
+        return validated
+
+    def check_emails(self, validated, messages, users):
+        emails = {}
+        for index, serializer in validated:
+            email = serializer.validated_data.get('email')
+            if email is None:
+                continue
+            if email in emails:
+                self.fail(index, status.HTTP_400_BAD_REQUEST, {'email': [messages[index]]})
+            else:
+                emails[email] = index
+        if not emails:
+            return
+
+        # The emails of the deleted users and the changed emails of the updated ones are free
+        freed = {operation['id'] for operation in self.operations
+                 if operation['op'] == DELETE and operation['id'] in users}
+        freed.update(serializer.instance.pk for index, serializer in validated if serializer.instance is not None and
+                     serializer.validated_data.get('email', serializer.instance.email) != serializer.instance.email)
+        for email, pk in MyUser.objects.filter(email__in=list(emails)).values_list('email', 'id'):
+            index = emails[email]
+            if pk not in freed and pk != self.operations[index].get('id'):
+                self.fail(index, status.HTTP_400_BAD_REQUEST, {'email': [messages[index]]})
+
+    def skip_valid(self):
+        for index, operation in enumerate(self.operations):
+            if self.results[index] is None:
+                self.results[index] = {'status': status.HTTP_424_FAILED_DEPENDENCY, 'id': operation.get('id'),
+                                       'errors': {'detail': 'Not applied, other operations of the batch are invalid.'}}
+
+    def delete(self, indexes):
+        if not indexes:
+            return
+        delete_users(MyUser.objects.filter(id__in=[self.operations[index]['id'] for index in indexes]))
+        for index in indexes:
+            self.results[index] = {'status': status.HTTP_204_NO_CONTENT, 'id': self.operations[index]['id']}
+
+    def update(self, items):
+        if not items:
+            return
+        now = timezone.now()
+        fields = {'updated_at'}
+        for index, serializer in items:
+            user = serializer.instance
+            for name, value in serializer.validated_data.items():
+                setattr(user, name, value)
+            # bulk_update doesn't call save(), so auto_now is not applied
+            user.updated_at = now
+            fields.update(serializer.validated_data)
+        MyUser.objects.bulk_update([serializer.instance for index, serializer in items], sorted(fields))
+        record_events(USER_UPDATED, [serializer.instance for index, serializer in items])
+        for index, serializer in items:
+            self.results[index] = {'status': status.HTTP_200_OK, 'id': serializer.instance.pk,
+                                   'data': serializer.data}
+
+    def create(self, items):
+        if not items:
+            return
+        # The passwords are hashed by `prepare_creates`
+        users = [MyUser(**serializer.validated_data) for index, serializer in items]
+        MyUser.objects.bulk_create(users)
+        if any(user.pk is None for user in users):
+            # The database returns no ids from the bulk insert (SQLite with Django 3.2)
+            ids = dict(MyUser.objects.filter(email__in=[user.email for user in users]).values_list('email', 'id'))
+            for user in users:
+                user.pk = ids[user.email]
+        record_events(USER_CREATED, users)
+        for (index, serializer), user in zip(items, users):
+            serializer.instance = user
+            self.results[index] = {'status': status.HTTP_201_CREATED, 'id': user.pk, 'data': serializer.data}
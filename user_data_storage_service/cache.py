@@ -0,0 +1,152 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .models import MyUser
+from .utils import LRUCache
+
+
+def is_primary(instance):
+    return instance._state.db == 'default'
+
+
+class UserCache:
+    """Cache of users and their serialized payloads, invalidated by the MyUser signals (see `signals.py`).
+
+    The first level is an in-process LRU. Invalidation reaches only the process which changed the user, so its
+    entries live no longer than USER_CACHE_LOCAL_TTL seconds. The second level is the Django cache USER_CACHE_BACKEND
+    shared by all the workers, it is skipped when the setting is empty.
+
+    Only the users read from the primary are cached. A replica may still have the data of before a change, which
+    would stay in the cache after the invalidation"""
+
+    USER = 'user'
+    # Columns left out of the cached users: the authentication of every request and the current user don't read them.
+    # The payloads which have them load them on a miss, see `serialize`
+    USER_DEFERRED_FIELDS = ('additional_info',)
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=settings.USER_CACHE_LOCAL_SIZE)
+        self.kinds = {self.USER}
+        self.counters = {'local_hits': 0, 'backend_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return caches[settings.USER_CACHE_BACKEND] if settings.USER_CACHE_BACKEND else None
+
+    def register(self, *serializer_classes):
+        """Payloads of the registered serializers are dropped when the user changes"""
+        self.kinds.update(serializer_class.__name__ for serializer_class in serializer_classes)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    @staticmethod
+    def make_key(kind, pk):
+        return f'user:{kind}:{pk}'
+
+    def get_many(self, kind, pks):
+        keys = {self.make_key(kind, pk): pk for pk in pks}
+        found, missing = {}, []
+        now = time.monotonic()
+        for key, pk in keys.items():
+            entry = self.local.get(key)
+            if entry is not None and entry[0] > now:
+                found[pk] = entry[1]
+            else:
+                missing.append(key)
+        self.count('local_hits', len(found))
+
+        backend = self.backend
+        if missing and backend is not None:
+            for key, value in backend.get_many(missing).items():
+                found[keys[key]] = value
+                self.local.set(key, (now + settings.USER_CACHE_LOCAL_TTL, value))
+            self.count('backend_hits', len(found) - (len(keys) - len(missing)))
+
+        self.count('misses', len(keys) - len(found))
+        return found
+
+    def get(self, kind, pk):
+        return self.get_many(kind, [pk]).get(pk)
+
+    def set_many(self, kind, values):
+        expires = time.monotonic() + settings.USER_CACHE_LOCAL_TTL
+        data = {self.make_key(kind, pk): value for pk, value in values.items()}
+        for key, value in data.items():
+            self.local.set(key, (expires, value))
+        if self.backend is not None:
+            self.backend.set_many(data, timeout=settings.USER_CACHE_TIMEOUT)
+
+    def set(self, kind, pk, value):
+        self.set_many(kind, {pk: value})
+
+    def invalidate(self, pk):
+        self.invalidate_many([pk])
+
+    def invalidate_many(self, pks):
+        """For the bulk changes, which send no signals"""
+        keys = [self.make_key(kind, pk) for pk in pks for kind in self.kinds]
+        for key in keys:
+            self.local.pop(key)
+        if self.backend is not None:
+            self.backend.delete_many(keys)
+
+    def get_user(self, pk):
+        """Returns a new instance on every call, so the cached one is never changed by a request. The
+        USER_DEFERRED_FIELDS are deferred. Raises MyUser.DoesNotExist"""
+        fields = [field for field in MyUser._meta.concrete_fields if field.name not in self.USER_DEFERRED_FIELDS]
+        field_names = [field.attname for field in fields]
+        values = self.get(self.USER, pk)
+        if values is None:
+            user = MyUser.objects.defer(*self.USER_DEFERRED_FIELDS).get(pk=pk)
+            if is_primary(user):
+                self.set(self.USER, pk, tuple(field.get_prep_value(getattr(user, field.attname)) for field in fields))
+            return user
+        return MyUser.from_db('default', field_names, values)
+
+    def serialize(self, serializer_class, instance):
+        """The deferred fields of `instance` the serializer reads are loaded only when the payload is not cached"""
+        data = self.get(serializer_class.__name__, instance.pk)
+        if data is None:
+            data = dict(serializer_class(instance).data)
+            if is_primary(instance):
+                self.set(serializer_class.__name__, instance.pk, data)
+        return data
+
+    def serialize_pks(self, serializer_class, pks, queryset):
+        """Payloads of the users by pk, the missing ones are read from `queryset` with one IN query.
+        The users which don't exist are absent from the result"""
+        kind = serializer_class.__name__
+        found = self.get_many(kind, pks)
+        missing = [pk for pk in pks if pk not in found]
+        if missing:
+            instances = list(queryset.filter(pk__in=missing))
+            loaded = {instance.pk: dict(serializer_class(instance).data) for instance in instances}
+            primary = {instance.pk: loaded[instance.pk] for instance in instances if is_primary(instance)}
+            if primary:
+                self.set_many(kind, primary)
+            found.update(loaded)
+        return found
+
+    def serialize_many(self, serializer_class, instances):
+        """Serializes only the instances which payloads are not cached, keeping the order"""
+        kind = serializer_class.__name__
+        cached = self.get_many(kind, [instance.pk for instance in instances])
+        missing = {instance.pk: dict(serializer_class(instance).data)
+                   for instance in instances if instance.pk not in cached}
+        primary = {instance.pk: missing[instance.pk] for instance in instances
+                   if instance.pk in missing and is_primary(instance)}
+        if primary:
+            self.set_many(kind, primary)
+        cached.update(missing)
+        return [cached[instance.pk] for instance in instances]
+
+
+user_cache = UserCache()
@@ -0,0 +1,88 @@
+import base64
+import binascii
+import datetime
+from collections import namedtuple
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from .cache import user_cache
+from .models import DeletedUser, MyUser
+from .serializers import PrivateUserDetailSerializer
+
+# Kinds of the changes, at the same time the users come before the tombstones
+CHANGED, DELETED = 0, 1
+
+Position = namedtuple('Position', ['time', 'kind', 'id'])
+
+
+def encode_cursor(position):
+    value = f'{position.time.isoformat()}|{position.kind}|{position.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        time, kind, pk = value.split('|')
+        position = Position(datetime.datetime.fromisoformat(time), int(kind), int(pk))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError({'since': ['Invalid cursor.']})
+    if position.kind not in (CHANGED, DELETED) or timezone.is_naive(position.time):
+        raise ValidationError({'since': ['Invalid cursor.']})
+    return position
+
+
+def after(queryset, time_field, kind, position):
+    """Rows of one kind which come after the position in the (time, kind, id) order. The range starts on the time,
+    so the (time, id) index of the table is used"""
+    if position is None:
+        return queryset
+    if kind < position.kind:
+        return queryset.filter(**{f'{time_field}__gt': position.time})
+    queryset = queryset.filter(**{f'{time_field}__gte': position.time})
+    if kind == position.kind:
+        queryset = queryset.exclude(**{time_field: position.time, 'id__lte': position.id})
+    return queryset
+
+
+class UserChanges:
+    """Users changed (created or updated) and deleted after the cursor, in the order of (time, kind, id): the time is
+    `MyUser.updated_at` or `DeletedUser.deleted_at`. A page is read with two range queries on the (time, id) indexes,
+    so a sync costs the number of changes, not the size of the table.
+
+    Changes of the last USERS_CHANGES_DELAY seconds are not given out yet: the time is set when the row is saved,
+    not when the transaction is committed, so a later cursor could pass over a change committed late"""
+
+    def __init__(self, since=None, limit=None):
+        self.position = decode_cursor(since) if since else None
+        self.limit = limit or settings.USERS_CHANGES_PAGE_SIZE
+
+    def get_page(self):
+        """Returns (changes, cursor of the next page, whether there are more changes)"""
+        horizon = timezone.now() - datetime.timedelta(seconds=settings.USERS_CHANGES_DELAY)
+        users = list(after(MyUser.objects.filter(updated_at__lte=horizon), 'updated_at', CHANGED, self.position)
+                     .order_by('updated_at', 'id')[:self.limit + 1])
+        tombstones = list(after(DeletedUser.objects.filter(deleted_at__lte=horizon), 'deleted_at', DELETED,
+                                self.position).order_by('deleted_at', 'id').values_list('deleted_at', 'id', 'user_id')
+                          [:self.limit + 1])
+
+        rows = sorted([(Position(user.updated_at, CHANGED, user.pk), user) for user in users] +
+                      [(Position(deleted_at, DELETED, pk), user_id) for deleted_at, pk, user_id in tombstones],
+                      key=lambda row: row[0])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+
+        payloads = iter(user_cache.serialize_many(PrivateUserDetailSerializer,
+                                                  [row for position, row in rows if position.kind == CHANGED]))
+        changes = []
+        for position, row in rows:
+            if position.kind == CHANGED:
+                # The user joined after the previous sync, for the clients which create and update differently
+                created = self.position is None or row.data_joined > self.position.time
+                changes.append({'op': 'create' if created else 'update', 'id': row.pk, 'changed_at': position.time,
+                                'data': next(payloads)})
+            else:
+                changes.append({'op': 'delete', 'id': row, 'changed_at': position.time})
+
+        position = rows[-1][0] if rows else self.position
+        return changes, encode_cursor(position) if position else None, has_more
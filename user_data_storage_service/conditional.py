@@ -0,0 +1,58 @@
+import hashlib
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The user has been changed since it was read.'
+    default_code = 'precondition_failed'
+
+
+def version(pk, updated_at):
+    return f'{pk}-{int(updated_at.timestamp()) * 1000000 + updated_at.microsecond}'
+
+
+def user_etag(user):
+    """Strong ETag of the user, it changes on every save of the user (see `MyUser.updated_at`)"""
+    return f'"{version(user.pk, user.updated_at)}"'
+
+
+def page_etag(versions, *extra):
+    """ETag of a page of users by their (pk, updated_at), it changes when any user of the page is changed,
+    added to or removed from the page, or any of the `extra` values of the page (links, count) changes"""
+    digest = hashlib.md5()
+    for pk, updated_at in versions:
+        digest.update(f'{version(pk, updated_at)}\n'.encode())
+    for value in extra:
+        digest.update(f'{value}\n'.encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def not_modified(request, etag, last_modified=None):
+    """Returns the 304 (or 412) response when the client's copy is up to date, so the body is not built at all"""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def check_if_match(request, user):
+    """Optimistic concurrency: the change is rejected when the client has not seen the last version of the user"""
+    if_match = request.META.get('HTTP_IF_MATCH')
+    if if_match is None:
+        return
+    # ETags of the compressed responses are weak, see `middleware.CompressionMiddleware`
+    etags = [etag[2:] if etag.startswith('W/') else etag for etag in parse_etags(if_match)]
+    if etags != ['*'] and user_etag(user) not in etags:
+        raise PreconditionFailed
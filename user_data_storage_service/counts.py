@@ -0,0 +1,88 @@
+import contextvars
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections
+from .async_views import db_executor
+from .utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class CountCache:
+    """Counts of querysets by their SQL. A stale count is served while it is refreshed in the database pool,
+    so only the first request for a query waits for the COUNT(*)"""
+
+    def __init__(self):
+        self.counts = LRUCache(maxsize=settings.COUNT_CACHE_SIZE)
+        self.refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(queryset):
+        sql, params = queryset.order_by().query.sql_with_params()
+        return queryset.db, sql, tuple(params)
+
+    def get(self, queryset):
+        """Returns the count and whether it has just been counted"""
+        key = self.make_key(queryset)
+        entry = self.counts.get(key)
+        if entry is None:
+            return self.refresh(key, queryset), True
+        count, counted_at = entry
+        if time.monotonic() - counted_at >= settings.COUNT_CACHE_TTL:
+            with self._lock:
+                if key in self.refreshing:
+                    return count, False
+                self.refreshing.add(key)
+            # Empty context: the refresh is not a part of the current request (its routing, metrics, profile)
+            db_executor.submit(contextvars.Context().run, self.refresh_in_background, key, queryset)
+        return count, False
+
+    def refresh(self, key, queryset):
+        count = queryset.count()
+        self.counts.set(key, (count, time.monotonic()))
+        return count
+
+    def refresh_in_background(self, key, queryset):
+        close_old_connections()
+        try:
+            self.refresh(key, queryset.all())
+        except DatabaseError:
+            logger.exception('Count is not refreshed')
+        finally:
+            with self._lock:
+                self.refreshing.discard(key)
+
+
+count_cache = CountCache()
+
+
+def table_estimate(queryset):
+    """Number of rows of the table from the PostgreSQL statistics, None when it is unknown"""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                       [connection.ops.quote_name(queryset.model._meta.db_table)])
+        row = cursor.fetchone()
+    # -1 while the table has not been analyzed yet
+    return row[0] if row and row[0] >= 0 else None
+
+
+def estimate_count(queryset, exact=False):
+    """Returns the count of the queryset and whether it is exact. An unfiltered table is estimated by the PostgreSQL
+    statistics, a filtered queryset by the cached count. Counts below COUNT_EXACT_THRESHOLD are always exact"""
+    if not exact:
+        estimate = None
+        if not queryset.query.where:
+            estimate = table_estimate(queryset)
+        if estimate is None:
+            estimate, counted = count_cache.get(queryset)
+            if counted:
+                return estimate, True
+        if estimate >= settings.COUNT_EXACT_THRESHOLD:
+            return estimate, False
+    return queryset.count(), True
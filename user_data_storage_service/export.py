@@ -0,0 +1,110 @@
+import contextvars
+import csv
+import io
+import queue
+import threading
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from .models import MyUser
+from .renderers import dumps, orjson
+
+EXPORT_FIELDS = ['id', 'first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday', 'city',
+                 'additional_info', 'is_admin', 'is_active', 'data_joined']
+EXPORT_DEFAULT_FIELDS = ['id', 'first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday', 'city',
+                         'additional_info', 'is_admin']
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+_done = object()
+
+
+def iterate_users(fields):
+    """Yields lists of row tuples with only the requested columns, read through a server-side cursor"""
+    chunk_size = settings.USERS_EXPORT_CHUNK_SIZE
+    rows = MyUser.objects.order_by('id').values_list(*fields).iterator(chunk_size=chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_ndjson(fields, chunks):
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    if orjson is not None:
+        for chunk in chunks:
+            yield b''.join(dumps(dict(zip(fields, row)), encoder.default, newline=True) for row in chunk)
+        return
+    for chunk in chunks:
+        yield ''.join(encoder.encode(dict(zip(fields, row))) + '\n' for row in chunk).encode()
+
+
+def encode_csv(fields, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    yield buffer.getvalue().encode()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+
+
+def produce_in_thread(iterator_factory, maxsize):
+    """Runs the iterator in a separate thread and yields its items through a bounded queue.
+
+    The parts of a streaming response are taken in the threads of the ASGI handler (see `core.handlers`), one by one
+    and not always in the same thread, while a database cursor must stay in the thread which opened it. So the
+    cursor is read in its own thread, the queue keeps memory flat when the client reads slowly.
+    The thread runs in the context of the caller, so the database routing of the request applies to it."""
+    context = contextvars.copy_context()
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterator_factory():
+                if not put(item):
+                    return
+            put(_done)
+        except BaseException as exc:
+            put(exc)
+        finally:
+            connections.close_all()
+
+    def consume():
+        threading.Thread(target=context.run, args=(run,), name='users-export', daemon=True).start()
+        try:
+            while True:
+                item = items.get()
+                if item is _done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    return consume()
+
+
+def stream_users(fields, file_format):
+    """Returns an iterator of encoded chunks of the users export"""
+    encode = encode_csv if file_format == 'csv' else encode_ndjson
+    return produce_in_thread(lambda: encode(fields, iterate_users(fields)), maxsize=settings.USERS_EXPORT_QUEUE_SIZE)
@@ -0,0 +1,59 @@
+import operator
+from functools import reduce
+from django.db import connections
+from django.db.models import Q
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.filters import BaseFilterBackend
+from .serializers import UsersFilterSerializer
+
+SEARCH_FIELDS = ('first_name', 'last_name', 'other_name', 'email', 'city')
+
+
+def search_lookup(vendor):
+    """PostgreSQL finds substrings with the trigram indexes on UPPER(column). SQLite has no trigram indexes, there
+    the search falls back to prefixes, which are looked up with the NOCASE indexes (see `models.SearchIndex`)"""
+    return 'istartswith' if vendor == 'sqlite' else 'icontains'
+
+
+class UsersFilterBackend(BaseFilterBackend):
+    """Search and filtering of users lists by the query parameters"""
+
+    def filter_queryset(self, request, queryset, view):
+        serializer = UsersFilterSerializer(data=request.query_params.dict())
+        serializer.is_valid(raise_exception=True)
+        filters = serializer.validated_data
+
+        if filters.get('search'):
+            lookup = search_lookup(connections[queryset.db].vendor)
+            queryset = queryset.filter(reduce(operator.or_, (
+                Q(**{f'{field}__{lookup}': filters['search']}) for field in SEARCH_FIELDS
+            )))
+        if 'city' in filters:
+            queryset = queryset.filter(city=filters['city'])
+        if 'is_active' in filters:
+            queryset = queryset.filter(is_active=filters['is_active'])
+        if 'birthday_from' in filters:
+            queryset = queryset.filter(birthday__gte=filters['birthday_from'])
+        if 'birthday_to' in filters:
+            queryset = queryset.filter(birthday__lte=filters['birthday_to'])
+        if 'joined_after' in filters:
+            queryset = queryset.filter(data_joined__gt=filters['joined_after'])
+        return queryset
+
+    def get_schema_fields(self, view):
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return [
+            coreapi.Field(name='search', required=False, location='query', schema=coreschema.String(
+                description='Поиск по имени, фамилии, отчеству, email и городу')),
+            coreapi.Field(name='city', required=False, location='query', schema=coreschema.String(
+                description='Город')),
+            coreapi.Field(name='is_active', required=False, location='query', schema=coreschema.Boolean(
+                description='Активен ли пользователь')),
+            coreapi.Field(name='birthday_from', required=False, location='query', schema=coreschema.String(
+                description='Дата рождения не раньше, YYYY-MM-DD')),
+            coreapi.Field(name='birthday_to', required=False, location='query', schema=coreschema.String(
+                description='Дата рождения не позже, YYYY-MM-DD')),
+            coreapi.Field(name='joined_after', required=False, location='query', schema=coreschema.String(
+                description='Зарегистрирован после, ISO 8601')),
+        ]
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """Raised when all the workers are busy and the queue of the pool is full"""
+
+
+class HashLatency:
+    """Latency of the password hashing in the pool workers"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+hash_latency = HashLatency()
+
+
+def verify_password(password, encoded):
+    """Checks the password against the encoded hash in a pool worker. Returns whether the password is correct,
+    a new hash if the hasher parameters have changed since the hash was made, and the time spent"""
+    new_encoded = None
+
+    def setter(raw_password):
+        nonlocal new_encoded
+        new_encoded = make_password(raw_password)
+
+    started = time.perf_counter()
+    is_correct = check_password(password, encoded, setter)
+    return is_correct, new_encoded, time.perf_counter() - started
+
+
+class PasswordHasherPool:
+    """Bounded pool which moves CPU-bound password hashing out of the request handling. No more than
+    `workers + queue_size` jobs are accepted at once, the next ones are rejected with PoolSaturated"""
+
+    def __init__(self, executor, workers, queue_size):
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            hash_latency.reject()
+            raise PoolSaturated
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    async def verify(self, password, encoded):
+        """Returns whether the password is correct and a new hash if the stored one must be upgraded"""
+        is_correct, new_encoded, elapsed = await asyncio.wrap_future(self.submit(verify_password, password, encoded))
+        hash_latency.observe(elapsed)
+        logger.debug('Password verified in %.3f s', elapsed)
+        return is_correct, new_encoded
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_password_pool():
+    """Returns the pool of the current process, it is created on the first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PasswordHasherPool(settings.PASSWORD_HASHER_EXECUTOR, settings.PASSWORD_HASHER_WORKERS,
+                                           settings.PASSWORD_HASHER_QUEUE_SIZE)
+    return _pool
@@ -0,0 +1,55 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Set while the work of a request is measured. The context is copied to the threads running the ORM
+# (see `async_views.db_sync_to_async`), so the queries are counted whichever thread runs them
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_duration = 0.0
+        self.serializer_duration = 0.0
+
+
+@contextmanager
+def collect_request_stats():
+    """A nested collection (e.g. the middleware inside the benchmark) shares the stats of the outer one"""
+    stats = _request_stats.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+@contextmanager
+def measure_serialization():
+    stats = _request_stats.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serializer_duration += time.perf_counter() - started
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper installed on every database connection (see `signals.install_query_recorder`)"""
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_duration += time.perf_counter() - started
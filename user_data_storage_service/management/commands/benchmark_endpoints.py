@@ -0,0 +1,283 @@
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from collections import namedtuple
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, override_settings
+from django.urls import resolve, reverse
+from ... import urls
+from ...counts import count_cache
+from ...instrumentation import collect_request_stats
+from ...models import MyUser
+
+BENCHMARK_EMAIL = 'benchmark@example.com'
+BENCHMARK_PASSWORD = 'benchmark-password'
+# The routes read and change the users by ids up to this far from the middle one, the last users are deleted
+MIDDLE_SPAN = 350
+# Seconds the in-process caches keep their entries during the run
+CACHE_TTL = 24 * 3600
+
+# `path` and `data` are called with the benchmark state and the number of the request.
+# `max_queries` is the budget of SQL queries of one request, counted after the warm-up requests, or a function of the
+# benchmark state returning it. The budgets are those of SQLite, where BEGIN of a transaction is a query too.
+# The entries of the in-process caches don't expire during the run: a cached read makes a query once per
+# USER_CACHE_LOCAL_TTL or SESSION_LOCAL_TTL seconds, not per request. Login and logout write the session through
+# (see `sessions.py`), in transactions of their own. A change of a user saves its outbox event in
+# the same transaction (see `outbox.py`). The requests of a route with `login` are made by a client logged in just
+# before, not measured
+Route = namedtuple('Route', ['name', 'method', 'path', 'data', 'max_queries', 'requests', 'login'], defaults=[False])
+
+ROUTES = [
+    Route('login', 'post', lambda state, i: reverse('login'),
+          lambda state, i: {'email': BENCHMARK_EMAIL, 'password': BENCHMARK_PASSWORD}, 4, None),
+    # Logout ends the session, which the token is bound to
+    Route('logout', 'get', lambda state, i: reverse('logout'), None, 3, None, login=True),
+    Route('current_user', 'get', lambda state, i: reverse('current_user'), None, 1, None),
+    # The total of a table smaller than COUNT_EXACT_THRESHOLD is counted exactly, see `counts.estimate_count`
+    Route('users', 'get', lambda state, i: reverse('users') + '?limit=100', None,
+          lambda state: 1 + state['exact_count'], None),
+    # The total of a small result is counted exactly, see `counts.estimate_count`
+    Route('users_search', 'get', lambda state, i: reverse('users') + '?search=user1&city=Москва', None, 2, None),
+    Route('update_user', 'patch', lambda state, i: reverse('update_user', kwargs={'pk': state['user_id']}),
+          lambda state, i: {'phone': f'+7{i:010}'}, 5, None),
+    Route('private_users', 'get', lambda state, i: reverse('private_users') + '?limit=100&ordering=-data_joined',
+          None, lambda state: 1 + state['exact_count'], None),
+    Route('private_users_ids', 'get',
+          lambda state, i: reverse('private_users') + '?ids=' + ','.join(
+              str(state['middle_id'] + n * 7) for n in range(50)), None, 1, None),
+    # The id beyond the last user is reported missing, it is looked up in the database on every request
+    Route('private_users_lookup', 'post', lambda state, i: reverse('private_users_lookup'),
+          lambda state, i: {'ids': [state['middle_id'] + n * 3 for n in range(100)] + [state['last_id'] + 1000]},
+          1, None),
+    # The first page of a sync, the users and the tombstones are read by one query each
+    Route('private_users_changes', 'get', lambda state, i: reverse('private_users_changes') + '?limit=100', None, 2,
+          None),
+    Route('private_users_create', 'post', lambda state, i: reverse('private_users'),
+          lambda state, i: {'first_name': 'Created', 'email': f'created{state["run"]}-{i}@example.com'}, 4, None),
+    Route('private_users_export', 'get', lambda state, i: reverse('private_users_export') + '?fields=id,email',
+          None, 1, 3),
+    # 10 updates and 2 creates in one transaction, the creates hash their passwords
+    Route('private_users_batch', 'post', lambda state, i: reverse('private_users_batch'),
+          lambda state, i: {'operations': [
+              {'op': 'update', 'id': state['middle_id'] + n, 'data': {'other_name': f'Batch{i}'}} for n in range(1, 11)
+          ] + [
+              {'op': 'create', 'data': {'first_name': 'Batch', 'email': f'batch{state["run"]}-{i}-{n}@example.com',
+                                        'password': BENCHMARK_PASSWORD}} for n in range(2)
+          ]}, 9, 50),
+    Route('private_user', 'get', lambda state, i: reverse('private_user', kwargs={'pk': state['middle_id']}),
+          None, 1, None),
+    Route('private_user_update', 'patch',
+          lambda state, i: reverse('private_user', kwargs={'pk': state['middle_id']}),
+          lambda state, i: {'last_name': f'Updated{i}'}, 4, None),
+    Route('private_user_delete', 'delete',
+          lambda state, i: reverse('private_user', kwargs={'pk': state['last_id'] - i}), None, 8, None),
+]
+
+
+def percentile(timings, percent):
+    return statistics.quantiles(timings, n=100, method='inclusive')[percent - 1] if len(timings) > 1 else timings[0]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks every route of user_data_storage_service/urls.py on a test database seeded with synthetic ' \
+           'users: latency percentiles, throughput and the number of SQL queries. The database engine is the one ' \
+           'of DATABASE_URL (SQLite or PostgreSQL). Fails when a route exceeds its SQL queries budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000',
+                            help='Comma separated numbers of users, e.g. 10000,100000,1000000')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per route')
+        parser.add_argument('--warmup', type=int, default=5, help='Not measured requests per route')
+        parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at the same time')
+        parser.add_argument('--accept-encoding', default='',
+                            help='Accept-Encoding header of the requests, e.g. gzip, not compressed by default')
+        parser.add_argument('--routes', help='Comma separated names of the routes to run, all by default')
+        parser.add_argument('--output', help='File for the results in JSON, stdout by default')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the test database, so the users are not seeded again by the next run')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted(int(size) for size in options['sizes'].split(','))
+        except ValueError:
+            raise CommandError('--sizes must be comma separated integers')
+        min_size = 2 * (MIDDLE_SPAN + options['warmup'] + options['requests'])
+        if sizes[0] < min_size:
+            raise CommandError(f'--sizes must be at least {min_size} with --requests {options["requests"]} and '
+                               f'--warmup {options["warmup"]}, the routes change and delete the users by their ids')
+
+        routes = ROUTES
+        uncovered = {pattern.name for pattern in urls.urlpatterns} - {self.url_name(route) for route in ROUTES}
+        if uncovered:
+            raise CommandError(f'Routes without a benchmark: {", ".join(sorted(uncovered))}')
+        if options['routes']:
+            names = options['routes'].split(',')
+            routes = [route for route in ROUTES if route.name in names]
+
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # A file instead of the in-memory database, which locks whole tables when used by several threads
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'users_benchmark.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb'])
+        try:
+            # Reads are not routed to the replicas, they have no benchmark data. The seeded users are given out by
+            # the change feed at once. The changes save their outbox events, nobody delivers them
+            with override_settings(DATABASE_REPLICAS=[], USERS_CHANGES_DELAY=0, OUTBOX_SINKS=['file:///dev/null'],
+                                   USER_CACHE_LOCAL_TTL=CACHE_TTL, SESSION_LOCAL_TTL=CACHE_TTL):
+                results = {
+                    'database': connection.vendor,
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'concurrency': options['concurrency'],
+                    'accept_encoding': options['accept_encoding'],
+                    'sizes': {},
+                }
+                for run, size in enumerate(sizes):
+                    self.stderr.write(f'Seeding {size} users')
+                    state = self.seed(size)
+                    state['run'] = f'{run}-{int(time.time())}'
+                    results['sizes'][size] = asyncio.run(self.run_routes(routes, state, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        failures = [f'{size} users, {name}: {", ".join(route["failures"])}'
+                    for size, size_results in results['sizes'].items()
+                    for name, route in size_results.items() if route['failures']]
+        if failures:
+            raise CommandError('Benchmark failed:\n' + '\n'.join(failures))
+
+    @staticmethod
+    def url_name(route):
+        state = {'user_id': 1, 'middle_id': 1, 'last_id': 1, 'run': ''}
+        return resolve(route.path(state, 0).split('?')[0]).url_name
+
+    def seed(self, size):
+        """Adds users up to `size`. The deletes of the previous runs are made up for, so every run has `size` users"""
+        user = MyUser.objects.filter(email=BENCHMARK_EMAIL).first()
+        if user is None:
+            user = MyUser.objects.create_user(BENCHMARK_EMAIL, 'Benchmark', BENCHMARK_PASSWORD, is_admin=True)
+
+        password = make_password(BENCHMARK_PASSWORD)
+        cities = ['Москва', 'Санкт-Петербург', 'Казань', 'Омск', 'Новосибирск']
+        start = (MyUser.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        missing = size - MyUser.objects.count()
+        batch_size = 5000
+        numbers = iter(range(start, start + max(missing, 0)))
+        while True:
+            batch = list(itertools.islice(numbers, batch_size))
+            if not batch:
+                break
+            MyUser.objects.bulk_create([
+                MyUser(email=f'user{number}@example.com', first_name=f'User{number}', last_name=f'Last{number}',
+                       password=password, city=cities[number % len(cities)], additional_info='x' * 200)
+                for number in batch
+            ])
+            self.stderr.write(f'  {batch[-1]} users', ending='\r')
+
+        # The counts of the previous size are stale
+        count_cache.counts.clear()
+        last_id = MyUser.objects.order_by('-id').values_list('id', flat=True).first()
+        return {
+            'user_id': user.id,
+            'middle_id': MyUser.objects.order_by('id').values_list('id', flat=True)[size // 2],
+            'last_id': last_id,
+            'exact_count': MyUser.objects.count() < settings.COUNT_EXACT_THRESHOLD,
+        }
+
+    @staticmethod
+    async def login(client):
+        response = await client.post(reverse('login'), {'email': BENCHMARK_EMAIL, 'password': BENCHMARK_PASSWORD},
+                                     content_type='application/json')
+        return response.cookies[settings.JWT_COOKIE_NAME].value
+
+    async def run_routes(self, routes, state, options):
+        client = AsyncClient()
+        token = await self.login(client)
+
+        results = {}
+        for route in routes:
+            self.stderr.write(f'  {route.name}')
+            results[route.name] = await self.run_route(client, token, route, state, options)
+        return results
+
+    async def run_route(self, client, token, route, state, options):
+        requests = min(options['requests'], route.requests or options['requests'])
+        counter = itertools.count()
+        timings, queries, sizes, errors = [], [], [], []
+
+        async def request(measured):
+            i = next(counter)
+            request_client, request_token = client, token
+            if route.login:
+                request_client = AsyncClient()
+                request_token = await self.login(request_client)
+            request_client.cookies[settings.JWT_COOKIE_NAME] = request_token
+            kwargs = {'content_type': 'application/json'}
+            if options['accept_encoding']:
+                # Extra arguments of AsyncClient are the ASGI headers as they are
+                kwargs['accept-encoding'] = options['accept_encoding']
+            if route.data is not None:
+                kwargs['data'] = route.data(state, i)
+            with collect_request_stats() as stats:
+                started = time.perf_counter()
+                response = await getattr(request_client, route.method)(route.path(state, i), **kwargs)
+                if response.streaming:
+                    size = sum(len(chunk) for chunk in response.streaming_content)
+                else:
+                    size = len(response.content)
+                elapsed = time.perf_counter() - started
+            if not measured:
+                return
+            timings.append(elapsed)
+            queries.append(stats.queries)
+            sizes.append(size)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+        async def worker(count):
+            for _ in range(count):
+                await request(measured=True)
+
+        for _ in range(options['warmup']):
+            await request(measured=False)
+
+        concurrency = min(options['concurrency'], requests)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(requests // concurrency + (n < requests % concurrency))
+                               for n in range(concurrency)))
+        total = time.perf_counter() - started
+
+        budget = route.max_queries(state) if callable(route.max_queries) else route.max_queries
+        failures = []
+        if max(queries) > budget:
+            failures.append(f'{max(queries)} queries, the budget is {budget}')
+        if errors:
+            failures.append(f'{len(errors)} errors: {sorted(set(errors))}')
+        return {
+            'requests': requests,
+            'p50_ms': round(percentile(timings, 50) * 1000, 3),
+            'p95_ms': round(percentile(timings, 95) * 1000, 3),
+            'p99_ms': round(percentile(timings, 99) * 1000, 3),
+            'mean_ms': round(statistics.mean(timings) * 1000, 3),
+            'throughput_rps': round(requests / total, 1),
+            'mean_response_bytes': round(statistics.mean(sizes)),
+            'max_queries': max(queries),
+            'queries_budget': budget,
+            'failures': failures,
+        }
@@ -0,0 +1,66 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from ...models import MyUser
+from ...serializers import UsersListSerializer
+
+
+def measure(func, repeat):
+    """Returns the median time of the call in seconds and the result of the last call"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+class Command(BaseCommand):
+    help = 'Compares the per-row cost of a users list page: ModelSerializer over model instances against the ' \
+           'values_list rows (see serializers.ValuesListSerializerMixin). Missing users are created in a ' \
+           'transaction which is rolled back at the end'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', default='100,250,500,1000',
+                            help='Comma separated page sizes')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per page size, the median is reported')
+
+    def handle(self, *args, **options):
+        try:
+            page_sizes = [int(size) for size in options['page_sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--page-sizes must be comma separated integers')
+        repeat = options['repeat']
+        renderer = JSONRenderer()
+        fields = UsersListSerializer.values_fields()
+
+        with transaction.atomic():
+            self.seed(max(page_sizes))
+            self.stdout.write(f'{"rows":>6} {"instances, us/row":>18} {"values, us/row":>15} {"speedup":>8}')
+            for size in page_sizes:
+                queryset = MyUser.objects.order_by('id')[:size]
+                values_queryset = MyUser.objects.order_by('id').values_list(*fields)[:size]
+
+                instances_time, instances_body = measure(
+                    lambda: renderer.render(UsersListSerializer(list(queryset), many=True).data), repeat)
+                values_time, values_body = measure(
+                    lambda: renderer.render(UsersListSerializer.represent_rows(list(values_queryset))), repeat)
+                if instances_body != values_body:
+                    raise CommandError(f'Bodies differ for {size} rows')
+
+                self.stdout.write(f'{size:>6} {instances_time / size * 1e6:>18.2f} {values_time / size * 1e6:>15.2f} '
+                                  f'{instances_time / values_time:>7.1f}x')
+            transaction.set_rollback(True)
+
+    def seed(self, count):
+        missing = count - MyUser.objects.count()
+        if missing <= 0:
+            return
+        start = MyUser.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        MyUser.objects.bulk_create([
+            MyUser(email=f'benchmark{start + i}@example.com', first_name=f'Имя{i}', last_name=f'Фамилия{i}',
+                   password='!', city='Москва', additional_info='x' * 1000)
+            for i in range(missing)
+        ], batch_size=1000)
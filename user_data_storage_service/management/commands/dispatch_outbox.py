@@ -0,0 +1,36 @@
+import asyncio
+import signal
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...outbox import OutboxDispatcher, make_sink
+
+
+class Command(BaseCommand):
+    help = 'Delivers the events of the users changes from the outbox to OUTBOX_SINKS until stopped (SIGTERM, ' \
+           'SIGINT), see user_data_storage_service/outbox.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sink', action='append', dest='sinks',
+                            help='Sink URL instead of OUTBOX_SINKS, may be repeated')
+        parser.add_argument('--once', action='store_true', help='Deliver the events in the outbox and exit')
+
+    def handle(self, *args, **options):
+        urls = options['sinks'] or settings.OUTBOX_SINKS
+        if not urls:
+            self.stdout.write('No OUTBOX_SINKS, no events are saved')
+            return
+        try:
+            sinks = [make_sink(url) for url in urls]
+        except ValueError as exc:
+            raise CommandError(exc)
+        delivered = asyncio.run(self.dispatch(sinks, options['once']))
+        self.stdout.write(f'{delivered} events delivered')
+
+    async def dispatch(self, sinks, once):
+        dispatcher = OutboxDispatcher(sinks)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, dispatcher.stop)
+        self.stdout.write(f'Delivering to {", ".join(map(str, sinks))}')
+        await dispatcher.run(once=once)
+        return dispatcher.delivered
@@ -0,0 +1,17 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.yasg import generate_schemas, schema_cache
+
+
+class Command(BaseCommand):
+    help = 'Generates the OpenAPI schema into SCHEMA_CACHE_DIR, so the workers read it instead of generating. ' \
+           'Run on deploy, the schema of another code version is never read'
+
+    def handle(self, *args, **options):
+        if not settings.SCHEMA_CACHE_DIR or not settings.SCHEMA_URL:
+            raise CommandError('SCHEMA_CACHE_DIR and SCHEMA_URL must be set')
+        started = time.perf_counter()
+        entries = generate_schemas()
+        self.stdout.write(f'Schema version {schema_cache.version}: {len(entries)} formats in '
+                          f'{time.perf_counter() - started:.2f}s, {settings.SCHEMA_CACHE_DIR}')
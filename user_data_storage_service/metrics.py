@@ -0,0 +1,197 @@
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from .cache import user_cache
+from .hashers import hash_latency
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by view, method and status', None),
+    'http_request_duration_seconds': ('histogram', 'Request handling time by view', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Size of the response body by view', SIZE_BUCKETS),
+    'db_queries_total': ('counter', 'SQL queries by view', None),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in SQL queries by view', None),
+    'serializer_duration_seconds_total': ('counter', 'Time spent in serializers by view', None),
+    'user_cache_requests_total': ('counter', 'User cache lookups by result', None),
+    'password_hash_total': ('counter', 'Password checks in the hasher pool', None),
+    'password_hash_duration_seconds_total': ('counter', 'Time spent in password checks', None),
+    'password_hash_rejected_total': ('counter', 'Logins rejected because the hasher pool is saturated', None),
+}
+
+
+class Registry:
+    """Metrics of the process. Every worker writes them to METRICS_DIR each METRICS_FLUSH_INTERVAL seconds,
+    `/metrics` sums the files of all the workers, including the exited ones, so the counters never go back"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.start_flusher()
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Counts by bucket, the last one is +Inf, then the sum
+                histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0]
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def register_collector(self, collector):
+        """`collector()` returns (name, labels, value) of the counters kept elsewhere in the process"""
+        self.collectors.append(collector)
+        return collector
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters[(name, labels)] = value
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), value] for (name, labels), value in histograms.items()],
+        }
+
+    def flush(self):
+        if not settings.METRICS_DIR:
+            return
+        path = os.path.join(settings.METRICS_DIR, f'{os.getpid()}.json')
+        data = json.dumps(self.snapshot())
+        with tempfile.NamedTemporaryFile('w', dir=settings.METRICS_DIR, delete=False) as file:
+            file.write(data)
+        os.replace(file.name, path)
+
+    def start_flusher(self):
+        # Started in each worker once it serves requests, the thread of the preloading master is not inherited
+        if not settings.METRICS_DIR or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        threading.Thread(target=self.run_flusher, name='metrics-flusher', daemon=True).start()
+
+    def run_flusher(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Metrics are not written to %s', settings.METRICS_DIR)
+
+    def collect(self):
+        """Snapshots of all the worker processes, the current one is taken from memory"""
+        snapshots = [self.snapshot()]
+        if settings.METRICS_DIR and os.path.isdir(settings.METRICS_DIR):
+            own = f'{os.getpid()}.json'
+            for name in os.listdir(settings.METRICS_DIR):
+                if name == own or not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(settings.METRICS_DIR, name)) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        return snapshots
+
+
+registry = Registry()
+
+
+@registry.register_collector
+def collect_user_cache():
+    stats = user_cache.stats()
+    return [('user_cache_requests_total', (('result', result),), stats[counter])
+            for result, counter in (('local_hit', 'local_hits'), ('backend_hit', 'backend_hits'), ('miss', 'misses'))]
+
+
+@registry.register_collector
+def collect_password_hashing():
+    return [
+        ('password_hash_total', (), hash_latency.count),
+        ('password_hash_duration_seconds_total', (), hash_latency.total),
+        ('password_hash_rejected_total', (), hash_latency.rejected),
+    ]
+
+
+def aggregate(snapshots):
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.get(key)
+            histograms[key] = value if total is None else [a + b for a, b in zip(total, value)]
+    return counters, histograms
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+def render(snapshots):
+    """Prometheus text exposition format 0.0.4"""
+    counters, histograms = aggregate(snapshots)
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'counter':
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+            continue
+        for (key_name, labels), value in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Metrics of all the workers, protected by `Authorization: Bearer <METRICS_TOKEN>`. Without the token they are
+    given only to the addresses of INTERNAL_IPS"""
+    if settings.METRICS_TOKEN:
+        if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'):
+            return HttpResponseForbidden()
+    elif request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render(registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from .compression import choose_encoding, compress, compress_stream, is_compressible
+from .instrumentation import collect_request_stats
+from .metrics import registry
+
+
+class MetricsMiddleware:
+    """Records the handling time, SQL queries, serializer time and response size of every request by view
+    (see `metrics.py`) and reports them to the client in the `Server-Timing` header.
+    Supports both the sync and the async handlers, so it adds no thread switch under ASGI"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Makes the middleware instance recognized as a coroutine function, like django.utils.deprecation does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with collect_request_stats() as stats:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        with collect_request_stats() as stats:
+            started = time.perf_counter()
+            response = await self.get_response(request)
+            self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def record(request, response, stats, duration):
+        match = request.resolver_match
+        labels = (('method', request.method), ('view', match.view_name if match else 'unresolved'))
+        registry.inc('http_requests_total', labels + (('status', response.status_code),))
+        registry.observe('http_request_duration_seconds', labels, duration)
+        if not response.streaming:
+            registry.observe('http_response_size_bytes', labels, len(response.content))
+        if stats.queries:
+            registry.inc('db_queries_total', labels, stats.queries)
+            registry.inc('db_query_duration_seconds_total', labels, stats.db_duration)
+        if stats.serializer_duration:
+            registry.inc('serializer_duration_seconds_total', labels, stats.serializer_duration)
+
+        response['Server-Timing'] = f'db;desc="{stats.queries} queries";dur={stats.db_duration * 1000:.1f}, ' \
+                                    f'serializer;dur={stats.serializer_duration * 1000:.1f}, ' \
+                                    f'total;dur={duration * 1000:.1f}'
+
+
+class CompressionMiddleware:
+    """Compresses the responses by the codings the client accepts (zstd and br when their packages are installed,
+    gzip), see `compression.py`. Bodies shorter than COMPRESSION_MIN_SIZE are sent as they are, streaming ones
+    are compressed chunk by chunk. Supports both the sync and the async handlers, like `MetricsMiddleware`"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    @staticmethod
+    def process_response(request, response):
+        if response.status_code < 200 or response.status_code in (204, 304) or \
+                response.has_header('Content-Encoding') or not is_compressible(response.get('Content-Type', '')):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_stream(encoding, response.streaming_content)
+            del response['Content-Length']
+        else:
+            content = compress(encoding, response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+
+        # The compressed body is another representation, the versions stay the same (see `conditional.check_if_match`)
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
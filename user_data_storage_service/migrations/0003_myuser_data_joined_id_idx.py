@@ -0,0 +1,17 @@
+# Generated by Django 3.2.7 on 2026-10-17 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0002_alter_myuser_is_active'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['data_joined', 'id'], name='myuser_data_joined_id_idx'),
+        ),
+    ]
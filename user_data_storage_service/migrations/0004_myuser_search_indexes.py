@@ -0,0 +1,67 @@
+# Generated by Django 3.2.7 on 2026-10-17 17:37
+
+from django.db import migrations, models
+from django.db.migrations.operations.base import Operation
+from user_data_storage_service.models import SearchIndex
+
+
+class TrigramExtension(Operation):
+    """pg_trgm of the search indexes, made on PostgreSQL only. It is the operation of django.contrib.postgres,
+    which needs psycopg2 on every database"""
+    reversible = True
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return 'Creates extension pg_trgm'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0003_myuser_data_joined_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['city', 'id'], name='myuser_city_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['is_active', 'id'], name='myuser_is_active_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['birthday'], name='myuser_birthday_idx'),
+        ),
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=SearchIndex(fields=['first_name'], name='myuser_first_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=SearchIndex(fields=['last_name'], name='myuser_last_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=SearchIndex(fields=['other_name'], name='myuser_other_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=SearchIndex(fields=['email'], name='myuser_email_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=SearchIndex(fields=['city'], name='myuser_city_search_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.7 on 2026-10-17 19:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0004_myuser_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Updated at'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['updated_at', 'id'], name='myuser_updated_at_id_idx'),
+        ),
+    ]
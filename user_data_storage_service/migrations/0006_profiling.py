@@ -0,0 +1,49 @@
+# Generated by Django 3.2.7 on 2026-10-17 20:10
+
+import django.core.validators
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0005_myuser_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfilingRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(help_text='View class and handler, e.g. PrivateUsersListCreateAPIView.get', max_length=255, unique=True, verbose_name='View')),
+                ('sample_rate', models.FloatField(default=0.01, help_text='Share of the requests to profile, from 0 to 1', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)], verbose_name='Sample rate')),
+                ('expires_at', models.DateTimeField(blank=True, null=True, verbose_name='Expires at')),
+            ],
+            options={
+                'verbose_name': 'Profiling rule',
+                'verbose_name_plural': 'Profiling rules',
+            },
+        ),
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(max_length=255, verbose_name='View')),
+                ('path', models.TextField(verbose_name='Path')),
+                ('duration', models.FloatField(verbose_name='Duration, s')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('stats', models.BinaryField(verbose_name='pstats')),
+                ('stacks', models.TextField(blank=True, verbose_name='Collapsed stacks')),
+            ],
+            options={
+                'verbose_name': 'Request profile',
+                'verbose_name_plural': 'Request profiles',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='requestprofile',
+            index=models.Index(fields=['view', '-created_at'], name='requestprofile_view_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:18
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0006_profiling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(verbose_name='User id')),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Deleted at')),
+            ],
+            options={
+                'verbose_name': 'Deleted user',
+                'verbose_name_plural': 'Deleted users',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='deleteduser',
+            index=models.Index(fields=['deleted_at', 'id'], name='deleteduser_deleted_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_data_storage_service', '0008_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['is_admin', 'email'], name='myuser_is_admin_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['is_superuser', 'email'], name='myuser_is_superuser_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['is_active', 'email'], name='myuser_is_active_email_idx'),
+        ),
+    ]
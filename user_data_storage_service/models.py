@@ -1,10 +1,40 @@
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, router, transaction
+from django.db.models.expressions import ExpressionList
+from django.db.models.functions import Cast, Upper
+from django.db.models.sql import Query
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser, PermissionsMixin
 )
+from django.contrib.postgres.indexes import OpClass
 from django.utils import timezone
 
 
+class SearchIndex(models.Index):
+    """Index of a column of the `search` filter (see `filters.search_lookup`): a trigram GIN index on UPPER(column)
+    for `icontains` on PostgreSQL, a NOCASE index for `istartswith` on SQLite and a plain index elsewhere"""
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            # OpClass is a wrapper of the index expressions only with django.contrib.postgres installed, otherwise it
+            # is put in parentheses, so the expressions are resolved here
+            expressions = ExpressionList(*(
+                OpClass(Upper(Cast(field, models.TextField())), 'gin_trgm_ops') for field in self.fields
+            )).resolve_expression(Query(model, alias_cols=False))
+            return schema_editor._create_index_sql(
+                model, name=self.name, using=' USING gin', expressions=expressions, **kwargs
+            )
+        if vendor == 'sqlite':
+            # The collation is a suffix of the columns: the table rebuilds of SQLite break the index expressions
+            return schema_editor._create_index_sql(
+                model, fields=[model._meta.get_field(field) for field in self.fields], name=self.name,
+                col_suffixes=['COLLATE NOCASE'] * len(self.fields), **kwargs
+            )
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
+
+
 class MyUserManager(BaseUserManager):
     def create_user(self, email, first_name, password=None, **other_fields):
         """Creates and saves a User with the given email, first_name and password."""
@@ -47,17 +77,46 @@ class MyUser(AbstractBaseUser, PermissionsMixin):
     city = models.CharField(verbose_name='City', max_length=255, blank=True)
     additional_info = models.TextField(verbose_name='Additional Info', max_length=1000, blank=True)
     data_joined = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(verbose_name='Updated at', auto_now=True)
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
 
     objects = MyUserManager()
 
+    # Changes of only these fields are not published to the other services, see `outbox.py`
+    UNPUBLISHED_FIELDS = frozenset(['password', 'last_login'])
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name']
 
     class Meta:
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        indexes = [
+            models.Index(fields=['data_joined', 'id'], name='myuser_data_joined_id_idx'),
+            models.Index(fields=['city', 'id'], name='myuser_city_id_idx'),
+            models.Index(fields=['is_active', 'id'], name='myuser_is_active_id_idx'),
+            models.Index(fields=['birthday'], name='myuser_birthday_idx'),
+            SearchIndex(fields=['first_name'], name='myuser_first_name_search_idx'),
+            SearchIndex(fields=['last_name'], name='myuser_last_name_search_idx'),
+            SearchIndex(fields=['other_name'], name='myuser_other_name_search_idx'),
+            SearchIndex(fields=['email'], name='myuser_email_search_idx'),
+            SearchIndex(fields=['city'], name='myuser_city_search_idx'),
+            models.Index(fields=['updated_at', 'id'], name='myuser_updated_at_id_idx'),
+            # Filters of the admin changelist, ordered by email
+            models.Index(fields=['is_admin', 'email'], name='myuser_is_admin_email_idx'),
+            models.Index(fields=['is_superuser', 'email'], name='myuser_is_superuser_email_idx'),
+            models.Index(fields=['is_active', 'email'], name='myuser_is_active_email_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """The event of the change is saved by `signals.publish_user_event` in the transaction of the user"""
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) <= self.UNPUBLISHED_FIELDS:
+            return super().save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            super().save(*args, **kwargs)
 
     def get_full_name(self):
         """The user is identified by their email address"""
@@ -74,3 +133,72 @@ class MyUser(AbstractBaseUser, PermissionsMixin):
     def is_staff(self):
         """All admins should be a staff"""
         return self.is_admin
+
+
+class DeletedUser(models.Model):
+    """Tombstone of a deleted user, the change feed gives it out to the clients syncing the users, see `changes.py`"""
+    user_id = models.BigIntegerField(verbose_name='User id')
+    deleted_at = models.DateTimeField(verbose_name='Deleted at', default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Deleted user'
+        verbose_name_plural = 'Deleted users'
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='deleteduser_deleted_at_id_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.deleted_at:%Y-%m-%d %H:%M:%S}'
+
+
+class OutboxEvent(models.Model):
+    """Event of a user change waiting to be delivered to the other services, see `outbox.py`"""
+    event_type = models.CharField(verbose_name='Event type', max_length=50)
+    user_id = models.BigIntegerField(verbose_name='User id')
+    payload = models.JSONField(verbose_name='Payload', blank=True, null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(verbose_name='Created at', default=timezone.now)
+    attempts = models.PositiveIntegerField(verbose_name='Failed attempts', default=0)
+
+    class Meta:
+        verbose_name = 'Outbox event'
+        verbose_name_plural = 'Outbox events'
+
+    def __str__(self):
+        return f'{self.event_type} {self.user_id}'
+
+
+class ProfilingRule(models.Model):
+    """Requests of the view are profiled with the given probability, see `profiling.py`"""
+    view = models.CharField(verbose_name='View', max_length=255, unique=True,
+                            help_text='View class and handler, e.g. PrivateUsersListCreateAPIView.get')
+    sample_rate = models.FloatField(verbose_name='Sample rate', default=0.01,
+                                    validators=[MinValueValidator(0), MaxValueValidator(1)],
+                                    help_text='Share of the requests to profile, from 0 to 1')
+    expires_at = models.DateTimeField(verbose_name='Expires at', blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Profiling rule'
+        verbose_name_plural = 'Profiling rules'
+
+    def __str__(self):
+        return self.view
+
+
+class RequestProfile(models.Model):
+    view = models.CharField(verbose_name='View', max_length=255)
+    path = models.TextField(verbose_name='Path')
+    duration = models.FloatField(verbose_name='Duration, s')
+    created_at = models.DateTimeField(verbose_name='Created at', default=timezone.now)
+    stats = models.BinaryField(verbose_name='pstats')
+    stacks = models.TextField(verbose_name='Collapsed stacks', blank=True)
+
+    class Meta:
+        verbose_name = 'Request profile'
+        verbose_name_plural = 'Request profiles'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['view', '-created_at'], name='requestprofile_view_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.view} {self.created_at:%Y-%m-%d %H:%M:%S}'
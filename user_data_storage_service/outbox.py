@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from .models import MyUser, OutboxEvent
+from .renderers import dumps, orjson
+from .serializers import PrivateUserDetailSerializer
+
+logger = logging.getLogger(__name__)
+
+USER_CREATED, USER_UPDATED, USER_DELETED = 'user.created', 'user.updated', 'user.deleted'
+
+
+def is_published(update_fields):
+    """Changes of only the credentials (login, rehashed password) are not published"""
+    return update_fields is None or not set(update_fields) <= MyUser.UNPUBLISHED_FIELDS
+
+
+# The columns of the user. The derived `photo_urls` is left out, it would check the thumbnails in the storage (and make
+# the missing ones) inside the transaction of the change
+EVENT_FIELDS = PrivateUserDetailSerializer.requested_fields({})
+
+
+def make_event(event_type, user):
+    data = None if event_type == USER_DELETED else dict(PrivateUserDetailSerializer(user, fields=EVENT_FIELDS).data)
+    return OutboxEvent(event_type=event_type, user_id=user.pk, payload=data)
+
+
+def record_event(event_type, user, using=None):
+    """Saves the event in the current transaction of the user's change. Nothing is saved without OUTBOX_SINKS,
+    there is nobody to deliver the events to"""
+    if settings.OUTBOX_SINKS:
+        make_event(event_type, user).save(using=using)
+
+
+def record_events(event_type, users, using=None):
+    """For the bulk changes, which send no signals"""
+    if settings.OUTBOX_SINKS and users:
+        OutboxEvent.objects.using(using).bulk_create([make_event(event_type, user) for user in users])
+
+
+def encode_events(events):
+    """NDJSON, an event per line. `id` grows with every event, the consumers drop the ones they've seen"""
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    lines = [{'id': event.pk, 'type': event.event_type, 'user_id': event.user_id, 'created_at': event.created_at,
+              'data': event.payload} for event in events]
+    if orjson is not None:
+        return b''.join(dumps(line, encoder.default, newline=True) for line in lines)
+    return ''.join(encoder.encode(line) + '\n' for line in lines).encode()
+
+
+class HTTPSink:
+    """POSTs the batch, any response but 2xx is retried"""
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def __str__(self):
+        return self.url
+
+    async def send(self, body):
+        response = await asyncio.to_thread(
+            self.session.post, self.url, data=body, headers={'Content-Type': 'application/x-ndjson'},
+            timeout=settings.OUTBOX_HTTP_TIMEOUT)
+        response.raise_for_status()
+
+
+class FileSink:
+    """Appends the batch to the file, the batch is delivered once it's on the disk"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return f'file://{self.path}'
+
+    def write(self, body):
+        with open(self.path, 'ab') as file:
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def send(self, body):
+        await asyncio.to_thread(self.write, body)
+
+
+class UnixSocketSink:
+    """Writes the batch to a unix stream socket, the connection is reopened after an error"""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def __str__(self):
+        return f'unix://{self.path}'
+
+    async def send(self, body):
+        try:
+            if self.writer is None:
+                _, self.writer = await asyncio.open_unix_connection(self.path)
+            self.writer.write(body)
+            await self.writer.drain()
+        except OSError:
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = None
+            raise
+
+
+def make_sink(url):
+    parts = urlsplit(url)
+    if parts.scheme in ('http', 'https'):
+        return HTTPSink(url)
+    if parts.scheme == 'file':
+        return FileSink(parts.path)
+    if parts.scheme == 'unix':
+        return UnixSocketSink(parts.path)
+    raise ValueError(f'Unknown outbox sink: {url}')
+
+
+class OutboxDispatcher:
+    """Delivers the outbox events to every sink in batches of OUTBOX_BATCH_SIZE, in the order of the events.
+    A batch is deleted from the outbox once all the sinks have taken it. A failed sink gets the same batch again
+    after a growing pause (from OUTBOX_RETRY_BACKOFF up to OUTBOX_RETRY_MAX_BACKOFF seconds), the sinks which have
+    taken it don't. So every event is delivered at least once: twice when the dispatcher stops between the delivery
+    and the delete, or a sink fails after it has taken the batch (e.g. a timeout).
+
+    Must be created in the running event loop. The database is used from a single thread, a single dispatcher must
+    run against the database"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.stopped = asyncio.Event()
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox-db')
+        self.delivered = 0
+
+    async def db(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
+
+    @staticmethod
+    def read_batch():
+        close_old_connections()
+        return list(OutboxEvent.objects.order_by('id')[:settings.OUTBOX_BATCH_SIZE])
+
+    @staticmethod
+    def delete_batch(events):
+        OutboxEvent.objects.filter(id__in=[event.pk for event in events]).delete()
+
+    @staticmethod
+    def count_attempt(events):
+        with transaction.atomic():
+            for event in events:
+                event.attempts += 1
+            OutboxEvent.objects.bulk_update(events, ['attempts'])
+
+    async def sleep(self, seconds):
+        """Returns whether the dispatcher has been stopped meanwhile"""
+        try:
+            await asyncio.wait_for(self.stopped.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def run(self, once=False):
+        """Runs until `stop()`, or with `once` until the outbox is empty"""
+        while not self.stopped.is_set():
+            events = await self.db(self.read_batch)
+            if not events:
+                if once or await self.sleep(settings.OUTBOX_POLL_INTERVAL):
+                    return
+                continue
+            if not await self.deliver(events):
+                return
+            await self.db(self.delete_batch, events)
+            self.delivered += len(events)
+
+    async def deliver(self, events):
+        """Returns False when stopped before all the sinks have taken the batch"""
+        body = encode_events(events)
+        pending = list(self.sinks)
+        failures = 0
+        while True:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(sink.send(body) for sink in pending), return_exceptions=True)
+            failed = [sink for sink, result in zip(pending, results) if isinstance(result, Exception)]
+            if not failed:
+                logger.debug('%s events delivered in %.3fs', len(events), time.perf_counter() - started)
+                return True
+            for sink, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logger.warning('Outbox sink %s failed: %r', sink, result)
+            pending = failed
+            failures += 1
+            await self.db(self.count_attempt, events)
+            backoff = min(settings.OUTBOX_RETRY_MAX_BACKOFF, settings.OUTBOX_RETRY_BACKOFF * 2 ** (failures - 1))
+            # Jitter, so the sinks recovering from an outage don't get all the retries at once
+            if await self.sleep(backoff * random.uniform(0.5, 1)):
+                return False
+
+    def stop(self):
+        self.stopped.set()
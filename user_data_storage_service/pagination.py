@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from .counts import estimate_count
+
+
+class EstimatedCountMixin:
+    """The total is estimated (see `counts.estimate_count`), `?exact_count=1` asks for the exact one"""
+
+    exact_count_query_param = 'exact_count'
+
+    def count_queryset(self, queryset, request):
+        exact = request.query_params.get(self.exact_count_query_param) in ('1', 'true')
+        self.count, self.count_exact = estimate_count(queryset, exact=exact)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_exact', self.count_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema['properties'] = OrderedDict([
+            ('count', {'type': 'integer', 'example': 123}),
+            ('count_exact', {'type': 'boolean', 'example': False}),
+            *schema['properties'].items(),
+        ])
+        return schema
+
+
+class UsersCursorPagination(EstimatedCountMixin, CursorPagination):
+    """Keyset pagination for users lists. Pages are fetched with `WHERE id > <cursor>` instead of OFFSET,
+    so deep pages cost the same as the first one"""
+
+    ordering = 'id'
+    ordering_param = 'ordering'
+    # Orderings backed by the primary key and by the (data_joined, id) index. The users joined at the same time
+    # keep the order of their ids, so the cursor neither skips nor repeats them
+    allowed_orderings = {
+        'id': ('id',),
+        '-id': ('-id',),
+        'data_joined': ('data_joined', 'id'),
+        '-data_joined': ('-data_joined', '-id'),
+    }
+    page_size_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_queryset(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_page_size(self, request):
+        self.page_size = settings.USERS_PAGE_SIZE
+        self.max_page_size = settings.USERS_MAX_PAGE_SIZE
+        return super().get_page_size(request)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get(self.ordering_param)
+        return self.allowed_orderings.get(ordering, (self.ordering,))
+
+
+class UsersLimitOffsetPagination(EstimatedCountMixin, LimitOffsetPagination):
+    """Pages by `?offset=`, the pagination of the users lists before the cursor one, kept for the clients which
+    count the offsets themselves. The page is read with one row more, so the next link doesn't depend on the
+    estimated total. The links keep the offset, so the clients stay on these pages"""
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.max_limit = settings.USERS_MAX_PAGE_SIZE
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        self.request = request
+        self.count_queryset(queryset, request)
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.get_link(self.offset + self.limit)
+
+    def get_previous_link(self):
+        if self.offset <= 0:
+            return None
+        return self.get_link(max(self.offset - self.limit, 0))
+
+    def get_link(self, offset):
+        url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, offset)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator of the admin changelists, the number of pages is built on the estimated count"""
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)[0]
@@ -0,0 +1,193 @@
+import collections
+import contextvars
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core import signing
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from .models import ProfilingRule, RequestProfile
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+TOKEN_SALT = 'user_data_storage_service.profiling'
+
+# Set for the profiled requests, the work run by `async_views.db_sync_to_async` is profiled then
+_session = contextvars.ContextVar('profile_session', default=None)
+
+
+def make_token(view):
+    """Value of the `X-Profile` header which turns on profiling of one request to the view"""
+    return signing.dumps(view, salt=TOKEN_SALT)
+
+
+def read_token(token):
+    try:
+        return signing.loads(token, salt=TOKEN_SALT, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+class Rules:
+    """Sample rates by view. They are reloaded every PROFILING_RULES_REFRESH seconds by a thread of the worker,
+    so the requests never query the rules"""
+
+    def __init__(self):
+        self.rates = {}
+        self._loader_pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Started in each worker by the warmup or its first request, the thread of the preloading master is not
+        # inherited
+        if self._loader_pid == os.getpid():
+            return
+        with self._lock:
+            if self._loader_pid == os.getpid():
+                return
+            self._loader_pid = os.getpid()
+        threading.Thread(target=self.run_loader, name='profiling-rules', daemon=True).start()
+
+    def run_loader(self):
+        while True:
+            close_old_connections()
+            self.load()
+            time.sleep(settings.PROFILING_RULES_REFRESH)
+
+    def load(self):
+        try:
+            rules = ProfilingRule.objects.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+                                                 sample_rate__gt=0)
+            self.rates = dict(rules.values_list('view', 'sample_rate'))
+        except DatabaseError:
+            logger.exception('Profiling rules are not loaded')
+
+
+rules = Rules()
+
+
+class Sampler:
+    """Takes the stacks of the threads running the profiled work every PROFILING_SAMPLE_INTERVAL seconds.
+    The thread runs only while there is something to sample"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def register(self, session):
+        with self._lock:
+            self.sessions[threading.get_ident()] = session
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiling-sampler', daemon=True)
+                self.thread.start()
+
+    def unregister(self):
+        with self._lock:
+            self.sessions.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            time.sleep(settings.PROFILING_SAMPLE_INTERVAL)
+            with self._lock:
+                if not self.sessions:
+                    self.thread = None
+                    return
+                sessions = list(self.sessions.items())
+            frames = sys._current_frames()
+            for thread_id, session in sessions:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    session.add_stack(frame)
+
+
+sampler = Sampler()
+
+
+def collapse(frame):
+    """Stack in the collapsed format of flamegraph.pl and speedscope, the outermost frame goes first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfileSession:
+    """Profile of one request. Every piece of work is run under cProfile and sampled for the flamegraph"""
+
+    def __init__(self, view, path):
+        self.view = view
+        self.path = path
+        self.started = time.perf_counter()
+        self.duration = None
+        self.profiles = []
+        self.stacks = collections.Counter()
+        self._lock = threading.Lock()
+
+    def run(self, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        sampler.register(self)
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            sampler.unregister()
+            with self._lock:
+                self.profiles.append(profile)
+
+    def add_stack(self, frame):
+        stack = collapse(frame)
+        with self._lock:
+            self.stacks[stack] += 1
+
+    def save(self):
+        if not self.profiles:
+            return
+        stats = pstats.Stats(*self.profiles)
+        RequestProfile.objects.create(
+            view=self.view,
+            path=self.path,
+            duration=self.duration,
+            stats=marshal.dumps(stats.stats),
+            stacks=''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common()),
+        )
+        stale = RequestProfile.objects.filter(view=self.view).values_list('id', flat=True)[
+                settings.PROFILING_MAX_PROFILES:]
+        RequestProfile.objects.filter(id__in=list(stale)).delete()
+
+
+def current_session():
+    return _session.get()
+
+
+def should_profile(request, view):
+    """Costs a dict lookup when profiling is off"""
+    token = request.META.get(PROFILE_HEADER)
+    if token is not None and read_token(token) == view:
+        return True
+    rate = rules.rates.get(view)
+    return rate is not None and random.random() < rate
+
+
+@contextmanager
+def profile_session(view, path):
+    session = ProfileSession(view, path)
+    token = _session.set(session)
+    try:
+        yield session
+    finally:
+        session.duration = time.perf_counter() - session.started
+        _session.reset(token)
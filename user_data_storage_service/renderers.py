@@ -0,0 +1,32 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # Dates and times are left to the encoder of DRF, orjson formats them differently
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data, default, newline=False):
+    """Compact UTF-8 JSON by orjson, the types it doesn't know are converted by `default`"""
+    option = ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE if newline else ORJSON_OPTIONS
+    return orjson.dumps(data, default=default, option=option)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer on orjson when it is installed, otherwise the renderer of DRF as it is. The output is the same:
+    indented and non compact or ASCII JSON, and the values orjson can't encode, are rendered by DRF"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = dumps(data, self.encoder_class().default)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped like JSONRenderer does, so the JSON is a strict JavaScript subset
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,108 @@
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_READS_COOKIE = 'primary_reads_until'
+
+# Set for the requests which may read from a replica. Holds the replica chosen for the request,
+# so all the queries of the request see the same data
+_replica_state = contextvars.ContextVar('replica_state', default=None)
+
+
+@contextmanager
+def read_from_replica():
+    token = _replica_state.set({})
+    try:
+        yield
+    finally:
+        _replica_state.reset(token)
+
+
+def must_read_primary(request):
+    """Reads go to the primary for a while after the user's own write, so the user sees the changes"""
+    try:
+        return float(request.COOKIES.get(PRIMARY_READS_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def pin_primary_reads(response):
+    window = settings.REPLICA_READ_YOUR_WRITES_WINDOW
+    response.set_cookie(PRIMARY_READS_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+
+
+class ReplicaHealth:
+    """Replica is checked at most once per REPLICA_HEALTH_CHECK_INTERVAL, a failed or lagging one is not used
+    until the next check"""
+
+    def __init__(self):
+        self._state = {}
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        state = self._state.get(alias)
+        if state is None or now - state[1] >= settings.REPLICA_HEALTH_CHECK_INTERVAL:
+            state = (self.check(alias), now)
+            self._state[alias] = state
+        return state[0]
+
+    def check(self, alias):
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    cursor.execute(
+                        'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                        'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+                    )
+                    lag = cursor.fetchone()[0]
+                    if lag > settings.REPLICA_MAX_LAG:
+                        logger.warning('Replica %s lags behind by %.1f s', alias, lag)
+                        return False
+                else:
+                    cursor.execute('SELECT 1')
+        except DatabaseError:
+            logger.exception('Replica %s is unavailable', alias)
+            try:
+                connection.close()
+            except DatabaseError:
+                pass
+            return False
+        return True
+
+    def reset(self):
+        self._state.clear()
+
+
+health = ReplicaHealth()
+
+
+def choose_replica():
+    replicas = [alias for alias in settings.DATABASE_REPLICAS if health.is_healthy(alias)]
+    return random.choice(replicas) if replicas else 'default'
+
+
+class PrimaryReplicaRouter:
+    """Writes go to the primary. Reads go to a healthy replica inside `read_from_replica`, otherwise to the primary.
+    Sessions are always read from the primary, the requests are authenticated by them"""
+
+    def db_for_read(self, model, **hints):
+        state = _replica_state.get()
+        if state is None or not settings.DATABASE_REPLICAS or model._meta.app_label == 'sessions':
+            return 'default'
+        alias = state.get('alias')
+        if alias is None or (alias != 'default' and not health.is_healthy(alias)):
+            alias = state['alias'] = choose_replica()
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
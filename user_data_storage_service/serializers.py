@@ -1,5 +1,70 @@
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from .instrumentation import measure_serialization
 from .models import MyUser
+from .thumbnails import thumbnail_urls
+
+
+class MeasuredSerializerMixin:
+    """Time of building the representation is counted to the request metrics, see `middleware.MetricsMiddleware`"""
+
+    @property
+    def data(self):
+        with measure_serialization():
+            return super().data
+
+
+class SparseFieldsetMixin:
+    """Fields of the response are chosen by the query parameters: `fields` and `exclude` take comma separated names,
+    the derived fields of `Meta.expandable_fields` are given only when named in `fields` or `expand`.
+    `fields` of the serializer limits it to these fields, the others are not run"""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, query_params):
+        """Names of the requested fields in the order of `Meta.fields`"""
+        all_fields = cls.Meta.fields
+        expandable_fields = getattr(cls.Meta, 'expandable_fields', [])
+        params = {}
+        errors = {}
+        for param, allowed in (('fields', all_fields), ('exclude', all_fields), ('expand', expandable_fields)):
+            value = query_params.get(param)
+            params[param] = [name for name in value.split(',') if name] if value else []
+            unknown = [name for name in params[param] if name not in allowed]
+            if unknown:
+                errors[param] = [f'Unknown fields: {", ".join(unknown)}']
+        if errors:
+            raise ValidationError(errors)
+
+        fields, exclude, expand = params['fields'], params['exclude'], params['expand']
+        if fields:
+            selected = [name for name in all_fields if name in fields or name in expand]
+        else:
+            selected = [name for name in all_fields if name not in expandable_fields or name in expand]
+        return [name for name in selected if name not in exclude]
+
+    @staticmethod
+    def select_fields(data, fields):
+        """Requested part of a full payload, e.g. of the cached one"""
+        return {name: data[name] for name in fields}
+
+
+class PhotoUrlsField(serializers.ReadOnlyField):
+    """URLs of the photo thumbnails by their size. URLs don't depend on the request (they are absolute only when
+    MEDIA_URL is), so the payloads may be cached"""
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = 'photo'
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return thumbnail_urls(value)
 
 
 class LoginSerializer(serializers.ModelSerializer):
@@ -11,15 +76,36 @@ class LoginSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
 
 
-class CurrentUserSerializer(serializers.ModelSerializer):
+class CurrentUserSerializer(MeasuredSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     """Current user serializer"""
 
+    photo_urls = PhotoUrlsField()
+
     class Meta:
         model = MyUser
-        fields = ['first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday', 'is_admin']
+        fields = ['first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday', 'is_admin', 'photo_urls']
+        expandable_fields = ['photo_urls']
+
+
+class ValuesListSerializerMixin:
+    """For serializers of plain text and integer columns. Such a column is represented by its value as it is,
+    so the rows read by `values_list` are given out without building instances and running the fields"""
+
+    @classmethod
+    def values_fields(cls, fields=None):
+        """All the fields when none are requested, an empty selection stays empty as in the detail responses"""
+        return cls.Meta.fields if fields is None else fields
 
+    @classmethod
+    def represent_rows(cls, rows, fields=None):
+        """Rows must start with the `values_fields` columns, the rest of the columns are skipped"""
+        fields = cls.values_fields(fields)
+        with measure_serialization():
+            return [dict(zip(fields, row)) for row in rows]
 
-class UsersListSerializer(serializers.ModelSerializer):
+
+class UsersListSerializer(MeasuredSerializerMixin, SparseFieldsetMixin, ValuesListSerializerMixin,
+                          serializers.ModelSerializer):
     """Users list serializer"""
 
     class Meta:
@@ -27,7 +113,8 @@ class UsersListSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name', 'email']
 
 
-class PrivateUsersListSerializer(serializers.ModelSerializer):
+class PrivateUsersListSerializer(MeasuredSerializerMixin, SparseFieldsetMixin, ValuesListSerializerMixin,
+                                 serializers.ModelSerializer):
     """Private users list serializer"""
 
     class Meta:
@@ -35,7 +122,7 @@ class PrivateUsersListSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name', 'email']
 
 
-class PrivateCreateUserSerializer(serializers.ModelSerializer):
+class PrivateCreateUserSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """Private create user serializer"""
 
     class Meta:
@@ -44,18 +131,90 @@ class PrivateCreateUserSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
 
 
-class PrivateUserDetailSerializer(serializers.ModelSerializer):
+class PrivateUserDetailSerializer(MeasuredSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     """Private user detail serializer"""
 
+    photo_urls = PhotoUrlsField()
+
     class Meta:
         model = MyUser
         fields = ['id', 'first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday', 'city',
-                  'additional_info', 'is_admin']
+                  'additional_info', 'is_admin', 'photo_urls']
+        expandable_fields = ['photo_urls']
 
 
-class UpdateUserSerializer(serializers.ModelSerializer):
+class UpdateUserSerializer(MeasuredSerializerMixin, serializers.ModelSerializer):
     """Update user serializer"""
 
     class Meta:
         model = MyUser
         fields = ['id', 'first_name', 'last_name', 'other_name', 'email', 'phone', 'birthday']
+
+
+class UsersFilterSerializer(serializers.Serializer):
+    """Users list filters serializer"""
+
+    search = serializers.CharField(required=False, max_length=255)
+    city = serializers.CharField(required=False, max_length=255)
+    is_active = serializers.BooleanField(required=False)
+    birthday_from = serializers.DateField(required=False)
+    birthday_to = serializers.DateField(required=False)
+    joined_after = serializers.DateTimeField(required=False)
+
+
+class UsersLookupSerializer(serializers.Serializer):
+    """Users lookup serializer, either ids or emails"""
+
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False)
+    emails = serializers.ListField(child=serializers.CharField(max_length=255), required=False, allow_empty=False)
+
+    def validate(self, attrs):
+        if len(attrs) != 1:
+            raise ValidationError('Either ids or emails must be given.')
+        (name, values), = attrs.items()
+        if len(values) > settings.USERS_LOOKUP_MAX_SIZE:
+            raise ValidationError({name: [f'Ensure this field has no more than {settings.USERS_LOOKUP_MAX_SIZE} '
+                                          f'elements.']})
+        return attrs
+
+
+class UserBatchOperationSerializer(serializers.Serializer):
+    """Operation of the users batch, `data` is validated by the serializer of the operation, see `batch.UserBatch`"""
+
+    op = serializers.ChoiceField(choices=['create', 'update', 'delete'])
+    id = serializers.IntegerField(required=False, min_value=1)
+    data = serializers.DictField(required=False)
+
+    def validate(self, attrs):
+        errors = {}
+        if attrs['op'] != 'create' and 'id' not in attrs:
+            errors['id'] = [self.fields['id'].error_messages['required']]
+        if attrs['op'] != 'delete' and 'data' not in attrs:
+            errors['data'] = [self.fields['data'].error_messages['required']]
+        if errors:
+            raise ValidationError(errors)
+        return attrs
+
+
+class UserBatchSerializer(serializers.Serializer):
+    """Users batch serializer"""
+
+    operations = UserBatchOperationSerializer(many=True, allow_empty=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Checked by the list before its items, an oversized batch is rejected without validating the operations
+        fields['operations'].max_length = settings.USERS_BATCH_MAX_OPERATIONS
+        return fields
+
+
+class UserChangesSerializer(serializers.Serializer):
+    """Query of the users change feed"""
+
+    since = serializers.CharField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, limit):
+        if limit > settings.USERS_MAX_PAGE_SIZE:
+            raise ValidationError(f'Ensure this value is less than or equal to {settings.USERS_MAX_PAGE_SIZE}.')
+        return limit
@@ -0,0 +1,179 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.db import DatabaseError, close_old_connections, connections, router
+from django.utils import timezone
+from .utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """Sessions of the worker process. Reads are served from an in-process LRU for SESSION_LOCAL_TTL seconds, a miss
+    is read from the database. New sessions, changed session data and deletes are written through, a save which only
+    moves the expiry of the session is written by a background thread every SESSION_WRITE_BEHIND_INTERVAL seconds,
+    in batches. The same thread deletes the expired sessions every SESSION_SWEEP_INTERVAL seconds"""
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=settings.SESSION_LOCAL_SIZE)
+        # Expiry dates to write by session keys
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._writer_pid = None
+        self._swept_at = time.monotonic()
+        # Database the pending changes were made in. The changes are dropped when it's been switched since,
+        # e.g. the test database destroyed before the flush at exit
+        self._database = None
+
+    def get(self, session_key):
+        """Returns (session_data, expire_date) or None when the session must be read from the database"""
+        entry = self.local.get(session_key)
+        if entry is None:
+            return None
+        cached_until, session_data, expire_date = entry
+        if cached_until < time.monotonic():
+            self.local.pop(session_key)
+            return None
+        return session_data, expire_date
+
+    def remember(self, session_key, session_data, expire_date):
+        """Keeps a session read from or written to the database, its pending expiry is superseded"""
+        self.local.set(session_key, (time.monotonic() + settings.SESSION_LOCAL_TTL, session_data, expire_date))
+        with self._lock:
+            self.pending.pop(session_key, None)
+
+    def set_expiry(self, session_key, expire_date):
+        """Keeps the new expiry of a session whose data is unchanged, it is written behind"""
+        entry = self.local.get(session_key)
+        if entry is not None:
+            self.local.set(session_key, (entry[0], entry[1], expire_date))
+        self.start_writer()
+        with self._lock:
+            self.pending[session_key] = expire_date
+            self._database = self.current_database()
+
+    def forget(self, session_key):
+        self.local.pop(session_key)
+        with self._lock:
+            self.pending.pop(session_key, None)
+
+    @staticmethod
+    def current_database():
+        return connections[router.db_for_write(SessionStore.get_model_class())].settings_dict['NAME']
+
+    def flush(self):
+        """Writes the pending expiry dates with a few queries whatever their number. Only the expiry is written,
+        so a session changed or deleted by another worker since is not overwritten nor restored"""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending or self._database != self.current_database():
+            return
+        model = SessionStore.get_model_class()
+        try:
+            model.objects.bulk_update([model(session_key=key, expire_date=expire_date)
+                                       for key, expire_date in pending.items()], ['expire_date'])
+        except DatabaseError:
+            logger.exception('Sessions are not written, they are retried with the next flush')
+            with self._lock:
+                # The changes made since take precedence
+                self.pending = {**pending, **self.pending}
+
+    def sweep(self):
+        """Deletes the expired sessions by SESSION_SWEEP_BATCH_SIZE rows, so no long lock is held on the table"""
+        model = SessionStore.get_model_class()
+        deleted = 0
+        while True:
+            keys = list(model.objects.filter(expire_date__lt=timezone.now())
+                        .values_list('session_key', flat=True)[:settings.SESSION_SWEEP_BATCH_SIZE])
+            if keys:
+                deleted += model.objects.filter(session_key__in=keys).delete()[0]
+            if len(keys) < settings.SESSION_SWEEP_BATCH_SIZE:
+                return deleted
+
+    def start_writer(self):
+        # Started in each worker by the warmup or its first session, the thread of the preloading master is not
+        # inherited. It also sweeps the expired sessions, so it runs whether any expiry is written behind or not
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        atexit.register(self.flush)
+        threading.Thread(target=self.run_writer, name='session-writer', daemon=True).start()
+
+    def run_writer(self):
+        while True:
+            time.sleep(settings.SESSION_WRITE_BEHIND_INTERVAL)
+            self.run_once()
+
+    def run_once(self):
+        """Writes the pending expiry dates and deletes the expired sessions when their SESSION_SWEEP_INTERVAL is up"""
+        close_old_connections()
+        self.flush()
+        if time.monotonic() - self._swept_at >= settings.SESSION_SWEEP_INTERVAL:
+            self._swept_at = time.monotonic()
+            try:
+                deleted = self.sweep()
+            except DatabaseError:
+                logger.exception('Expired sessions are not deleted')
+            else:
+                logger.debug('%s expired sessions deleted', deleted)
+
+
+session_cache = SessionCache()
+
+
+class SessionStore(DBStore):
+    """Database sessions read through the in-process cache, see `SessionCache`.
+
+    Logins, logouts and the other changes of the session data reach the database at once, so the other workers see
+    them. A worker which has read a session before keeps it for up to SESSION_LOCAL_TTL seconds, so a logout in one
+    worker ends the session in the others within that time"""
+
+    def load(self):
+        session_cache.start_writer()
+        cached = session_cache.get(self.session_key)
+        if cached is None:
+            session = self._get_session_from_db()
+            if session is None:
+                return {}
+            session_data, expire_date = session.session_data, session.expire_date
+            session_cache.remember(self.session_key, session_data, expire_date)
+        else:
+            session_data, expire_date = cached
+            if expire_date <= timezone.now():
+                self._session_key = None
+                return {}
+        return self.decode(session_data)
+
+    def exists(self, session_key):
+        return session_cache.get(session_key) is not None or super().exists(session_key)
+
+    def save(self, must_create=False):
+        session_cache.start_writer()
+        if self.session_key is None:
+            return self.create()
+        if not must_create and not self.modified:
+            # Saved by SESSION_SAVE_EVERY_REQUEST, only the expiry has moved
+            session_cache.set_expiry(self.session_key, self.get_expiry_date())
+            return
+        super().save(must_create=must_create)
+        session_cache.remember(self.session_key, self.encode(self._session), self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        session_cache.forget(session_key)
+        self.model.objects.filter(session_key=session_key).delete()
+
+    @classmethod
+    def clear_expired(cls):
+        """Used by `manage.py clearsessions`"""
+        session_cache.sweep()
@@ -0,0 +1,94 @@
+import contextvars
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .cache import user_cache
+from .instrumentation import record_query
+from .models import DeletedUser, MyUser, ProfilingRule
+from .outbox import USER_CREATED, USER_DELETED, USER_UPDATED, is_published, record_event, \
+    record_events
+from .profiling import rules as profiling_rules
+from .serializers import CurrentUserSerializer, PrivateUserDetailSerializer
+from .thumbnails import schedule_thumbnails
+
+# Payloads cached by the views, they are dropped when the user is changed in any process
+user_cache.register(CurrentUserSerializer, PrivateUserDetailSerializer)
+
+
+@receiver(post_save, sender=MyUser)
+def make_photo_thumbnails(sender, instance, update_fields=None, **kwargs):
+    """Thumbnails of a saved photo are made in the background after the transaction is committed"""
+    if not instance.photo or (update_fields is not None and 'photo' not in update_fields):
+        return
+    name = instance.photo.name
+    transaction.on_commit(lambda: schedule_thumbnails(name))
+
+
+@receiver(post_save, sender=MyUser)
+@receiver(post_delete, sender=MyUser)
+def invalidate_user_cache(sender, instance, **kwargs):
+    """Cached payloads are dropped at once and once more after commit, so a concurrent request can't put back
+    the data read before the commit"""
+    pk = instance.pk
+    user_cache.invalidate(pk)
+    transaction.on_commit(lambda: user_cache.invalidate(pk))
+
+
+# Ids of the users being deleted by `delete_users`, their tombstones and events are saved by it in bulk
+_deleted_ids = contextvars.ContextVar('deleted_ids', default=None)
+
+
+def delete_users(queryset):
+    """Deletes the users with one INSERT of their tombstones and one of their outbox events instead of one per user.
+    Used by the bulk deletes (batch, admin), returns the result of `QuerySet.delete`"""
+    deleted_ids = []
+    token = _deleted_ids.set(deleted_ids)
+    try:
+        # No savepoint inside the transaction of the batch
+        with transaction.atomic(using=queryset.db, savepoint=False):
+            result = queryset.delete()
+            DeletedUser.objects.using(queryset.db).bulk_create([DeletedUser(user_id=pk) for pk in deleted_ids])
+            record_events(USER_DELETED, [MyUser(pk=pk) for pk in deleted_ids], queryset.db)
+    finally:
+        _deleted_ids.reset(token)
+    return result
+
+
+@receiver(post_delete, sender=MyUser)
+def record_tombstone(sender, instance, using, **kwargs):
+    """Saved in the transaction of the delete, however the user is deleted (API, batch, admin)"""
+    deleted_ids = _deleted_ids.get()
+    if deleted_ids is not None:
+        deleted_ids.append(instance.pk)
+    else:
+        DeletedUser.objects.using(using).create(user_id=instance.pk)
+
+
+@receiver(post_save, sender=MyUser)
+def publish_user_event(sender, instance, created, using, update_fields=None, raw=False, **kwargs):
+    """The event is saved in the transaction of the change (see `MyUser.save`), the fixtures are not published"""
+    if not raw and is_published(update_fields):
+        record_event(USER_CREATED if created else USER_UPDATED, instance, using)
+
+
+@receiver(post_delete, sender=MyUser)
+def publish_user_deleted(sender, instance, using, **kwargs):
+    if _deleted_ids.get() is None:
+        record_event(USER_DELETED, instance, using)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    """Queries are counted only inside `instrumentation.collect_request_stats`, otherwise the wrapper just calls
+    through"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(post_save, sender=ProfilingRule)
+@receiver(post_delete, sender=ProfilingRule)
+def reload_profiling_rules(sender, **kwargs):
+    """The process where the rule was changed applies it once it's committed, the others within
+    PROFILING_RULES_REFRESH"""
+    transaction.on_commit(profiling_rules.load)
@@ -1,3 +1,1147 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from unittest import mock, skipUnless
+from core.handlers import ASGIHandler
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.hashers import make_password
+from django.contrib.sessions.models import Session
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from . import profiling
+from .cache import user_cache
+from .counts import count_cache, estimate_count
+from .filters import SEARCH_FIELDS
+from .admin import MyUserAdmin
+from .async_views import db_executor, db_sync_to_async
+from .hashers import PasswordHasherPool, PoolSaturated, hash_latency
+from .middleware import CompressionMiddleware
+from .models import DeletedUser, MyUser, OutboxEvent, ProfilingRule, RequestProfile, SearchIndex
+from .outbox import FileSink, OutboxDispatcher
+from .renderers import FastJSONRenderer
+from .sessions import SessionStore, session_cache
+from .routers import PRIMARY_READS_COOKIE, ReplicaHealth, health
+from .serializers import PrivateUserDetailSerializer, PrivateUsersListSerializer, UserBatchOperationSerializer, \
+    UsersListSerializer
+from .thumbnails import generate_thumbnails, thumbnail_name, thumbnail_url, thumbnail_urls
+from .utils import LRUCache
+from .views import CurrentUserAPIView
 
-# Create your tests here.
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], DATABASE_REPLICAS=[])
+class AdminAPITestCase(TransactionTestCase):
+    """Requests run the ORM in the threads of the database pool, which don't see the transaction of a TestCase.
+    The requests are made by an admin logged in through the API"""
+
+    def setUp(self):
+        user_cache.local.clear()
+        # The reloader thread of the profiling rules would read the test database while the test writes it
+        patcher = mock.patch.object(profiling.rules, 'start')
+        self.start_profiling_rules = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.admin = MyUser.objects.create_user('admin@google.com', 'Admin', 'password', is_admin=True)
+        self.login('admin@google.com', 'password')
+
+    def login(self, email, password):
+        return self.client.post(reverse('login'), {'email': email, 'password': password},
+                                content_type='application/json')
+
+
+class UsersPaginationTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(4):
+            MyUser.objects.create_user(f'user{i}@google.com', f'User{i}')
+        # Everybody joined at the same time, the cursor has to go by id among them
+        MyUser.objects.update(data_joined=timezone.now())
+        self.ids = list(MyUser.objects.order_by('id').values_list('id', flat=True))
+
+    def pages(self, url, params):
+        ids = []
+        response = self.client.get(url, params)
+        while True:
+            page = response.json()
+            ids += [row['id'] for row in page['results']]
+            if page['next'] is None:
+                return ids, page
+            response = self.client.get(page['next'])
+
+    def test_cursor_pages_by_data_joined(self):
+        ids, page = self.pages(reverse('private_users'), {'fields': 'id', 'limit': 2, 'ordering': 'data_joined'})
+        self.assertEqual(ids, self.ids)
+        self.assertEqual((page['count'], page['count_exact']), (5, True))
+        self.assertIn('cursor=', page['previous'])
+        ids, _ = self.pages(reverse('users'), {'fields': 'id', 'limit': 2, 'ordering': '-data_joined'})
+        self.assertEqual(ids, self.ids[::-1])
+
+    def test_offset_pages(self):
+        ids, page = self.pages(reverse('users'), {'fields': 'id', 'limit': 2, 'offset': 0})
+        self.assertEqual(ids, self.ids)
+        self.assertEqual(page['count'], 5)
+        self.assertIn('offset=2', page['previous'])
+        page = self.client.get(reverse('users'), {'fields': 'id', 'limit': 2, 'offset': 2}).json()
+        self.assertEqual([row['id'] for row in page['results']], self.ids[2:4])
+        self.assertIn('offset=0', page['previous'])
+        self.assertIn('offset=4', page['next'])
+
+
+class CountsTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        count_cache.counts.clear()
+        self.addCleanup(count_cache.counts.clear)
+
+    def test_small_counts_are_exact(self):
+        self.assertEqual(estimate_count(MyUser.objects.all()), (1, True))
+        MyUser.objects.create_user('user@google.com', 'User')
+        self.assertEqual(estimate_count(MyUser.objects.all()), (2, True))
+
+    @override_settings(COUNT_EXACT_THRESHOLD=2)
+    def test_large_counts_are_cached(self):
+        MyUser.objects.create_user('user@google.com', 'User')
+        page = self.client.get(reverse('users'), {'fields': 'id'}).json()
+        self.assertEqual((page['count'], page['count_exact']), (2, True))
+        MyUser.objects.create_user('user2@google.com', 'User')
+        page = self.client.get(reverse('users'), {'fields': 'id'}).json()
+        self.assertEqual((page['count'], page['count_exact']), (2, False))
+        page = self.client.get(reverse('users'), {'fields': 'id', 'exact_count': 1}).json()
+        self.assertEqual((page['count'], page['count_exact']), (3, True))
+
+    @override_settings(COUNT_EXACT_THRESHOLD=1, COUNT_CACHE_TTL=0)
+    def test_stale_count_is_refreshed_in_background(self):
+        queryset = MyUser.objects.all()
+        self.assertEqual(estimate_count(queryset), (1, True))
+        MyUser.objects.create_user('user@google.com', 'User')
+        with mock.patch.object(db_executor, 'submit') as submit:
+            self.assertEqual(estimate_count(queryset), (1, False))
+            self.assertEqual(estimate_count(queryset), (1, False))
+        submit.assert_called_once()
+        run, *args = submit.call_args.args
+        run(*args)
+        self.assertFalse(count_cache.refreshing)
+        with mock.patch.object(db_executor, 'submit'):
+            self.assertEqual(estimate_count(queryset), (2, False))
+
+
+class JWTAuthenticationTests(AdminAPITestCase):
+
+    def test_token_with_session(self):
+        response = self.client.get(reverse('current_user'))
+        self.assertEqual(response.json()['email'], 'admin@google.com')
+
+    def test_token_without_session(self):
+        token = self.client.cookies[settings.JWT_COOKIE_NAME].value
+        self.client.cookies.pop(settings.SESSION_COOKIE_NAME)
+        self.assertEqual(self.client.get(reverse('current_user')).status_code, 401)
+        self.client = self.client_class()
+        self.client.cookies[settings.JWT_COOKIE_NAME] = token
+        self.assertEqual(self.client.get(reverse('current_user')).status_code, 401)
+
+    def test_logout_revokes_token(self):
+        token = self.client.cookies[settings.JWT_COOKIE_NAME].value
+        self.assertEqual(self.client.get(reverse('logout')).status_code, 200)
+        self.client.cookies[settings.JWT_COOKIE_NAME] = token
+        self.assertEqual(self.client.get(reverse('current_user')).status_code, 401)
+
+    def test_password_change_revokes_token(self):
+        self.admin.set_password('changed')
+        self.admin.save()
+        self.assertEqual(self.client.get(reverse('current_user')).status_code, 401)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordHasherPoolTests(SimpleTestCase):
+
+    def test_verify(self):
+        pool = PasswordHasherPool('thread', workers=1, queue_size=0)
+        encoded = make_password('secret')
+        self.assertEqual(asyncio.run(pool.verify('secret', encoded)), (True, None))
+        self.assertEqual(asyncio.run(pool.verify('wrong', encoded)), (False, None))
+
+    def test_upgrades_hash(self):
+        pool = PasswordHasherPool('thread', workers=1, queue_size=0)
+        encoded = make_password('secret')
+        with self.settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.SHA1PasswordHasher',
+                                             'django.contrib.auth.hashers.MD5PasswordHasher']):
+            is_correct, new_encoded = asyncio.run(pool.verify('secret', encoded))
+        self.assertTrue(is_correct)
+        self.assertTrue(new_encoded.startswith('sha1$'))
+
+    def test_rejects_when_saturated(self):
+        pool = PasswordHasherPool('thread', workers=1, queue_size=1)
+        release = threading.Event()
+        futures = [pool.submit(release.wait) for _ in range(2)]
+        rejected = hash_latency.rejected
+        with self.assertRaises(PoolSaturated):
+            pool.submit(release.wait)
+        self.assertEqual(hash_latency.rejected, rejected + 1)
+        release.set()
+        for future in futures:
+            future.result()
+        self.assertTrue(pool.submit(release.wait).result())
+
+
+class LoginTests(AdminAPITestCase):
+
+    def test_wrong_password(self):
+        self.assertEqual(self.login('admin@google.com', 'wrong').status_code, 422)
+        self.assertEqual(self.login('nobody@google.com', 'password').status_code, 422)
+
+    def test_saturated_pool(self):
+        with mock.patch.object(PasswordHasherPool, 'verify', side_effect=PoolSaturated):
+            response = self.login('admin@google.com', 'password')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_upgrades_stored_hash(self):
+        with self.settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.SHA1PasswordHasher',
+                                             'django.contrib.auth.hashers.MD5PasswordHasher']):
+            self.assertEqual(self.login('admin@google.com', 'password').status_code, 200)
+        self.admin.refresh_from_db()
+        self.assertTrue(self.admin.password.startswith('sha1$'))
+
+
+class AsyncViewsTests(AdminAPITestCase):
+
+    def test_views_are_coroutines(self):
+        view = CurrentUserAPIView.as_view()
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        self.assertIs(view.cls, CurrentUserAPIView)
+        self.assertTrue(view.csrf_exempt)
+
+    def test_orm_runs_in_db_pool(self):
+        thread_name = asyncio.run(db_sync_to_async(lambda: threading.current_thread().name)())
+        self.assertTrue(thread_name.startswith('db'))
+
+    async def test_asgi_requests(self):
+        self.async_client.cookies = self.client.cookies
+        response = await self.async_client.get(reverse('current_user'))
+        self.assertEqual(response.json()['email'], 'admin@google.com')
+        response = await self.async_client.patch(reverse('update_user', args=[self.admin.pk]),
+                                                 {'last_name': 'Async'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await db_sync_to_async(lambda: MyUser.objects.get(pk=self.admin.pk).last_name)(), 'Async')
+
+
+class ProfilingTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, profiling.rules, 'rates', {})
+
+    def test_header_profiles_request(self):
+        response = self.client.get(reverse('current_user'),
+                                   HTTP_X_PROFILE=profiling.make_token('CurrentUserAPIView.get'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(RequestProfile.objects.values_list('view', flat=True)), ['CurrentUserAPIView.get'])
+        self.client.get(reverse('current_user'), HTTP_X_PROFILE=profiling.make_token('UsersListAPIView.get'))
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    def test_requests_dont_load_rules(self):
+        with mock.patch.object(profiling.Rules, 'load') as load:
+            self.client.get(reverse('current_user'))
+        load.assert_not_called()
+        self.start_profiling_rules.assert_called()
+
+    def test_changed_rule_applies_on_commit(self):
+        ProfilingRule.objects.create(view='CurrentUserAPIView.get', sample_rate=1)
+        self.assertEqual(profiling.rules.rates, {'CurrentUserAPIView.get': 1})
+        self.client.get(reverse('current_user'))
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    def test_expired_and_zero_rules_are_skipped(self):
+        ProfilingRule.objects.create(view='CurrentUserAPIView.get', sample_rate=0)
+        ProfilingRule.objects.create(view='UsersListAPIView.get', expires_at=timezone.now() - datetime.timedelta(1))
+        self.assertEqual(profiling.rules.rates, {})
+
+
+class UsersExportTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user('user@google.com', 'Иван', city='Омск')
+
+    def export(self, **params):
+        response = self.client.get(reverse('private_users_export'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export(fields='id,first_name,city').splitlines()]
+        self.assertEqual(rows, [{'id': self.admin.pk, 'first_name': 'Admin', 'city': ''},
+                                {'id': self.user.pk, 'first_name': 'Иван', 'city': 'Омск'}])
+
+    def test_csv(self):
+        self.assertEqual(self.export(type='csv', fields='id,email').splitlines(),
+                         ['id,email', f'{self.admin.pk},admin@google.com', f'{self.user.pk},user@google.com'])
+
+    def test_invalid_params(self):
+        for params in ({'type': 'xml'}, {'fields': 'id,password'}):
+            self.assertEqual(self.client.get(reverse('private_users_export'), params).status_code, 400)
+
+
+class ASGIHandlerTests(SimpleTestCase):
+
+    def test_streaming_parts_out_of_event_loop(self):
+        threads = []
+
+        def parts():
+            for part in (b'first', b'second'):
+                threads.append(threading.current_thread())
+                yield part
+
+        async def send_response():
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await ASGIHandler().send_response(StreamingHttpResponse(parts()), send)
+            return messages, threading.current_thread()
+
+        messages, loop_thread = asyncio.run(send_response())
+        self.assertEqual(b''.join(message.get('body', b'') for message in messages), b'firstsecond')
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        self.assertNotIn(loop_thread, threads)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImportUsersTests(TestCase):
+
+    def setUp(self):
+        MyUser.objects.create_user('existing@google.com', 'Existing')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def import_users(self, path, *args):
+        stderr = io.StringIO()
+        call_command('import_users', path, '--workers', '1', *args, stdout=io.StringIO(), stderr=stderr)
+        return stderr.getvalue()
+
+    def test_csv(self):
+        path = self.write('users.csv', 'email,first_name,city,password\n'
+                                       'ivan@google.com,Иван,Омск,secret\n'
+                                       'not-an-email,Петр,,\n'
+                                       'ivan@GOOGLE.com,Иван,,\n'
+                                       'existing@google.com,Existing,,\n'
+                                       'anna@google.com,Анна,,\n')
+        errors = self.import_users(path)
+        self.assertIn('Row 2:', errors)
+        self.assertIn('Row 3: duplicate email', errors)
+        self.assertIn('User existing@google.com already exists', errors)
+        ivan = MyUser.objects.get(email='ivan@google.com')
+        self.assertEqual((ivan.first_name, ivan.city), ('Иван', 'Омск'))
+        self.assertTrue(ivan.check_password('secret'))
+        self.assertFalse(MyUser.objects.get(email='anna@google.com').has_usable_password())
+        self.assertEqual(MyUser.objects.count(), 3)
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_resumes_from_checkpoint(self):
+        path = self.write('users.ndjson', '{"email": "first@google.com", "first_name": "First"}\n'
+                                          '{"email": "second@google.com", "first_name": "Second"}\n')
+        self.write('users.ndjson.checkpoint', '1')
+        self.import_users(path, '--hashed-passwords')
+        self.assertEqual(set(MyUser.objects.values_list('email', flat=True)),
+                         {'existing@google.com', 'second@google.com'})
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+        self.import_users(path, '--hashed-passwords', '--restart')
+        self.assertTrue(MyUser.objects.filter(email='first@google.com').exists())
+
+
+class UsersFilterTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        MyUser.objects.create_user('ivan@google.com', 'Иван', city='Омск', birthday=datetime.date(1990, 5, 1))
+        MyUser.objects.create_user('petr@google.com', 'Петр', city='Казань', birthday=datetime.date(2000, 1, 1),
+                                   is_active=False)
+
+    def emails(self, **params):
+        response = self.client.get(reverse('private_users'), {'fields': 'email', **params})
+        self.assertEqual(response.status_code, 200)
+        return [row['email'] for row in response.json()['results']]
+
+    def test_search(self):
+        self.assertEqual(self.emails(search='Ива'), ['ivan@google.com'])
+        self.assertEqual(self.emails(search='PETR'), ['petr@google.com'])
+        self.assertEqual(self.emails(search='Каз'), ['petr@google.com'])
+        self.assertEqual(self.emails(search='nobody'), [])
+
+    def test_empty_selection(self):
+        response = self.client.get(reverse('private_users'),
+                                   {'exclude': ','.join(PrivateUsersListSerializer.Meta.fields)})
+        self.assertEqual(response.json()['results'], [{}] * 3)
+        response = self.client.get(reverse('private_user', args=[self.admin.pk]),
+                                   {'exclude': ','.join(PrivateUserDetailSerializer.Meta.fields)})
+        self.assertEqual(response.json(), {})
+
+    def test_filters(self):
+        self.assertEqual(self.emails(city='Омск'), ['ivan@google.com'])
+        self.assertEqual(self.emails(is_active='false'), ['petr@google.com'])
+        self.assertEqual(self.emails(birthday_from='1995-01-01'), ['petr@google.com'])
+        self.assertEqual(self.emails(birthday_to='1995-01-01'), ['ivan@google.com'])
+        self.assertEqual(self.emails(joined_after=timezone.now().isoformat()), [])
+
+    def test_invalid_filter(self):
+        response = self.client.get(reverse('users'), {'birthday_from': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('birthday_from', response.json())
+
+
+class ThumbnailsTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = self.settings(MEDIA_ROOT=directory.name, MEDIA_URL='/media/')
+        media.enable()
+        self.addCleanup(media.disable)
+        self.name = default_storage.save('users/photo.png', ContentFile(self.image(600, 400)))
+
+    @staticmethod
+    def image(width, height):
+        content = io.BytesIO()
+        Image.new('RGBA', (width, height), (255, 0, 0, 128)).save(content, format='PNG')
+        return content.getvalue()
+
+    def open_thumbnail(self, size):
+        with default_storage.open(thumbnail_name(self.name, size)) as file:
+            image = Image.open(file)
+            image.load()
+            return image
+
+    def test_generate(self):
+        generate_thumbnails(self.name)
+        for size in settings.USER_PHOTO_THUMBNAIL_SIZES:
+            image = self.open_thumbnail(size)
+            self.assertEqual((image.format, max(image.size)), ('WEBP', size))
+        self.assertEqual(thumbnail_name(self.name, 64), 'users/photo.64.webp')
+
+    @override_settings(USER_PHOTO_THUMBNAIL_FORMAT='JPEG')
+    def test_jpeg_without_alpha(self):
+        generate_thumbnails(self.name, [64])
+        image = self.open_thumbnail(64)
+        self.assertEqual((image.format, image.mode, image.size), ('JPEG', 'RGB', (64, 43)))
+
+    def test_url_made_on_demand(self):
+        user = MyUser(email='user@google.com', photo=self.name)
+        self.assertEqual(thumbnail_url(user.photo, 128), '/media/users/photo.128.webp')
+        self.assertFalse(default_storage.exists('users/photo.64.webp'))
+        self.assertEqual(thumbnail_urls(user.photo), {str(size): f'/media/users/photo.{size}.webp'
+                                                      for size in settings.USER_PHOTO_THUMBNAIL_SIZES})
+
+    def test_broken_photo_falls_back_to_original(self):
+        name = default_storage.save('users/broken.png', ContentFile(b'not an image'))
+        user = MyUser(email='user@google.com', photo=name)
+        with self.assertLogs('user_data_storage_service.thumbnails', 'ERROR'):
+            self.assertEqual(thumbnail_url(user.photo, 64), '/media/users/broken.png')
+
+    def test_scheduled_after_commit(self):
+        with mock.patch('user_data_storage_service.signals.schedule_thumbnails') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                MyUser.objects.create_user('user@google.com', 'User', photo=self.name)
+                schedule.assert_not_called()
+        schedule.assert_called_once_with(self.name)
+
+    @override_settings(OUTBOX_SINKS=['file:///dev/null'])
+    def test_not_made_by_event(self):
+        with mock.patch('user_data_storage_service.thumbnails.generate_thumbnails') as generate, \
+                mock.patch('user_data_storage_service.signals.schedule_thumbnails'):
+            user = MyUser.objects.create_user('user@google.com', 'User', photo=self.name)
+        generate.assert_not_called()
+        payload = OutboxEvent.objects.get(user_id=user.pk).payload
+        self.assertNotIn('photo_urls', payload)
+        self.assertEqual(payload['email'], 'user@google.com')
+
+
+@override_settings(USER_CACHE_BACKEND='')
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+        user_cache.local.clear()
+        self.user = MyUser.objects.create_user('user@google.com', 'User')
+
+    def test_get_user(self):
+        self.assertEqual(user_cache.get_user(self.user.pk).first_name, 'User')
+        with self.assertNumQueries(0):
+            user = user_cache.get_user(self.user.pk)
+        self.assertEqual(user.email, 'user@google.com')
+        user.first_name = 'Changed'
+        self.assertEqual(user_cache.get_user(self.user.pk).first_name, 'User')
+        with self.assertRaises(MyUser.DoesNotExist):
+            user_cache.get_user(999)
+
+    def test_get_user_defers_additional_info(self):
+        MyUser.objects.filter(pk=self.user.pk).update(additional_info='Info')
+        with CaptureQueriesContext(connection) as queries:
+            user = user_cache.get_user(self.user.pk)
+        self.assertNotIn('additional_info', queries[0]['sql'])
+        self.assertEqual(user_cache.get_user(self.user.pk).get_deferred_fields(), {'additional_info'})
+        with self.assertNumQueries(1):
+            self.assertEqual(user_cache.serialize(PrivateUserDetailSerializer, user)['additional_info'], 'Info')
+        with self.assertNumQueries(0):
+            user_cache.serialize(PrivateUserDetailSerializer, user_cache.get_user(self.user.pk))
+
+    def test_invalidated_by_changes(self):
+        self.assertEqual(user_cache.serialize(PrivateUserDetailSerializer, self.user)['first_name'], 'User')
+        user_cache.get_user(self.user.pk)
+        self.user.first_name = 'Changed'
+        self.user.save()
+        self.assertEqual(user_cache.get_user(self.user.pk).first_name, 'Changed')
+        self.assertEqual(user_cache.serialize(PrivateUserDetailSerializer, self.user)['first_name'], 'Changed')
+        self.user.delete()
+        with self.assertRaises(MyUser.DoesNotExist):
+            user_cache.get_user(self.user.pk)
+
+    def test_serialize_pks(self):
+        queryset = MyUser.objects.all()
+        found = user_cache.serialize_pks(PrivateUserDetailSerializer, [self.user.pk, 999], queryset)
+        self.assertEqual(list(found), [self.user.pk])
+        stats = user_cache.stats()
+        with self.assertNumQueries(0):
+            user_cache.serialize_pks(PrivateUserDetailSerializer, [self.user.pk], queryset)
+        self.assertEqual(user_cache.stats()['local_hits'], stats['local_hits'] + 1)
+
+
+class ConditionalRequestsTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user('user@google.com', 'User')
+        self.url = reverse('private_user', args=[self.user.pk])
+
+    def patch(self, data, **headers):
+        return self.client.patch(self.url, data, content_type='application/json', **headers)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        self.assertEqual(self.patch({'last_name': 'Changed'}).status_code, 200)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_not_modified(self):
+        response = self.client.get(reverse('users'), {'limit': 10})
+        etag = response['ETag']
+        self.assertEqual(self.client.get(reverse('users'), {'limit': 10}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        MyUser.objects.create_user('new@google.com', 'New')
+        self.assertEqual(self.client.get(reverse('users'), {'limit': 10}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.patch({'last_name': 'First'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        self.assertEqual(self.patch({'last_name': 'Second'}, HTTP_IF_MATCH=etag).status_code, 412)
+        self.assertEqual(MyUser.objects.get(pk=self.user.pk).last_name, 'First')
+        self.assertEqual(self.patch({'last_name': 'Third'}, HTTP_IF_MATCH='*').status_code, 200)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'The NOCASE search indexes are made on SQLite')
+class SearchIndexesTests(TestCase):
+
+    def test_indexes_kept_after_table_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE '%%_search_idx'")
+            names = {name for name, in cursor.fetchall()}
+        self.assertEqual(names, {f'myuser_{field}_search_idx' for field in SEARCH_FIELDS})
+
+    def test_indexes_in_migration_state(self):
+        state = MigrationLoader(connection).project_state()
+        indexes = state.models['user_data_storage_service', 'myuser'].options['indexes']
+        names = {index.name for index in indexes if isinstance(index, SearchIndex)}
+        self.assertEqual(names, {f'myuser_{field}_search_idx' for field in SEARCH_FIELDS})
+
+    def test_search_uses_indexes(self):
+        plan = MyUser.objects.filter(email__istartswith='user').explain()
+        self.assertIn('USING INDEX myuser_email_search_idx', plan)
+
+
+@override_settings(METRICS_DIR='', METRICS_TOKEN='')
+class MetricsTests(AdminAPITestCase):
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('current_user'))
+        self.assertRegex(response['Server-Timing'], r'^db;desc="\d+ queries";dur=[\d.]+, serializer;dur=[\d.]+, '
+                                                    r'total;dur=[\d.]+$')
+
+    def test_metrics_of_requests(self):
+        self.client.get(reverse('current_user'))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_requests_total{method="GET",view="current_user",status="200"}', body)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+
+    def test_internal_ips_without_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+                   DATABASE_REPLICAS=[settings.TEST_REPLICA])
+class ReplicaRoutingTests(TransactionTestCase):
+    """The primary and the replica are separate databases here, so it is visible where each query went"""
+
+    databases = '__all__'
+    # The admin must get the same id in both databases, it is taken from the token
+    reset_sequences = True
+
+    def setUp(self):
+        self.replica = settings.TEST_REPLICA
+        health.reset()
+        user_cache.local.clear()
+        for alias in ('default', self.replica):
+            MyUser.objects.db_manager(alias).create_user('admin@google.com', 'Admin', 'password', is_admin=True)
+        # A replicated copy, the session of the login is bound to the password hash
+        password = MyUser.objects.using('default').get(email='admin@google.com').password
+        MyUser.objects.db_manager(self.replica).filter(email='admin@google.com').update(password=password)
+        MyUser.objects.db_manager(self.replica).create_user('replica@google.com', 'Replica')
+        MyUser.objects.db_manager('default').create_user('primary@google.com', 'Primary')
+        self.client.post(reverse('login'), {'email': 'admin@google.com', 'password': 'password'},
+                         content_type='application/json')
+
+    def get_emails(self):
+        response = self.client.get(reverse('private_users'))
+        self.assertEqual(response.status_code, 200)
+        return [user['email'] for user in response.json()['results']]
+
+    def test_list_reads_from_replica(self):
+        self.assertEqual(self.get_emails(), ['admin@google.com', 'replica@google.com'])
+
+    def test_current_user_reads_from_replica(self):
+        MyUser.objects.db_manager(self.replica).filter(email='admin@google.com').update(first_name='Replica admin')
+        response = self.client.get(reverse('current_user'))
+        self.assertEqual(response.json()['first_name'], 'Replica admin')
+
+    def test_replica_reads_are_not_cached(self):
+        self.client.get(reverse('current_user'))
+        self.client.get(reverse('private_users'), {'ids': '1,2'})
+        self.assertIsNone(user_cache.get(user_cache.USER, 1))
+        self.assertEqual(user_cache.get_many(PrivateUserDetailSerializer.__name__, [1, 2]), {})
+
+    def test_write_goes_to_primary_and_pins_reads(self):
+        response = self.client.patch(reverse('private_user', args=[1]), {'phone': '79530000000'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(PRIMARY_READS_COOKIE, response.cookies)
+        self.assertEqual(MyUser.objects.using('default').get(pk=1).phone, '79530000000')
+        self.assertEqual(MyUser.objects.using(self.replica).get(pk=1).phone, '')
+        self.assertEqual(self.get_emails(), ['admin@google.com', 'primary@google.com'])
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        with mock.patch.object(ReplicaHealth, 'check', return_value=False):
+            self.assertEqual(self.get_emails(), ['admin@google.com', 'primary@google.com'])
+
+
+class ReplicaSettingsTests(SimpleTestCase):
+
+    def import_settings(self, **environ):
+        return subprocess.run([sys.executable, '-c', 'import core.settings'], cwd=settings.BASE_DIR,
+                              env={**os.environ, **environ}, capture_output=True, text=True)
+
+    def test_window_covers_replica_lag(self):
+        result = self.import_settings(REPLICA_READ_YOUR_WRITES_WINDOW='5', REPLICA_MAX_LAG='10',
+                                      REPLICA_HEALTH_CHECK_INTERVAL='10')
+        self.assertIn('ImproperlyConfigured', result.stderr)
+        result = self.import_settings(REPLICA_READ_YOUR_WRITES_WINDOW='20', REPLICA_MAX_LAG='10',
+                                      REPLICA_HEALTH_CHECK_INTERVAL='10')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class ValuesListSerializationTests(TestCase):
+    """The values_list path of the lists must give the same JSON as the serializers over instances"""
+
+    def test_same_json_as_model_serializer(self):
+        MyUser.objects.create_user('first@google.com', 'Иван', last_name='O\'Neil "Jr"\n')
+        MyUser.objects.create_user('second@google.com', '😀', other_name='Other')
+        renderer = JSONRenderer()
+        for serializer_class in (UsersListSerializer, PrivateUsersListSerializer):
+            users = MyUser.objects.order_by('id')
+            rows = users.values_list(*serializer_class.values_fields())
+            self.assertEqual(renderer.render(serializer_class(users, many=True).data),
+                             renderer.render(serializer_class.represent_rows(rows)))
+
+
+class SparseFieldsetTests(SimpleTestCase):
+    """Fields of the response by `?fields=`, `?exclude=` and `?expand=`"""
+
+    def get_fields(self, query):
+        return PrivateUserDetailSerializer.requested_fields(QueryDict(query))
+
+    def test_derived_fields_only_on_expand(self):
+        self.assertNotIn('photo_urls', self.get_fields(''))
+        self.assertIn('photo_urls', self.get_fields('expand=photo_urls'))
+        self.assertEqual(self.get_fields('fields=email,id&expand=photo_urls'), ['id', 'email', 'photo_urls'])
+
+    def test_exclude(self):
+        fields = self.get_fields('exclude=additional_info,city')
+        self.assertNotIn('additional_info', fields)
+        self.assertIn('first_name', fields)
+        self.assertEqual(self.get_fields('fields=id,email&exclude=email'), ['id'])
+
+    def test_empty_selection(self):
+        fields = UsersListSerializer.requested_fields(QueryDict('exclude=id,first_name,last_name,email'))
+        self.assertEqual(UsersListSerializer.values_fields(fields), [])
+        self.assertEqual(UsersListSerializer.represent_rows([(1, 'Ivan', 'Petrov', 'ivan@google.com')], fields), [{}])
+        self.assertEqual(UsersListSerializer.values_fields(), UsersListSerializer.Meta.fields)
+
+    def test_unknown_fields(self):
+        with self.assertRaises(ValidationError) as context:
+            self.get_fields('fields=id,password&expand=city')
+        self.assertEqual(set(context.exception.detail), {'fields', 'expand'})
+
+
+class FastJSONRendererTests(SimpleTestCase):
+
+    def test_same_json_as_drf(self):
+        data = {'date': datetime.date(2022, 3, 1), 'time': datetime.datetime(2022, 3, 1, 10, 0, 0, 123456),
+                'decimal': Decimal('1.50'), 'text': 'Иван "\u2028"', 'nested': [(1, None)], 1: 2 ** 70}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+@override_settings(COMPRESSION_MIN_SIZE=100)
+class CompressionMiddlewareTests(SimpleTestCase):
+
+    def get_response(self, response, accept_encoding='gzip, deflate'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_compresses_by_threshold(self):
+        content = b'{"results": []}' * 20
+        response = self.get_response(HttpResponse(content, content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), content)
+        self.assertFalse(self.get_response(HttpResponse(b'{}', content_type='application/json')).has_header(
+            'Content-Encoding'))
+        self.assertFalse(self.get_response(HttpResponse(content, content_type='application/json'),
+                                           'gzip;q=0').has_header('Content-Encoding'))
+
+    def test_compresses_streaming(self):
+        chunks = [b'id,email\n', b'1,admin@google.com\n' * 10]
+        response = self.get_response(StreamingHttpResponse(iter(chunks), content_type='text/csv'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(chunks))
+
+
+class SchemaCacheTests(SimpleTestCase):
+
+    def test_schema_is_generated_once(self):
+        from core.yasg import schema_cache
+
+        response = self.client.get('/swagger.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        with mock.patch('drf_yasg.generators.OpenAPISchemaGenerator.get_schema') as get_schema:
+            self.assertEqual(self.client.get('/swagger.json').content, response.content)
+            self.assertEqual(self.client.get('/swagger.json', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            compressed = self.client.get('/swagger.json', HTTP_ACCEPT_ENCODING='gzip')
+        get_schema.assert_not_called()
+        self.assertEqual(gzip.decompress(compressed.content), response.content)
+        self.assertEqual(compressed['ETag'], response['ETag'])
+        self.assertEqual(len(schema_cache.version), 32)
+
+    @override_settings(SCHEMA_URL='')
+    def test_request_urls_are_bounded(self):
+        from core.yasg import schema_cache
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(SCHEMA_CACHE_DIR=directory), \
+                mock.patch.object(schema_cache, 'entries', LRUCache(maxsize=2)):
+            for host in ('a.example.com', 'b.example.com', 'c.example.com'):
+                response = self.client.get('/swagger.json', HTTP_HOST=host)
+                self.assertEqual(response.json()['host'], host)
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(len(schema_cache.entries), 2)
+
+
+class UserBatchTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user('user@google.com', 'User')
+
+    def post(self, *operations):
+        return self.client.post(reverse('private_users_batch'), {'operations': operations},
+                                content_type='application/json')
+
+    def test_applies_operations(self):
+        # Cached before the batch, bulk_update sends no signals
+        self.client.get(reverse('private_user', args=[self.user.pk]))
+        response = self.post({'op': 'create', 'data': {'first_name': 'New', 'email': 'new@google.com',
+                                                       'password': 'secret'}},
+                             {'op': 'update', 'id': self.user.pk, 'data': {'last_name': 'Changed'}},
+                             {'op': 'delete', 'id': 999})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json()['results']], [201, 200, 404])
+        self.assertTrue(MyUser.objects.get(email='new@google.com').check_password('secret'))
+        detail = self.client.get(reverse('private_user', args=[self.user.pk])).json()
+        self.assertEqual(detail['last_name'], 'Changed')
+
+    def test_invalid_operation_rejects_batch(self):
+        response = self.post({'op': 'update', 'id': self.user.pk, 'data': {'last_name': 'Changed'}},
+                             {'op': 'create', 'data': {'first_name': 'New', 'email': 'user@google.com',
+                                                       'password': 'secret'}},
+                             {'op': 'delete', 'id': self.admin.pk})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.json()['results']], [424, 400, 424])
+        self.assertEqual(MyUser.objects.get(pk=self.user.pk).last_name, '')
+        self.assertTrue(MyUser.objects.filter(pk=self.admin.pk).exists())
+
+    def test_deletes_with_tombstones(self):
+        other = MyUser.objects.create_user('other@google.com', 'User')
+        response = self.post({'op': 'delete', 'id': self.user.pk}, {'op': 'delete', 'id': other.pk})
+        self.assertEqual([result['status'] for result in response.json()['results']], [204, 204])
+        self.assertEqual(sorted(DeletedUser.objects.values_list('user_id', flat=True)), [self.user.pk, other.pk])
+
+    def test_passwords_hashed_before_transaction(self):
+        def hash_password(password):
+            self.assertFalse(connection.in_atomic_block)
+            return make_password(password)
+
+        with mock.patch('user_data_storage_service.batch.make_password', side_effect=hash_password) as hashed:
+            response = self.post({'op': 'create', 'data': {'first_name': 'New', 'email': 'new@google.com',
+                                                           'password': 'secret'}})
+        self.assertEqual(response.status_code, 200)
+        hashed.assert_called_once_with('secret')
+        self.assertTrue(MyUser.objects.get(email='new@google.com').check_password('secret'))
+
+    @override_settings(USERS_BATCH_MAX_OPERATIONS=2)
+    def test_too_many_operations(self):
+        with mock.patch.object(UserBatchOperationSerializer, 'run_validation') as run_validation:
+            response = self.post(*[{'op': 'delete', 'id': self.user.pk}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(),
+                         {'operations': {'non_field_errors': ['Ensure this field has no more than 2 elements.']}})
+        run_validation.assert_not_called()
+
+
+class UsersLookupTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = MyUser.objects.create_user('user@google.com', 'User')
+
+    def test_ids_in_request_order(self):
+        response = self.client.get(reverse('private_users'),
+                                   {'ids': f'{self.user.pk},999,{self.admin.pk}', 'fields': 'id'})
+        self.assertEqual(response.json(), {'results': [{'id': self.user.pk}, {'id': self.admin.pk}],
+                                           'missing': [999]})
+
+    def test_emails_in_body(self):
+        response = self.client.post(reverse('private_users_lookup') + '?fields=email',
+                                    {'emails': ['nobody@google.com', 'admin@google.com']},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'results': [{'email': 'admin@google.com'}],
+                                           'missing': ['nobody@google.com']})
+
+
+@override_settings(USERS_CHANGES_DELAY=0)
+class UserChangesTests(AdminAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = [MyUser.objects.create_user(f'user{number}@google.com', 'User') for number in range(3)]
+
+    def get_changes(self, **params):
+        response = self.client.get(reverse('private_users_changes'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync_by_pages(self):
+        first = self.get_changes(limit=3)
+        self.assertTrue(first['has_more'])
+        second = self.get_changes(since=first['cursor'], limit=3)
+        self.assertFalse(second['has_more'])
+        self.assertEqual([change['id'] for change in first['results'] + second['results']],
+                         [self.admin.pk] + [user.pk for user in self.users])
+        self.assertEqual({change['op'] for change in first['results']}, {'create'})
+        self.assertEqual(self.get_changes(since=second['cursor']), {'results': [], 'cursor': second['cursor'],
+                                                                    'has_more': False})
+
+    def test_updates_and_deletes_since_cursor(self):
+        cursor = self.get_changes()['cursor']
+        self.client.patch(reverse('private_user', kwargs={'pk': self.users[2].pk}), {'last_name': 'Updated'},
+                          content_type='application/json')
+        self.client.delete(reverse('private_user', kwargs={'pk': self.users[0].pk}))
+        changes = self.get_changes(since=cursor)['results']
+        self.assertEqual([(change['op'], change['id']) for change in changes],
+                         [('update', self.users[2].pk), ('delete', self.users[0].pk)])
+        self.assertEqual(changes[0]['data']['last_name'], 'Updated')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('private_users_changes'), {'since': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class FailingSink:
+    """Fails the first `failures` batches"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.bodies = []
+
+    async def send(self, body):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('Sink is down')
+        self.bodies.append(body)
+
+
+@override_settings(OUTBOX_SINKS=['file:///dev/null'], OUTBOX_RETRY_BACKOFF=0.01)
+class OutboxTests(AdminAPITestCase):
+
+    def events(self):
+        return list(OutboxEvent.objects.order_by('id').values_list('event_type', 'user_id'))
+
+    def test_events_of_changes(self):
+        response = self.client.post(reverse('private_users'), {'first_name': 'User', 'email': 'user@google.com'},
+                                    content_type='application/json')
+        pk = response.json()['id']
+        self.client.patch(reverse('private_user', kwargs={'pk': pk}), {'last_name': 'Updated'},
+                          content_type='application/json')
+        self.client.delete(reverse('private_user', kwargs={'pk': pk}))
+        # Login changes only last_login, it is not published
+        self.assertEqual(self.events(), [('user.created', self.admin.pk), ('user.created', pk),
+                                         ('user.updated', pk), ('user.deleted', pk)])
+        self.assertEqual(OutboxEvent.objects.get(event_type='user.updated').payload['last_name'], 'Updated')
+
+    def test_event_rolled_back_with_change(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            MyUser.objects.create_user('user@google.com', 'User')
+            raise RuntimeError
+        self.assertEqual(self.events(), [('user.created', self.admin.pk)])
+
+    def test_failed_sink_gets_batch_again(self):
+        MyUser.objects.create_user('user@google.com', 'User')
+        failing = FailingSink(failures=2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.ndjson')
+
+            async def dispatch():
+                dispatcher = OutboxDispatcher([FileSink(path), failing])
+                await dispatcher.run(once=True)
+                return dispatcher.delivered
+
+            with self.assertLogs('user_data_storage_service.outbox', 'WARNING') as logs:
+                self.assertEqual(asyncio.run(dispatch()), 2)
+            with open(path, 'rb') as file:
+                delivered = file.read()
+        self.assertEqual(failing.bodies, [delivered])
+        self.assertEqual([json.loads(line)['type'] for line in delivered.splitlines()], ['user.created'] * 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+class DeleteUsersTests(TestCase):
+    """Tombstones and outbox events of the users deleted in bulk, see `signals.delete_users`"""
+
+    def setUp(self):
+        self.ids = [MyUser.objects.create_user(f'user{number}@google.com', 'User').pk for number in range(3)]
+
+    def test_tombstones_in_bulk(self):
+        with CaptureQueriesContext(connection) as queries:
+            MyUserAdmin(MyUser, admin.site).delete_queryset(None, MyUser.objects.filter(id__in=self.ids))
+        inserts = [query for query in queries if query['sql'].startswith(f'INSERT INTO "{DeletedUser._meta.db_table}"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(sorted(DeletedUser.objects.values_list('user_id', flat=True)), self.ids)
+        self.assertFalse(MyUser.objects.exists())
+
+    @override_settings(OUTBOX_SINKS=['file:///dev/null'])
+    def test_events_in_bulk(self):
+        with CaptureQueriesContext(connection) as queries:
+            MyUserAdmin(MyUser, admin.site).delete_queryset(None, MyUser.objects.filter(id__in=self.ids))
+        inserts = [query for query in queries if query['sql'].startswith(f'INSERT INTO "{OutboxEvent._meta.db_table}"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(list(OutboxEvent.objects.filter(event_type='user.deleted').order_by('user_id')
+                              .values_list('user_id', 'payload')), [(pk, None) for pk in self.ids])
+
+    def test_tombstone_of_single_delete(self):
+        MyUser.objects.get(pk=self.ids[0]).delete()
+        self.assertEqual(list(DeletedUser.objects.values_list('user_id', flat=True)), self.ids[:1])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UsersChangeListTests(TestCase):
+
+    def setUp(self):
+        self.admin = MyUser.objects.create_superuser('admin@google.com', 'Admin', 'password')
+        for number in range(4):
+            MyUser.objects.create_user(f'user{number}@google.com', 'User')
+        self.client.force_login(self.admin)
+
+    def get_page(self, query=''):
+        with mock.patch.object(MyUserAdmin, 'list_per_page', 2):
+            response = self.client.get(reverse('admin:user_data_storage_service_myuser_changelist') + query)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context['cl']
+        return [user.email for user in cl.result_list], cl.previous_url, cl.next_url
+
+    def test_keyset_pages(self):
+        emails, previous_url, next_url = self.get_page()
+        self.assertEqual(emails, ['admin@google.com', 'user0@google.com'])
+        self.assertIsNone(previous_url)
+        emails, previous_url, next_url = self.get_page(next_url)
+        self.assertEqual(emails, ['user1@google.com', 'user2@google.com'])
+        emails, _, last_url = self.get_page(next_url)
+        self.assertEqual(emails, ['user3@google.com'])
+        self.assertIsNone(last_url)
+        self.assertEqual(self.get_page(previous_url)[0], ['admin@google.com', 'user0@google.com'])
+
+    def test_keyset_page_reads_only_its_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.get_page()
+        pages = [query['sql'] for query in queries if 'ORDER BY' in query['sql'] and
+                 f'FROM "{MyUser._meta.db_table}"' in query['sql']]
+        self.assertEqual(len(pages), 1)
+        self.assertIn('LIMIT 3', pages[0])
+        self.assertNotIn('OFFSET', pages[0])
+
+    @override_settings(COUNT_EXACT_THRESHOLD=1)
+    def test_estimated_count(self):
+        count_cache.counts.clear()
+        self.addCleanup(count_cache.counts.clear)
+        self.client.get(reverse('admin:user_data_storage_service_myuser_changelist'))
+        MyUser.objects.create_user('user4@google.com', 'User')
+        response = self.client.get(reverse('admin:user_data_storage_service_myuser_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 5)
+
+    def test_filter_from_cursor_page(self):
+        _, _, next_url = self.get_page()
+        with mock.patch.object(MyUserAdmin, 'list_per_page', 2):
+            cl = self.client.get(reverse('admin:user_data_storage_service_myuser_changelist') + next_url).context['cl']
+        self.assertNotIn('after', cl.params)
+        links = [choice['query_string'] for spec in cl.filter_specs for choice in spec.choices(cl)]
+        self.assertTrue(links)
+        self.assertFalse([link for link in links if 'after=' in link])
+        link = next(link for link in links if 'is_superuser__exact=0' in link)
+        self.assertEqual(self.get_page(link)[0], ['user0@google.com', 'user1@google.com'])
+
+    def test_keyset_pages_with_filter(self):
+        emails, previous_url, next_url = self.get_page('?is_superuser__exact=0')
+        self.assertEqual(emails, ['user0@google.com', 'user1@google.com'])
+        self.assertEqual(self.get_page(next_url)[0], ['user2@google.com', 'user3@google.com'])
+
+
+class SessionStoreTests(TestCase):
+    """Sessions are read through the in-process cache, only their expiry is written behind, see
+    `sessions.SessionCache`"""
+
+    def setUp(self):
+        session_cache.local.clear()
+        session_cache.pending.clear()
+
+    def test_write_through(self):
+        session = SessionStore()
+        session['user'] = 1
+        session.save()
+        self.assertTrue(Session.objects.filter(session_key=session.session_key).exists())
+
+        # Another worker, the session is not in its cache
+        session_cache.local.clear()
+        self.assertTrue(SessionStore().exists(session.session_key))
+        self.assertEqual(SessionStore(session.session_key)['user'], 1)
+
+        session['user'] = 2
+        session.save()
+        session_cache.local.clear()
+        self.assertEqual(SessionStore(session.session_key)['user'], 2)
+
+        session.delete()
+        self.assertFalse(Session.objects.filter(session_key=session.session_key).exists())
+        self.assertFalse(SessionStore().exists(session.session_key))
+        self.assertEqual(SessionStore(session.session_key).load(), {})
+
+    def test_expiry_written_behind(self):
+        session = SessionStore()
+        session['user'] = 1
+        session.save()
+        stored = Session.objects.get(session_key=session.session_key)
+
+        # Saved unchanged by SESSION_SAVE_EVERY_REQUEST
+        later = SessionStore(session.session_key)
+        self.assertEqual(later['user'], 1)
+        later.save()
+        self.assertEqual(Session.objects.get(session_key=session.session_key).expire_date, stored.expire_date)
+        expire_date = session_cache.pending[session.session_key]
+        self.assertGreater(expire_date, stored.expire_date)
+
+        # Changed by another worker meanwhile, the flush writes only the expiry
+        Session.objects.filter(session_key=session.session_key).update(session_data='changed')
+        session_cache.flush()
+        stored = Session.objects.get(session_key=session.session_key)
+        self.assertEqual(stored.session_data, 'changed')
+        self.assertEqual(stored.expire_date, expire_date)
+
+    @override_settings(SESSION_SWEEP_BATCH_SIZE=2)
+    def test_sweep_expired(self):
+        expired = timezone.now() - datetime.timedelta(days=1)
+        Session.objects.bulk_create([Session(session_key=f'expired{number}', session_data='', expire_date=expired)
+                                     for number in range(5)])
+        Session.objects.create(session_key='active', session_data='',
+                               expire_date=timezone.now() + datetime.timedelta(days=1))
+        self.assertEqual(session_cache.sweep(), 5)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['active'])
+
+
+class SessionSweepTests(TransactionTestCase):
+    """The thread of the sessions runs under the default settings, whether any expiry is written behind or not"""
+
+    def test_thread_started_by_sessions(self):
+        with mock.patch.object(session_cache, '_writer_pid', None), \
+                mock.patch('user_data_storage_service.sessions.threading.Thread') as thread:
+            SessionStore('missing').load()
+        thread.assert_called_once_with(target=session_cache.run_writer, name='session-writer', daemon=True)
+
+        SessionStore().save()
+        self.assertIn('session-writer', [thread.name for thread in threading.enumerate()])
+
+    def test_thread_sweeps_expired(self):
+        Session.objects.create(session_key='expired', session_data='',
+                               expire_date=timezone.now() - datetime.timedelta(days=1))
+        Session.objects.create(session_key='active', session_data='',
+                               expire_date=timezone.now() + datetime.timedelta(days=1))
+        session_cache.run_once()
+        self.assertEqual(Session.objects.count(), 2)
+        with mock.patch.object(session_cache, '_swept_at', time.monotonic() - settings.SESSION_SWEEP_INTERVAL):
+            session_cache.run_once()
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['active'])
@@ -0,0 +1,77 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Pillow releases the GIL while decoding, resizing and encoding, so threads are enough here
+thumbnail_executor = ThreadPoolExecutor(max_workers=settings.USER_PHOTO_THUMBNAIL_WORKERS,
+                                        thread_name_prefix='thumbnails')
+
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+def thumbnail_name(name, size):
+    """Thumbnail is stored next to the original: users/2022/02/25/photo.jpg -> users/2022/02/25/photo.128.webp"""
+    root, _ = os.path.splitext(name)
+    return f'{root}.{size}.{EXTENSIONS[settings.USER_PHOTO_THUMBNAIL_FORMAT]}'
+
+
+def generate_thumbnails(name, sizes=None):
+    """Makes the missing thumbnails of the photo"""
+    sizes = [size for size in sizes or settings.USER_PHOTO_THUMBNAIL_SIZES
+             if not default_storage.exists(thumbnail_name(name, size))]
+    if not sizes:
+        return
+
+    image_format = settings.USER_PHOTO_THUMBNAIL_FORMAT
+    with default_storage.open(name) as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        for size in sorted(sizes, reverse=True):
+            image.thumbnail((size, size))
+            content = io.BytesIO()
+            image.save(content, format=image_format, quality=settings.USER_PHOTO_THUMBNAIL_QUALITY)
+            path = thumbnail_name(name, size)
+            # The path is deterministic, so a thumbnail left by a failed run is replaced rather than renamed
+            default_storage.delete(path)
+            default_storage.save(path, ContentFile(content.getvalue()))
+
+
+def _generate_in_background(name):
+    try:
+        generate_thumbnails(name)
+    except Exception:
+        logger.exception('Failed to make thumbnails of %s', name)
+
+
+def schedule_thumbnails(name):
+    thumbnail_executor.submit(_generate_in_background, name)
+
+
+def thumbnail_url(photo, size):
+    """Returns the URL of the thumbnail, a missing one is made on demand. Falls back to the original photo when
+    the thumbnail can't be made"""
+    if not photo:
+        return None
+    name = thumbnail_name(photo.name, size)
+    if not default_storage.exists(name):
+        try:
+            generate_thumbnails(photo.name, [size])
+        except Exception:
+            logger.exception('Failed to make thumbnails of %s', photo.name)
+            return photo.url
+    return default_storage.url(name)
+
+
+def thumbnail_urls(photo):
+    if not photo:
+        return None
+    return {str(size): thumbnail_url(photo, size) for size in settings.USER_PHOTO_THUMBNAIL_SIZES}
@@ -1,6 +1,7 @@
 from django.urls import re_path
 from .views import LoginAPIView, LogoutAPIView, CurrentUserAPIView, UsersListAPIView, UpdateUserAPIView, \
-    PrivateUsersListCreateAPIView, PrivateUserDetailRetrieveUpdateDestroyAPIView
+    PrivateUsersListCreateAPIView, PrivateUserDetailRetrieveUpdateDestroyAPIView, PrivateUsersExportAPIView, \
+    PrivateUsersBatchAPIView, PrivateUsersLookupAPIView, PrivateUsersChangesAPIView
 
 urlpatterns = [
     re_path(r'^login/$', LoginAPIView.as_view(), name='login'),
@@ -9,6 +10,10 @@ urlpatterns = [
     re_path(r'^users/$', UsersListAPIView.as_view(), name='users'),
     re_path(r'^users/(?P<pk>\d+)/$', UpdateUserAPIView.as_view(), name='update_user'),
     re_path(r'^private/users/$', PrivateUsersListCreateAPIView.as_view(), name='private_users'),
+    re_path(r'^private/users/export/$', PrivateUsersExportAPIView.as_view(), name='private_users_export'),
+    re_path(r'^private/users/lookup/$', PrivateUsersLookupAPIView.as_view(), name='private_users_lookup'),
+    re_path(r'^private/users/changes/$', PrivateUsersChangesAPIView.as_view(), name='private_users_changes'),
+    re_path(r'^private/users/batch/$', PrivateUsersBatchAPIView.as_view(), name='private_users_batch'),
     re_path(r'private/users/(?P<pk>\d+)/$', PrivateUserDetailRetrieveUpdateDestroyAPIView.as_view(),
             name='private_user')
 ]
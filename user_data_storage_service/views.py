@@ -1,34 +1,168 @@
-import jwt
+from django.conf import settings
 from django.contrib.auth import login, logout
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
 from django.utils.decorators import method_decorator
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import generics, permissions, mixins, status
-from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
-from rest_framework.views import APIView
-import datetime
+from .async_views import AsyncAPIView, db_sync_to_async
+from .authentication import encode_token
+from .batch import UserBatch
+from .cache import user_cache
+from .changes import UserChanges
+from .conditional import check_if_match, not_modified, page_etag, set_validators, user_etag
+from .export import EXPORT_CONTENT_TYPES, EXPORT_DEFAULT_FIELDS, EXPORT_FIELDS, stream_users
+from .filters import UsersFilterBackend
+from .hashers import PoolSaturated, get_password_pool
+from .pagination import UsersCursorPagination, UsersLimitOffsetPagination
 from .permissions import AuthorOrReadOnly
+from .routers import must_read_primary, pin_primary_reads, read_from_replica
 from .models import MyUser
 from .serializers import UsersListSerializer, UpdateUserSerializer, PrivateUsersListSerializer, \
-    PrivateUserDetailSerializer, PrivateCreateUserSerializer, CurrentUserSerializer, LoginSerializer
+    PrivateUserDetailSerializer, PrivateCreateUserSerializer, CurrentUserSerializer, LoginSerializer, \
+    UserBatchSerializer, UsersLookupSerializer, UserChangesSerializer
 
 
-class Mixin(APIView):
+SPARSE_FIELDSET_PARAMETERS = [
+    openapi.Parameter('fields', openapi.IN_QUERY, description='Только перечисленные через запятую поля',
+                      type=openapi.TYPE_STRING),
+    openapi.Parameter('exclude', openapi.IN_QUERY, description='Поля через запятую, которые не нужно отдавать',
+                      type=openapi.TYPE_STRING),
+]
+OFFSET_PARAMETER = openapi.Parameter('offset', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                                     description='Страница по смещению вместо курсора, для прежних клиентов')
+EXPAND_PARAMETER = openapi.Parameter('expand', openapi.IN_QUERY, description='Вычисляемые поля через запятую: '
+                                                                             'photo_urls', type=openapi.TYPE_STRING)
+
+LOOKUP_PARAMETERS = [
+    openapi.Parameter('ids', openapi.IN_QUERY, description='id пользователей через запятую', type=openapi.TYPE_STRING),
+    openapi.Parameter('emails', openapi.IN_QUERY, description='Email пользователей через запятую',
+                      type=openapi.TYPE_STRING),
+]
+
+
+class Mixin(AsyncAPIView):
+    """The user is authenticated by the token from Cookies, see `authentication.JWTAuthentication`.
+    Reads are served by a replica, see `routers.PrimaryReplicaRouter`"""
+
     queryset = MyUser.objects.all().order_by('id')
+    permission_classes = [permissions.IsAuthenticated]
+    # Views which only read, whatever the method (e.g. a POST with the query in the body)
+    read_only = False
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method in permissions.SAFE_METHODS or self.read_only:
+            if must_read_primary(request):
+                return await super().dispatch(request, *args, **kwargs)
+            with read_from_replica():
+                return await super().dispatch(request, *args, **kwargs)
+
+        response = await super().dispatch(request, *args, **kwargs)
+        if response.status_code < 400:
+            pin_primary_reads(response)
+        return response
+
+
+class ValuesListModelMixin:
+    """Only the requested columns of the list serializer are read, with `values_list`, and the rows are given out
+    as they are (see `serializers.ValuesListSerializerMixin` and `serializers.SparseFieldsetMixin`).
+    The page is not built at all when the client's copy is up to date"""
+
+    # Besides the serialized ones, for the ETag and for the cursor positions of the orderings
+    extra_values_fields = ('id', 'updated_at', 'data_joined')
+    # The pages by `?offset=`, as before the cursor pagination
+    offset_pagination_class = UsersLimitOffsetPagination
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            request = getattr(self, 'request', None)
+            if request is not None and 'offset' in request.query_params:
+                self._paginator = self.offset_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.get_serializer_class()
+        requested_fields = serializer_class.requested_fields(request.query_params)
+        fields = list(serializer_class.values_fields(requested_fields))
+        fields += [field for field in self.extra_values_fields if field not in fields]
+        queryset = self.filter_queryset(self.get_queryset()).values_list(*fields, named=True)
+        page = self.paginate_queryset(queryset)
+
+        etag = page_etag(((row.id, row.updated_at) for row in page), self.paginator.count,
+                         self.paginator.get_next_link(), self.paginator.get_previous_link())
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+        response = self.get_paginated_response(serializer_class.represent_rows(page, requested_fields))
+        return set_validators(response, etag)
+
+
+class UsersLookupMixin:
+    """Full data of the users by ids or emails. The payloads come from the user cache, the missing users are read
+    with one IN query. The users come in the order of the request, those not found are listed in `missing`"""
+
+    lookup_params = ('ids', 'emails')
+
+    def list(self, request, *args, **kwargs):
+        data = {name: request.query_params[name].split(',') for name in self.lookup_params
+                if name in request.query_params}
+        if data:
+            return self.lookup(request, data)
+        return super().list(request, *args, **kwargs)
+
+    @staticmethod
+    def lookup(request, data):
+        serializer = UsersLookupSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        fields = PrivateUserDetailSerializer.requested_fields(request.query_params)
+        (name, values), = serializer.validated_data.items()
+        values = list(dict.fromkeys(values))
 
-    def check_authentication_failed(self, request):
-        """if a token does not locate in Cookies or id from Cookies don't match with the current user id from request,
-        returns AuthenticationFailed error"""
-        encode_token = request.COOKIES.get('jwt')
+        queryset = MyUser.objects.order_by()
+        if name == 'ids':
+            found = user_cache.serialize_pks(PrivateUserDetailSerializer, values, queryset)
+        else:
+            users = {user.email: user for user in queryset.filter(email__in=values)}
+            found = dict(zip(users, user_cache.serialize_many(PrivateUserDetailSerializer, list(users.values()))))
+        return Response({
+            'results': [PrivateUserDetailSerializer.select_fields(found[value], fields)
+                        for value in values if value in found],
+            'missing': [value for value in values if value not in found],
+        })
+
+
+class ConditionalUpdateMixin:
+    """PATCH with If-Match is applied only to the version of the user the client has seen"""
+
+    def update(self, request, *args, **kwargs):
+        if 'HTTP_IF_MATCH' in request.META:
+            # The user is locked from the check until the save
+            with transaction.atomic():
+                response = super().update(request, *args, **kwargs)
+        else:
+            response = super().update(request, *args, **kwargs)
+        return set_validators(response, user_etag(self.user), self.user.updated_at)
 
-        if encode_token is None:
-            return self.handle_exception(AuthenticationFailed)
-        decode_token = jwt.decode(encode_token, 'secret', algorithms=['HS256'])
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method == 'PATCH' and 'HTTP_IF_MATCH' in self.request.META:
+            # The row stays locked until the change is saved, so nobody can change it after the check
+            queryset = queryset.select_for_update()
+        return queryset
 
-        if request.user.id != decode_token['id']:
-            return self.handle_exception(AuthenticationFailed)
+    def get_object(self):
+        self.user = super().get_object()
+        if self.request.method == 'PATCH':
+            check_if_match(self.request, self.user)
+        return self.user
 
 
 @method_decorator(name='get', decorator=swagger_auto_schema(
@@ -37,17 +171,22 @@ class Mixin(APIView):
                           "а так же информация является ли он администратором",
     operation_id="current_user_users_current_get",
     operation_summary="Получение данных о текущем пользователе",
-    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized'}
+    manual_parameters=SPARSE_FIELDSET_PARAMETERS + [EXPAND_PARAMETER],
+    responses={'200': 'Successful Response', '304': 'Not Modified', '400': 'Bad Request', '401': 'Unauthorized'}
 ))
 class CurrentUserAPIView(Mixin):
     """Получение данных о текущем пользователе. Здесь находится вся информация, доступная пользователю о самом себе,
     а так же информация является ли он администратором"""
 
-    def get(self, request):
-        self.check_authentication_failed(request)
-        user = MyUser.objects.get(id=request.user.id)
-        serializer = CurrentUserSerializer(user)
-        return Response(serializer.data)
+    async def get(self, request):
+        fields = CurrentUserSerializer.requested_fields(request.query_params)
+        user = request.user
+        etag = user_etag(user)
+        response = not_modified(request, etag, user.updated_at)
+        if response is not None:
+            return response
+        data = await db_sync_to_async(user_cache.serialize)(CurrentUserSerializer, user)
+        return set_validators(Response(CurrentUserSerializer.select_fields(data, fields)), etag, user.updated_at)
 
 
 @method_decorator(name='get', decorator=swagger_auto_schema(
@@ -55,17 +194,20 @@ class CurrentUserAPIView(Mixin):
     operation_description="Здесь находится вся информация, доступная пользователю о других пользователях",
     operation_id="users_users_get",
     operation_summary="Постраничное получение кратких данных обо всех пользователях",
-    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '422': 'Validation Error'}
+    manual_parameters=SPARSE_FIELDSET_PARAMETERS + [OFFSET_PARAMETER],
+    responses={'200': 'Successful Response', '304': 'Not Modified', '400': 'Bad Request', '401': 'Unauthorized',
+               '422': 'Validation Error'}
 ))
-class UsersListAPIView(Mixin, generics.ListAPIView):
+class UsersListAPIView(Mixin, ValuesListModelMixin, generics.ListAPIView):
     """Постраничное получение кратких данных обо всех пользователях. Здесь находится вся информация, доступная
     пользователю о других пользователях"""
 
     serializer_class = UsersListSerializer
+    pagination_class = UsersCursorPagination
+    filter_backends = [UsersFilterBackend]
 
-    def get(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return super().get(self, request, *args, **kwargs)
+    async def get(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.list)(request, *args, **kwargs)
 
 
 @method_decorator(name='patch', decorator=swagger_auto_schema(
@@ -74,36 +216,39 @@ class UsersListAPIView(Mixin, generics.ListAPIView):
     operation_id="edit_user_users__pk__patch",
     operation_summary="Изменение данных пользователя",
     responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '404': 'Not Found',
-               '422': 'Validation Error'}
+               '412': 'Precondition Failed', '422': 'Validation Error'}
 ))
-class UpdateUserAPIView(Mixin, mixins.UpdateModelMixin, GenericAPIView):
+class UpdateUserAPIView(Mixin, ConditionalUpdateMixin, mixins.UpdateModelMixin, GenericAPIView):
     """Изменение данных пользователя. Здесь пользователь имеет возможность изменить свои данные"""
 
     serializer_class = UpdateUserSerializer
     permission_classes = [AuthorOrReadOnly]
 
-    def patch(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return self.partial_update(request, *args, **kwargs)
+    async def patch(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.partial_update)(request, *args, **kwargs)
 
 
-class PrivateUsersListCreateAPIView(Mixin, generics.ListCreateAPIView):
+class PrivateUsersListCreateAPIView(Mixin, UsersLookupMixin, ValuesListModelMixin, generics.ListCreateAPIView):
     """Постраничное получение кратких данных обо всех пользователях. Здесь находится вся информация, доступная
     пользователю о других пользователях"""
 
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = UsersCursorPagination
+    filter_backends = [UsersFilterBackend]
 
     @method_decorator(name='get', decorator=swagger_auto_schema(
         tags=['admin'],
-        operation_description="Здесь находится вся информация, доступная пользователю о других пользователях",
+        operation_description="Здесь находится вся информация, доступная пользователю о других пользователях. "
+                              "С параметром ids или emails возвращаются полные данные перечисленных пользователей "
+                              "в порядке запроса, ненайденные перечисляются в missing",
         operation_id="private_users_private_users_get",
         operation_summary="Постраничное получение кратких данных обо всех пользователях",
-        responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden',
-                   '422': 'Validation Error'}
+        manual_parameters=SPARSE_FIELDSET_PARAMETERS + LOOKUP_PARAMETERS + [OFFSET_PARAMETER],
+        responses={'200': 'Successful Response', '304': 'Not Modified', '400': 'Bad Request', '401': 'Unauthorized',
+                   '403': 'Forbidden', '422': 'Validation Error'}
     ))
-    def get(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return super().list(request, *args, **kwargs)
+    async def get(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.list)(request, *args, **kwargs)
 
     @method_decorator(name='post', decorator=swagger_auto_schema(
         tags=['admin'],
@@ -113,9 +258,8 @@ class PrivateUsersListCreateAPIView(Mixin, generics.ListCreateAPIView):
         responses={'201': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden',
                    '422': 'Validation Error'}
     ))
-    def post(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return super().create(request, *args, **kwargs)
+    async def post(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.create)(request, *args, **kwargs)
 
     def create(self, request, *args, **kwargs):
         serializer = PrivateUserDetailSerializer(data=request.data)
@@ -132,7 +276,7 @@ class PrivateUsersListCreateAPIView(Mixin, generics.ListCreateAPIView):
         return serializer_class
 
 
-class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, mixins.RetrieveModelMixin,
+class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, ConditionalUpdateMixin, mixins.RetrieveModelMixin,
                                                     mixins.UpdateModelMixin, mixins.DestroyModelMixin, GenericAPIView):
     """Детальное получение информации о пользователе. Здесь администратор может увидеть всю существующую
     пользовательскую информацию"""
@@ -144,12 +288,12 @@ class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, mixins.RetrieveModelM
         operation_description="Здесь администратор может увидеть всю существующую пользовательскую информацию",
         operation_id="private_get_user_private_users__pk__get",
         operation_summary="Детальное получение информации о пользователе",
-        responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden',
-                   '404': 'Not Found', '422': 'Validation Error'}
+        manual_parameters=SPARSE_FIELDSET_PARAMETERS + [EXPAND_PARAMETER],
+        responses={'200': 'Successful Response', '304': 'Not Modified', '400': 'Bad Request', '401': 'Unauthorized',
+                   '403': 'Forbidden', '404': 'Not Found', '422': 'Validation Error'}
     ))
-    def get(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return self.retrieve(request, *args, **kwargs)
+    async def get(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.retrieve)(request, *args, **kwargs)
 
     @method_decorator(name='patch', decorator=swagger_auto_schema(
         tags=['admin'],
@@ -157,11 +301,10 @@ class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, mixins.RetrieveModelM
         operation_id="private_patch_user_private_users__pk__patch",
         operation_summary="Изменение информации о пользователе",
         responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden',
-                   '404': 'Not Found', '422': 'Validation Error'}
+                   '404': 'Not Found', '412': 'Precondition Failed', '422': 'Validation Error'}
     ))
-    def patch(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return self.partial_update(request, *args, **kwargs)
+    async def patch(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.partial_update)(request, *args, **kwargs)
 
     @method_decorator(name='delete', decorator=swagger_auto_schema(
         tags=['admin'],
@@ -170,9 +313,23 @@ class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, mixins.RetrieveModelM
         operation_summary="Удаление пользователя",
         responses={'204': 'Successful Response', '401': 'Unauthorized', '403': 'Forbidden', '422': 'Validation Error'}
     ))
-    def delete(self, request, *args, **kwargs):
-        self.check_authentication_failed(request)
-        return self.destroy(request, *args, **kwargs)
+    async def delete(self, request, *args, **kwargs):
+        return await db_sync_to_async(self.destroy)(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        fields = PrivateUserDetailSerializer.requested_fields(request.query_params)
+        try:
+            user = user_cache.get_user(kwargs['pk'])
+        except MyUser.DoesNotExist:
+            raise Http404
+        self.check_object_permissions(request, user)
+
+        etag = user_etag(user)
+        response = not_modified(request, etag, user.updated_at)
+        if response is not None:
+            return response
+        data = user_cache.serialize(PrivateUserDetailSerializer, user)
+        return set_validators(Response(PrivateUserDetailSerializer.select_fields(data, fields)), etag, user.updated_at)
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
@@ -182,55 +339,174 @@ class PrivateUserDetailRetrieveUpdateDestroyAPIView(Mixin, mixins.RetrieveModelM
         return self.serializer_class
 
 
+@method_decorator(name='get', decorator=swagger_auto_schema(
+    tags=['admin'],
+    operation_description="Здесь администратор может выгрузить всех пользователей одним потоком в формате NDJSON или "
+                          "CSV, в выгрузку попадают только перечисленные в параметре fields поля",
+    operation_id="private_export_users_private_users_export_get",
+    operation_summary="Выгрузка всех пользователей",
+    manual_parameters=[
+        openapi.Parameter('type', openapi.IN_QUERY, description='Формат выгрузки', type=openapi.TYPE_STRING,
+                          enum=list(EXPORT_CONTENT_TYPES), default='ndjson'),
+        openapi.Parameter('fields', openapi.IN_QUERY, description='Поля через запятую: ' + ', '.join(EXPORT_FIELDS),
+                          type=openapi.TYPE_STRING),
+    ],
+    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden'}
+))
+class PrivateUsersExportAPIView(Mixin):
+    """Выгрузка всех пользователей. Строки отдаются по мере чтения из базы данных, поэтому расход памяти не зависит
+    от числа пользователей"""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    async def get(self, request):
+        file_format = request.query_params.get('type', 'ndjson')
+        if file_format not in EXPORT_CONTENT_TYPES:
+            raise ValidationError({'type': [f'Unknown format: {file_format}']})
+
+        fields = request.query_params.get('fields')
+        fields = fields.split(',') if fields else EXPORT_DEFAULT_FIELDS
+        unknown_fields = [field for field in fields if field not in EXPORT_FIELDS]
+        if unknown_fields:
+            raise ValidationError({'fields': [f'Unknown fields: {", ".join(unknown_fields)}']})
+
+        response = StreamingHttpResponse(stream_users(fields, file_format),
+                                         content_type=EXPORT_CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = f'attachment; filename="users.{file_format}"'
+        return response
+
+
+@method_decorator(name='get', decorator=swagger_auto_schema(
+    tags=['admin'],
+    operation_description="Здесь внешние системы получают только созданных, измененных и удаленных с прошлой "
+                          "синхронизации пользователей, в порядке изменения. Первый запрос без since отдает всех "
+                          "пользователей, следующие передают в since курсор из ответа предыдущего. Пока has_more "
+                          "равен true, следующую страницу можно запрашивать сразу",
+    operation_id="private_changes_users_private_users_changes_get",
+    operation_summary="Изменения пользователей с прошлой синхронизации",
+    manual_parameters=[
+        openapi.Parameter('since', openapi.IN_QUERY, description='Курсор из ответа предыдущего запроса',
+                          type=openapi.TYPE_STRING),
+        openapi.Parameter('limit', openapi.IN_QUERY, description='Число изменений в ответе', type=openapi.TYPE_INTEGER),
+    ],
+    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden'}
+))
+class PrivateUsersChangesAPIView(Mixin):
+    """Изменения пользователей с прошлой синхронизации, см. `changes.UserChanges`"""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    async def get(self, request):
+        serializer = UserChangesSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        changes = UserChanges(**serializer.validated_data)
+        results, cursor, has_more = await db_sync_to_async(changes.get_page)()
+        return Response({'results': results, 'cursor': cursor, 'has_more': has_more})
+
+
+@method_decorator(name='post', decorator=swagger_auto_schema(
+    tags=['admin'],
+    operation_description="Здесь можно получить полные данные множества пользователей по id или email одним "
+                          "запросом, если их слишком много для параметров GET /private/users/. Пользователи "
+                          "возвращаются в порядке запроса, ненайденные перечисляются в missing",
+    operation_id="private_lookup_users_private_users_lookup_post",
+    operation_summary="Получение пользователей по списку id или email",
+    manual_parameters=SPARSE_FIELDSET_PARAMETERS + [EXPAND_PARAMETER],
+    request_body=UsersLookupSerializer,
+    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden'}
+))
+class PrivateUsersLookupAPIView(Mixin):
+    """Получение пользователей по списку id или email. Запрос только читает данные, поэтому идет в реплику"""
+
+    permission_classes = [permissions.IsAdminUser]
+    read_only = True
+
+    async def post(self, request):
+        return await db_sync_to_async(UsersLookupMixin.lookup)(request, request.data)
+
+
+@method_decorator(name='post', decorator=swagger_auto_schema(
+    tags=['admin'],
+    operation_description="Здесь администратор может создать, изменить и удалить множество пользователей одним "
+                          "запросом. Операции применяются в одной транзакции: если хотя бы одна операция неверна, "
+                          "не применяется ни одна. Результат возвращается для каждой операции в порядке запроса",
+    operation_id="private_batch_users_private_users_batch_post",
+    operation_summary="Пакетное изменение пользователей",
+    request_body=UserBatchSerializer,
+    responses={'200': 'Successful Response', '400': 'Bad Request', '401': 'Unauthorized', '403': 'Forbidden',
+               '409': 'Conflict'}
+))
+class PrivateUsersBatchAPIView(Mixin):
+    """Пакетное изменение пользователей. Создания, изменения и удаления применяются в одной транзакции,
+    см. `batch.UserBatch`"""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    async def post(self, request):
+        serializer = UserBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        batch = UserBatch(serializer.validated_data['operations'])
+        await db_sync_to_async(batch.apply)()
+        return Response({'results': batch.results}, status=batch.status_code)
+
+
 @method_decorator(name='post', decorator=swagger_auto_schema(
     tags=['auth'],
     operation_description="После успешного входа в систему необходимо установить Cookies для пользователя",
     operation_id="login_login_post",
     operation_summary="Вход в систему",
-    responses={'200': 'Successful Response', '400': 'Bad Request', '422': 'Validation Error'}
+    responses={'200': 'Successful Response', '400': 'Bad Request', '422': 'Validation Error',
+               '503': 'Service Unavailable'}
 ))
-class LoginAPIView(GenericAPIView):
+class LoginAPIView(AsyncAPIView, GenericAPIView):
     """Вход в систему"""
 
     serializer_class = LoginSerializer
+    authentication_classes = []
 
-    def post(self, request):
+    async def post(self, request):
         try:
             email = request.data['email']
             password = request.data['password']
+        except KeyError:
+            raise ValidationError
 
-            try:
-                user = MyUser.objects.get(email=email)
-            except ObjectDoesNotExist:
-                data = {
-                    'error': '"Validation Error (422)'
-                }
-                return Response(data, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-
-            if user is None or not user.check_password(password):
-                data = {
-                    'error': '"Validation Error (422)'
-                }
-                return Response(data, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-
-            elif user is not None:
-                login(request, user)
-                data = {
-                    'message': 'Вход в систему'
-                }
-                payload = {
-                    'id': user.id,
-                    'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24),
-                    'iat': datetime.datetime.utcnow()
-                }
-                encoded_token = jwt.encode(payload, 'secret', algorithm='HS256')
-
-                response = Response(data, status=status.HTTP_200_OK)
-                response.set_cookie(key='jwt', value=encoded_token, httponly=True)
-                return response
+        try:
+            user = await db_sync_to_async(MyUser.objects.get)(email=email)
+        except ObjectDoesNotExist:
+            data = {
+                'error': '"Validation Error (422)'
+            }
+            return Response(data, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-        except KeyError:
-            self.handle_exception(ValidationError)
+        try:
+            is_correct, new_encoded = await get_password_pool().verify(password, user.password)
+        except PoolSaturated:
+            data = {
+                'error': 'Service Unavailable (503)'
+            }
+            return Response(data, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
+        if not is_correct:
+            data = {
+                'error': '"Validation Error (422)'
+            }
+            return Response(data, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        if new_encoded is not None:
+            # Hasher parameters have changed since the password was set, the hash is upgraded transparently
+            user.password = new_encoded
+            await db_sync_to_async(user.save)(update_fields=['password'])
+
+        await db_sync_to_async(login)(request, user)
+        data = {
+            'message': 'Вход в систему'
+        }
+        encoded_token = encode_token(user)
+
+        response = Response(data, status=status.HTTP_200_OK)
+        response.set_cookie(key=settings.JWT_COOKIE_NAME, value=encoded_token, httponly=True)
+        return response
 
 
 @method_decorator(name='get', decorator=swagger_auto_schema(
@@ -240,18 +516,18 @@ class LoginAPIView(GenericAPIView):
     operation_summary="Выход из системы",
     responses={'200': 'Successful Response'}
 ))
-class LogoutAPIView(APIView):
+class LogoutAPIView(AsyncAPIView):
     """Выход из системы"""
 
     permission_classes = [permissions.IsAuthenticated]
 
-    def get(self, request):
-        logout(request)
+    async def get(self, request):
+        await db_sync_to_async(logout)(request)
 
         data = {
             'message': 'Выход из системы'
         }
         response = Response(data, status=status.HTTP_200_OK)
-        response.delete_cookie('jwt')
+        response.delete_cookie(settings.JWT_COOKIE_NAME)
 
         return response